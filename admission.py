@@ -0,0 +1,225 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import g, request
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from auth import verified_tokens
+from pool import is_async_url, setting
+from serializers import jsonify
+
+'''
+Admission control
+
+    ADMISSION_RATE=20 ADMISSION_BURST=40
+    ADMISSION_CONCURRENCY=products=16,orders=8,export=2
+
+every client (the subject of its bearer token once the token has been verified, else its
+address) gets a token bucket refilled at ADMISSION_RATE requests per second up to
+ADMISSION_BURST, a request that finds it empty is answered 429 with the seconds until the next
+token in Retry-After
+every route group gets at most its ADMISSION_CONCURRENCY requests in flight in this worker,
+a request over the cap waits up to ADMISSION_QUEUE_SECONDS (0 by default) and is then
+answered 503 with Retry-After, so a spike is shed at the door instead of queueing on the pool
+waiting would block the event loop of the ASGI mode, which therefore refuses a queue
+every sub-request of a /batch is admitted like a request of its own: it takes a token from the
+bucket of the batch's client and a place in the cap of its own route group
+shed requests are counted in /metrics. nothing is installed when neither limit is set
+    TRUSTED_PROXY_HOPS          the number of proxies in front of the app whose X-Forwarded-For
+                                is trusted for the client address, 0 (the socket peer) by default
+headers a client can set freely, an unverified token or X-API-Key, never pick its bucket
+'''
+
+# route groups by path prefix, the first match wins and other paths are in the default group
+ROUTE_GROUPS = (
+    ('orders', '/orders'),
+    ('products', '/products'),
+    ('export', '/export'),
+    ('batch', '/batch'),
+)
+DEFAULT_GROUP = 'default'
+
+# endpoints that are never limited, so the app can still be observed while it sheds load
+EXEMPT_ENDPOINTS = ('get_metrics', 'get_pool_metrics', 'static')
+
+# seconds a client is told to wait when a concurrency cap sheds its request
+SHED_RETRY_AFTER = 1
+
+
+'''
+LocalBucketStore
+    the token buckets of this worker, the least recently seen clients are dropped past max_clients
+    a shared backend (redis with a script doing the same arithmetic, ...) implements the same
+    take(key, rate, burst) so every worker draws from one bucket per client
+'''
+class LocalBucketStore:
+    def __init__(self, max_clients=100000):
+        self.max_clients = max_clients
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    take(key, rate, burst)
+        takes a token from the bucket of key, returns (True, 0) or (False, seconds until a token)
+    '''
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / rate
+
+
+def parse_caps(value):
+    caps = {}
+    for part in str(value or '').split(','):
+        if not part.strip():
+            continue
+        group, _, cap = part.partition('=')
+        caps[group.strip()] = int(cap)
+    return caps
+
+
+def route_group(path):
+    for group, prefix in ROUTE_GROUPS:
+        if path == prefix or path.startswith(prefix + '/'):
+            return group
+    return DEFAULT_GROUP
+
+
+def client_key():
+    parts = request.headers.get('Authorization', '').split()
+    if len(parts) == 2 and parts[0].lower() == 'bearer':
+        # only a token that already passed verification, checking one is too slow for the door
+        payload = verified_tokens.get(parts[1])
+        if payload is not None and payload.get('sub'):
+            return 'sub:' + hashlib.sha256(str(payload['sub']).encode('utf-8')).hexdigest()[:16]
+    # behind ProxyFix this is the address the last trusted proxy saw
+    return 'addr:' + (request.remote_addr or '')
+
+
+'''
+AdmissionControl
+    the buckets, the per group semaphores and the counts of shed requests of an app
+'''
+class AdmissionControl:
+    def __init__(self, rate=None, burst=None, caps=None, queue_seconds=0, buckets=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.queue_seconds = queue_seconds
+        self.buckets = buckets if buckets is not None else LocalBucketStore()
+        self.caps = dict(caps or {})
+        self.semaphores = {group: threading.BoundedSemaphore(cap) for group, cap in self.caps.items()}
+        self.in_flight = {group: 0 for group in self.caps}
+        self.shed = {}
+        self._lock = threading.Lock()
+
+    def count_shed(self, reason, group):
+        with self._lock:
+            self.shed[(reason, group)] = self.shed.get((reason, group), 0) + 1
+
+    '''
+    admit()
+        the before request check, returns the 429 or 503 response of a shed request
+    '''
+    def admit(self):
+        if request.endpoint in EXEMPT_ENDPOINTS:
+            return None
+        group = route_group(request.path)
+
+        if self.rate is not None:
+            if 'admission_client' not in g:
+                # sub-requests of a batch share its g, and are charged to the client of the batch
+                g.admission_client = client_key()
+            allowed, retry_after = self.buckets.take(g.admission_client, self.rate, self.burst)
+            if not allowed:
+                self.count_shed('rate_limited', group)
+                return self.shed_response(429, 'Too many requests', retry_after)
+
+        semaphore = self.semaphores.get(group, None)
+        if semaphore is not None:
+            if self.queue_seconds:
+                acquired = semaphore.acquire(timeout=self.queue_seconds)
+            else:
+                acquired = semaphore.acquire(blocking=False)
+            if not acquired:
+                self.count_shed('overloaded', group)
+                return self.shed_response(503, 'Service overloaded', SHED_RETRY_AFTER)
+            request.environ['admission.semaphore'] = group
+            with self._lock:
+                self.in_flight[group] += 1
+        return None
+
+    def release(self, error=None):
+        group = request.environ.pop('admission.semaphore', None)
+        if group is not None:
+            with self._lock:
+                self.in_flight[group] -= 1
+            self.semaphores[group].release()
+
+    def shed_response(self, status, message, retry_after):
+        response = jsonify({
+            'success': False,
+            'error': status,
+            'message': message
+        })
+        response.status_code = status
+        response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+        return response
+
+    def render(self):
+        with self._lock:
+            lines = ['# HELP http_requests_shed_total requests refused by admission control',
+                '# TYPE http_requests_shed_total counter']
+            for (reason, group), count in sorted(self.shed.items()):
+                lines.append(f'http_requests_shed_total{{reason="{reason}",group="{group}"}} {count}')
+            lines.append('# HELP http_requests_admitted_in_flight admitted requests of a capped group in flight')
+            lines.append('# TYPE http_requests_admitted_in_flight gauge')
+            for group, count in sorted(self.in_flight.items()):
+                lines.append(f'http_requests_admitted_in_flight{{group="{group}"}} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+'''
+init_admission(app)
+    installs admission control when ADMISSION_RATE or ADMISSION_CONCURRENCY is set
+    an ADMISSION_BUCKETS object in the app config replaces the per worker buckets
+    with TRUSTED_PROXY_HOPS set the app is wrapped in ProxyFix, so the client address is taken
+    from that many X-Forwarded-For entries and no further
+    raises ValueError for an ADMISSION_QUEUE_SECONDS on an app served by the ASGI mode
+    returns the app's AdmissionControl, or None when it is disabled
+'''
+def init_admission(app):
+    rate = setting(app.config, 'ADMISSION_RATE')
+    caps = parse_caps(setting(app.config, 'ADMISSION_CONCURRENCY'))
+    if rate is None and not caps:
+        return None
+
+    burst = setting(app.config, 'ADMISSION_BURST')
+    queue_seconds = float(setting(app.config, 'ADMISSION_QUEUE_SECONDS') or 0)
+    if queue_seconds and is_async_url(app.config['SQLALCHEMY_DATABASE_URI']):
+        # a waiting request would hold the event loop, and with it the requests that could release it
+        raise ValueError('ADMISSION_QUEUE_SECONDS must be 0 in the ASGI mode')
+    admission = AdmissionControl(
+        rate=None if rate is None else float(rate),
+        burst=None if burst is None else float(burst),
+        caps=caps,
+        queue_seconds=queue_seconds,
+        buckets=app.config.get('ADMISSION_BUCKETS', None))
+    hops = int(setting(app.config, 'TRUSTED_PROXY_HOPS') or 0)
+    if hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops)
+    app.extensions['admission'] = admission
+    app.before_request(admission.admit)
+    # teardown also runs after a streamed response has been sent
+    app.teardown_request(admission.release)
+    return admission
\ No newline at end of file
@@ -1,18 +1,385 @@
 
 from math import prod
+import csv
+import datetime
+import hashlib
+import io
+import json
 import os
+from functools import wraps
 from venv import create
-from flask import Flask, request, jsonify, abort, render_template
-from models import setup_db, Brand, ProductCategory, Product, Customer, Order, ProductReview
-from flask_cors import CORS
+from flask import Flask, Response, current_app, request, abort, make_response, render_template, stream_with_context
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.test import EnvironBuilder
+from models import MAX_PAGE_LIMIT, OutOfStock, setup_db, db, table_versions, Brand, ProductCategory, Product, Customer, Order, OrderItem, ProductReview
+from serializers import dumps, jsonify
+from pool import pool_status, statement_timeout
+from replicas import replica_read
+from metrics import PROMETHEUS_MIMETYPE, init_metrics
+from admission import init_admission
+from idempotency import idempotency_store, idempotent
 from auth import requires_auth
 
+ITEMS_PER_PAGE = 10
+BULK_CHUNK_SIZE = 1000
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/jsonl')
+# sub-requests a single POST /batch may carry
+MAX_BATCH_REQUESTS = 20
+BATCH_METHODS = ('GET', 'POST', 'PATCH', 'DELETE')
+# headers of the batch request passed on to its sub-requests
+BATCH_FORWARDED_HEADERS = ('Authorization',)
+
+# tables that can be streamed from /export/<table>
+EXPORT_TABLES = {
+    'products': Product,
+    'brands': Brand,
+    'product-categories': ProductCategory,
+    'product-reviews': ProductReview,
+    'customers': Customer,
+    'orders': Order,
+}
+
+
+'''
+@conditional(*models)
+    answers GET requests with a weak ETag and Last-Modified built from the version counters of the
+    tables the response is read from, and with 304 Not Modified when the client already has them
+    the versions and the body are read from the same replica, so a lagging one cannot pair an
+    old body with the validators of newer data
+'''
+def conditional(*models):
+    tables = sorted({model.__tablename__ for model in models})
+
+    def conditional_decorator(f):
+        @wraps(f)
+        @replica_read
+        def wrapper(*args, **kwargs):
+            versions = table_versions(tables)
+            state = ','.join(f'{table}:{versions.get(table, (0, None))[0]}' for table in tables)
+            etag = hashlib.sha1(f'{request.full_path}|{state}'.encode('utf-8')).hexdigest()
+            updated = [updated_at for _, updated_at in versions.values()]
+            last_modified = max(updated) if updated else None
+
+            if request.if_none_match:
+                not_modified = request.if_none_match.contains_weak(etag)
+            else:
+                # http dates have whole seconds, a write later in the second the client fetched in
+                # would carry the same date, so only an older second is known to be unchanged
+                not_modified = (last_modified is not None and request.if_modified_since is not None
+                    and last_modified.replace(microsecond=0) < request.if_modified_since.replace(tzinfo=None))
+
+            if not_modified:
+                response = Response(status=304)
+            else:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+
+'''
+fieldset_arg(model)
+    the Fieldset of ?fields=name,price_usd and ?expand=brand for a list of model rows,
+    None when neither is given so the rows are formatted in full
+    aborts with 400 for names the model does not have
+'''
+def fieldset_arg(model):
+    if 'fields' not in request.args and 'expand' not in request.args:
+        return None
+    fields = expand = None
+    if 'fields' in request.args:
+        fields = [name.strip() for name in request.args['fields'].split(',') if name.strip()]
+    if 'expand' in request.args:
+        expand = [name.strip() for name in request.args['expand'].split(',') if name.strip()]
+    try:
+        return model.fieldset(fields, expand)
+    except ValueError:
+        abort(400)
+
+
+'''
+paginate(model, criteria, fieldset)
+    loads one page of model rows matching criteria for the current request
+    ?page= keeps the old page numbering, otherwise ?cursor=, ?limit= and ?sort= select a keyset page
+    returns the rows and the pagination fields to merge into the response
+'''
+def paginate(model, criteria=(), fieldset=None):
+    limit = request.args.get('limit', ITEMS_PER_PAGE, type=int)
+    if limit < 1:
+        abort(400)
+
+    if 'page' in request.args:
+        page = request.args.get('page', 1, type=int)
+        return model.get_all(page, limit, criteria=criteria, fieldset=fieldset), {}
+
+    cursor = request.args.get('cursor', None)
+    sort_key = request.args.get('sort', 'id')
+    try:
+        rows, next_cursor = model.get_page(cursor=cursor, limit=limit, sort_key=sort_key, criteria=criteria,
+            fieldset=fieldset)
+    except ValueError:
+        abort(400)
+
+    return rows, {'next_cursor': next_cursor}
+
+
+'''
+count_rows(model, default, criteria)
+    the total row count for a list response
+    each endpoint picks its default mode, ?count=exact or ?count=estimated overrides it
+'''
+def count_rows(model, default='exact', criteria=()):
+    mode = request.args.get('count', default)
+    if mode not in ('exact', 'estimated'):
+        abort(400)
+    return model.count_total(mode, criteria=criteria)
+
+
+'''
+arg_or_none(name, type)
+    reads an optional query argument, aborting with 400 if it is present but cannot be converted
+'''
+def arg_or_none(name, type):
+    if name not in request.args:
+        return None
+    value = request.args.get(name, None, type=type)
+    if value is None:
+        abort(400)
+    return value
+
+
+'''
+ids_arg()
+    the ids of a ?ids=1,2,3 multi-get in the order given and without repeats, None without ?ids=
+'''
+def ids_arg():
+    if 'ids' not in request.args:
+        return None
+    try:
+        ids = [int(part) for part in request.args['ids'].split(',') if part.strip()]
+    except ValueError:
+        abort(400)
+    ids = list(dict.fromkeys(ids))
+    if not ids or len(ids) > MAX_PAGE_LIMIT:
+        abort(400)
+    return ids
+
+
+'''
+multi_get(model, key, ids, fieldset)
+    the formatted rows with the given ids from one IN query (or the model's cache), in the order requested
+'''
+def multi_get(model, key, ids, fieldset=None):
+    if fieldset is None:
+        rows = model.get_formatted(ids)
+    elif model.cache is None:
+        rows = {row.id: row.format(fieldset) for row in model.get_many(ids, fieldset)}
+    else:
+        # cached rows are already formatted in full
+        rows = {id: {name: row[name] for name in fieldset.fields} for id, row in model.get_formatted(ids).items()}
+    return jsonify({
+        'success': True,
+        key: [rows[id] for id in ids if id in rows],
+        'missing_ids': [id for id in ids if id not in rows]
+    })
+
+
+'''
+run_subrequest(item)
+    runs one {'method', 'path', 'body'} item of a batch through the app's routes, inside the
+    request context of the batch so every sub-request shares its database session
+    returns the status and the decoded body of the sub-request
+'''
+def run_subrequest(item):
+    bad_request = {'status': 400, 'body': {'success': False, 'error': 400, 'message': 'Bad request'}}
+    if not isinstance(item, dict):
+        return bad_request
+    method = str(item.get('method', 'GET')).upper()
+    path = item.get('path', None)
+    if method not in BATCH_METHODS or not isinstance(path, str) or not path.startswith('/'):
+        return bad_request
+    if path.split('?', 1)[0].rstrip('/') == '/batch':
+        return bad_request
+
+    headers = {name: request.headers[name] for name in BATCH_FORWARDED_HEADERS if name in request.headers}
+    environ = EnvironBuilder(path=path, method=method, json=item.get('body', None), headers=headers).get_environ()
+    app = current_app._get_current_object()
+    with app.request_context(environ):
+        try:
+            response = app.full_dispatch_request()
+        except Exception as error:
+            db.session.rollback()
+            response = app.make_response(app.handle_exception(error))
+
+    if response.is_streamed:
+        response.close()
+        return {'status': 400, 'body': {'success': False, 'error': 400,
+            'message': 'Streamed responses cannot be batched'}}
+    data = response.get_data()
+    return {
+        'status': response.status_code,
+        'body': json.loads(data) if response.is_json and data else data.decode('utf-8')
+    }
+
+
+'''
+export_value(value)
+    converts a column value into something csv can hold
+'''
+def export_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return value
+
+
+'''
+export_table(model)
+    streams every row of a table matching the request filters as ndjson, or csv with ?format=csv
+    ?after_id= resumes after a row, ?since= (iso timestamp) bounds tables with a timestamp column
+    any other argument that names one of the model's export_filters filters on that column
+'''
+def export_table(model):
+    output = request.args.get('format', 'ndjson')
+    if output not in ('ndjson', 'csv'):
+        abort(400)
+
+    after_id = arg_or_none('after_id', int)
+    since = request.args.get('since', None)
+    if since is not None:
+        try:
+            since = datetime.datetime.fromisoformat(since)
+        except ValueError:
+            abort(400)
+
+    filters = {}
+    for key, value in request.args.items():
+        if key in ('format', 'after_id', 'since'):
+            continue
+        if key not in model.export_filters:
+            abort(400)
+        # converted here, a value the column cannot hold would otherwise fail once the stream has begun
+        try:
+            filters[key] = model.__table__.c[key].type.python_type(value)
+        except ValueError:
+            abort(400)
+
+    if since is not None and model.since_column is None:
+        abort(400)
+
+    columns = [column.name for column in model.__table__.columns]
+    batches = model.stream_rows(filters=filters, after_id=after_id, since=since)
+
+    def generate_ndjson():
+        for batch in batches:
+            yield b''.join(dumps(dict(row)) + b'\n' for row in batch)
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+        for batch in batches:
+            writer.writerows([export_value(row[column]) for column in columns] for row in batch)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        # the header of an empty table
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    if output == 'csv':
+        return Response(stream_with_context(generate_csv()), mimetype='text/csv')
+    return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+
+
+'''
+read_bulk_rows()
+    yields the items of a bulk request body
+    an ndjson body is read from the stream one line at a time, anything else must be a json array
+    lines that are not valid json are yielded as the ValueError raised while parsing them
+'''
+def read_bulk_rows():
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in request.stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as error:
+                yield error
+        return
+
+    body = request.get_json()
+    if not isinstance(body, list):
+        abort(400)
+    yield from body
+
+
+'''
+bulk_load(model)
+    validates the rows of a bulk request and writes them in chunks of BULK_CHUNK_SIZE
+    ?upsert=true updates the rows whose natural key already exists
+    rows that fail are reported by their position in the body instead of failing the request
+'''
+def bulk_load(model):
+    upsert = request.args.get('upsert', 'false').lower() == 'true'
+    inserted = 0
+    updated = 0
+    errors = []
+    chunk = []
+
+    def write(chunk):
+        nonlocal inserted, updated
+        try:
+            chunk_inserted, chunk_updated, chunk_errors = model.bulk_write(chunk, upsert=upsert)
+        except SQLAlchemyError:
+            db.session.rollback()
+            errors.extend({'row': index, 'error': 'database error'} for index, _ in chunk)
+            return
+        inserted += chunk_inserted
+        updated += chunk_updated
+        errors.extend(chunk_errors)
+
+    for index, item in enumerate(read_bulk_rows()):
+        try:
+            if isinstance(item, ValueError):
+                raise ValueError('invalid json')
+            chunk.append((index, model.row_from_json(item)))
+        except ValueError as error:
+            errors.append({'row': index, 'error': str(error)})
+            continue
+        if len(chunk) >= BULK_CHUNK_SIZE:
+            write(chunk)
+            chunk = []
+    if chunk:
+        write(chunk)
+
+    return jsonify({
+        'success': True,
+        'inserted': inserted,
+        'updated': updated,
+        'errors': errors
+    })
+
 
 def create_app(test_config=None):
 
     app = Flask(__name__, static_folder='./static')
+    if test_config is not None:
+        app.config.update(test_config)
     setup_db(app)
+    # imported here so importing this module does not pay for it
+    from flask_cors import CORS
     CORS(app)
+    request_metrics = init_metrics(app)
+    admission = init_admission(app)
+    app.extensions['idempotency'] = idempotency_store(app.config)
 
     @app.route('/')
     def index():
@@ -29,24 +396,61 @@ def create_app(test_config=None):
 
     @app.route('/products')
     #@requires_auth('get:products')
+    @conditional(Product, Brand, ProductCategory)
     def get_products():
-        # get all products using pagination
-        page = request.args.get('page', 1, type=int)
-        items_per_page = 10
+        fieldset = fieldset_arg(Product)
+        ids = ids_arg()
+        if ids is not None:
+            return multi_get(Product, 'products', ids, fieldset)
+
+        # the index page uses -1 for all categories
+        category_id = arg_or_none('category_id', int)
+        if category_id == -1:
+            category_id = None
+
+        criteria = Product.filter_criteria(
+            category_id=category_id,
+            brand_id=arg_or_none('brand_id', int),
+            min_price=arg_or_none('min_price', float),
+            max_price=arg_or_none('max_price', float))
 
-        products = Product.get_all(page, items_per_page)
+        # get all products using pagination
+        products, pagination = paginate(Product, criteria, fieldset)
 
         # get count of all products
-        total_products = Product.count_total()
+        total_products = count_rows(Product, 'estimated', criteria)
 
         return jsonify({
             'success': True,
-            'products': [product.format() for product in products],
-            'total_products': total_products
+            'products': [product.format(fieldset) for product in products],
+            'total_products': total_products,
+            **pagination
         })
     
+    @app.route('/products/search')
+    #@requires_auth('get:products')
+    @conditional(Product, Brand, ProductCategory)
+    def search_products():
+        q = request.args.get('q', '').strip()
+        page = request.args.get('page', 1, type=int)
+        limit = request.args.get('limit', ITEMS_PER_PAGE, type=int)
+
+        if not q or page < 1 or limit < 1:
+            abort(400)
+
+        fieldset = fieldset_arg(Product)
+        products, has_more = Product.search(q, page, limit, fieldset)
+
+        return jsonify({
+            'success': True,
+            'products': [product.format(fieldset) for product in products],
+            'page': page,
+            'has_more': has_more
+        })
+
     @app.route('/products', methods=['POST'])
     #@requires_auth('post:products')
+    @idempotent
     def create_product():
         body = request.get_json()
 
@@ -55,11 +459,15 @@ def create_app(test_config=None):
         brand = body.get('brand', None)
         description = body.get('description', None)
         product_category_id = body.get('product_category_id', None)
+        stock = body.get('stock', None)
 
         if not name or not price or not brand:
             abort(400)
+        if stock is not None and (not isinstance(stock, int) or stock < 0):
+            abort(400)
 
-        product = Product(name=name, price=price, brand=brand, description=description, product_category=product_category_id)
+        product = Product(name=name, price=price, brand=brand, description=description, product_category=product_category_id,
+            stock=stock)
         Product.insert(product)
 
         return jsonify({
@@ -69,6 +477,11 @@ def create_app(test_config=None):
     
 
 
+    @app.route('/products/bulk', methods=['POST'])
+    #@requires_auth('post:products')
+    def bulk_create_products():
+        return bulk_load(Product)
+
     @app.route('/products/<int:product_id>', methods=['PATCH'])
     #@requires_auth('patch:products')
     def update_product(product_id):
@@ -82,12 +495,17 @@ def create_app(test_config=None):
         name = body.get('name', product.name)
         price = body.get('price', product.price)
         brand = body.get('brand', product.brand)
+        stock = body.get('stock', product.stock)
+
+        if stock is not None and (not isinstance(stock, int) or stock < 0):
+            abort(400)
 
         product.name = name
         product.price = price
         product.brand = brand
+        product.stock = stock
 
-        product.update()
+        Product.update(product)
 
         return jsonify({
             'success': True,
@@ -109,28 +527,49 @@ def create_app(test_config=None):
             'product_id': product_id
         })
     
+    @app.route('/products/<int:product_id>/sales')
+    #@requires_auth('get:orders')
+    @conditional(Product, Order, OrderItem)
+    def get_product_sales(product_id):
+        product = Product.get_one_or_none(product_id)
+
+        if product is None:
+            abort(404)
+
+        units_sold, revenue = OrderItem.sales(product_id)
+
+        return jsonify({
+            'success': True,
+            'product_id': product_id,
+            'units_sold': units_sold,
+            'revenue': revenue
+        })
+
     @app.route('/products/<int:product_id>/product-reviews', methods=['GET'])
     #@requires_auth('get:product-reviews')
-    def get_product_reviews():
-        product_id = request.args.get('product_id', None)
+    @conditional(Product, ProductReview)
+    def get_product_reviews(product_id):
         product = Product.get_one_or_none(product_id)
 
         if product is None:
             abort(404)
 
-        reviews = product.reviews
+        # a keyset page over the (product, id) index
+        fieldset = fieldset_arg(ProductReview)
+        reviews, pagination = paginate(ProductReview, [ProductReview.product == product_id], fieldset)
 
         return jsonify({
             'success': True,
-            'reviews': [review.format() for review in reviews]
+            'reviews': [review.format(fieldset) for review in reviews],
+            'review_count': product.review_count,
+            'rating_avg': product.rating_avg,
+            **pagination
         })
     
     @app.route('/products/<int:product_id>/product-reviews', methods=['POST'])
     #@requires_auth('post:product-reviews')
-    def create_product_review():
-        customer_id = request.args.get('customer_id', None)
-        product_id = request.args.get('product_id', None)
-
+    @idempotent
+    def create_product_review(product_id):
         product = Product.get_one_or_none(product_id)
 
         if product is None:
@@ -138,10 +577,11 @@ def create_app(test_config=None):
 
         body = request.get_json()
 
+        customer_id = body.get('customer_id', request.args.get('customer_id', None, type=int))
         rating = body.get('rating', None)
         review = body.get('review', None)
 
-        if not rating or not review:
+        if not rating or not review or not customer_id:
             abort(400)
 
         product_review = ProductReview(rating=rating, review=review, product_id=product_id, customer_id=customer_id)
@@ -156,19 +596,25 @@ def create_app(test_config=None):
 
     @app.route('/brands')
     #@requires_auth('get:brands')
+    @conditional(Brand)
     def get_brands():
-        page = request.args.get('page', 1, type=int)
-        items_per_page = 10
-        brands = Brand.get_all(page, items_per_page)
-        total_count = Brand.count_total()
+        fieldset = fieldset_arg(Brand)
+        ids = ids_arg()
+        if ids is not None:
+            return multi_get(Brand, 'brands', ids, fieldset)
+
+        brands, pagination = paginate(Brand, fieldset=fieldset)
+        total_count = count_rows(Brand)
         return jsonify({
             'success': True,
-            'brands': [brand.format() for brand in brands],
-            'total_brands': total_count
+            'brands': [brand.format(fieldset) for brand in brands],
+            'total_brands': total_count,
+            **pagination
         })
     
     @app.route('/brands', methods=['POST'])
     #@requires_auth('post:brands')
+    @idempotent
     def create_brand():
         body = request.get_json()
 
@@ -186,6 +632,11 @@ def create_app(test_config=None):
             'brand': brand.format()
         })
     
+    @app.route('/brands/bulk', methods=['POST'])
+    #@requires_auth('post:brands')
+    def bulk_create_brands():
+        return bulk_load(Brand)
+
     @app.route('/brands/<int:brand_id>', methods=['PATCH'])
     #@requires_auth('patch:brands')
     def update_brand(brand_id):
@@ -202,7 +653,7 @@ def create_app(test_config=None):
         brand.name = name
         brand.catchphrase = catchphrase
 
-        brand.update()
+        Brand.update(brand)
 
         return jsonify({
             'success': True,
@@ -226,19 +677,21 @@ def create_app(test_config=None):
     
     @app.route('/product-categories')
     #@requires_auth('get:product-categories')
+    @conditional(ProductCategory)
     def get_product_categories():
-        page = request.args.get('page', 1, type=int)
-        items_per_page = 10
-        categories = ProductCategory.get_all(page, items_per_page)
-        total_count = ProductCategory.count_total()
+        fieldset = fieldset_arg(ProductCategory)
+        categories, pagination = paginate(ProductCategory, fieldset=fieldset)
+        total_count = count_rows(ProductCategory)
         return jsonify({
             'success': True,
-            'product_categories': [category.format() for category in categories],
-            'total_product_categories': total_count
+            'product_categories': [category.format(fieldset) for category in categories],
+            'total_product_categories': total_count,
+            **pagination
         })
     
     @app.route('/product-categories', methods=['POST'])
     #@requires_auth('post:product-categories')
+    @idempotent
     def create_product_category():
         body = request.get_json()
 
@@ -297,19 +750,25 @@ def create_app(test_config=None):
     
     @app.route('/customers')
     #@requires_auth('get:customers')
+    @conditional(Customer)
     def get_customers():
-        page = request.args.get('page', 1, type=int)
-        items_per_page = 10
-        customers = Customer.get_all(page, items_per_page)
-        total_count = Customer.count_total()
+        fieldset = fieldset_arg(Customer)
+        ids = ids_arg()
+        if ids is not None:
+            return multi_get(Customer, 'customers', ids, fieldset)
+
+        customers, pagination = paginate(Customer, fieldset=fieldset)
+        total_count = count_rows(Customer)
         return jsonify({
             'success': True,
-            'customers': [customer.format() for customer in customers],
-            'total_customers': total_count
+            'customers': [customer.format(fieldset) for customer in customers],
+            'total_customers': total_count,
+            **pagination
         })
     
     @app.route('/customers', methods=['POST'])
     #@requires_auth('post:customers')
+    @idempotent
     def create_customer():
         body = request.get_json()
 
@@ -328,6 +787,11 @@ def create_app(test_config=None):
             'customer': customer.format()
         })
     
+    @app.route('/customers/bulk', methods=['POST'])
+    #@requires_auth('post:customers')
+    def bulk_create_customers():
+        return bulk_load(Customer)
+
     @app.route('/customers/<int:customer_id>', methods=['PATCH'])
     #@requires_auth('patch:customers')
     def update_customer(customer_id):
@@ -370,56 +834,82 @@ def create_app(test_config=None):
     
     @app.route('/orders')
     #@requires_auth('get:orders')
+    @conditional(Order, OrderItem, Product)
     def get_orders():
-        page = request.args.get('page', 1, type=int)
-        items_per_page = 10
-        orders = Order.get_all(page, items_per_page)
-        total_count = Order.count_total()
+        product_id = arg_or_none('product_id', int)
+        criteria = Order.containing_product(product_id) if product_id is not None else ()
+        fieldset = fieldset_arg(Order)
+        orders, pagination = paginate(Order, criteria, fieldset)
+        total_count = count_rows(Order, 'estimated', criteria)
         return jsonify({
             'success': True,
-            'orders': [order.format() for order in orders],
-            'total_orders': total_count
+            'orders': [order.format(fieldset) for order in orders],
+            'total_orders': total_count,
+            **pagination
         })
     
     @app.route('/orders/', methods=['POST'])
     #@requires_auth('post:orders')
+    @idempotent
     def create_order():
         body = request.get_json()
 
         customer_id = body.get('customer_id', None)
-        items_json = body.get('items', None)
-        cost = body.get('cost', None)
+        items = body.get('items', None)
 
-        if not customer_id or not items_json or not cost:
+        # the cost is worked out from the product prices, a cost sent by the client is ignored
+        if not customer_id or not items:
             abort(400)
 
-        order = Order(customer_id=customer_id, items_json=items_json, cost=cost)
-        Order.insert(order)
+        try:
+            order = Order.place(customer_id, items)
+        except OutOfStock as error:
+            return jsonify({
+                'success': False,
+                'error': 409,
+                'message': 'Out of stock',
+                'product_ids': error.product_ids
+            }), 409
+        except ValueError:
+            abort(400)
 
         return jsonify({
             'success': True,
-            'order': order.format()
+            'order': order
         })
     
     @app.route('/orders/<int:order_id>', methods=['PATCH'])
     #@requires_auth('patch:orders')
     def update_order(order_id):
-        order = Order.get_one_or_none(order_id)
+        # locked until the commit, so a concurrent change to its items waits for this one
+        order = Order.get_for_update(order_id)
 
         if order is None:
             abort(404)
 
         body = request.get_json()
 
-        customer_id = body.get('customer_id', order.customer_id)
-        items_json = body.get('items', order.items_json)
-        cost = body.get('cost', order.cost)
-
-        order.customer_id = customer_id
-        order.items_json = items_json
-        order.cost = cost
-
-        order.update()
+        customer_id = body.get('customer_id', order.customer)
+        items = body.get('items', None)
+
+        # the cost follows the items, a cost sent by the client is ignored
+        order.customer = customer_id
+        if items is not None:
+            try:
+                order.set_items(items)
+            except OutOfStock as error:
+                db.session.rollback()
+                return jsonify({
+                    'success': False,
+                    'error': 409,
+                    'message': 'Out of stock',
+                    'product_ids': error.product_ids
+                }), 409
+            except ValueError:
+                db.session.rollback()
+                abort(400)
+
+        Order.update(order)
 
         return jsonify({
             'success': True,
@@ -429,7 +919,7 @@ def create_app(test_config=None):
     @app.route('/orders/<int:order_id>', methods=['DELETE'])
     #@requires_auth('delete:orders')
     def delete_order(order_id):
-        order = Order.get_one_or_none(order_id)
+        order = Order.get_for_update(order_id)
 
         if order is None:
             abort(404)
@@ -441,6 +931,48 @@ def create_app(test_config=None):
             'order_id': order_id
         })
     
+    @app.route('/export/<table>')
+    #@requires_auth('get:export')
+    @statement_timeout(None)
+    def export(table):
+        model = EXPORT_TABLES.get(table, None)
+
+        if model is None:
+            abort(404)
+
+        return conditional(model)(export_table)(model)
+
+    @app.route('/batch', methods=['POST'])
+    def batch():
+        body = request.get_json()
+        items = body.get('requests', None) if isinstance(body, dict) else None
+
+        if not isinstance(items, list) or not items or len(items) > MAX_BATCH_REQUESTS:
+            abort(400)
+
+        return jsonify({
+            'success': True,
+            'responses': [run_subrequest(item) for item in items]
+        })
+
+    @app.route('/metrics/pool')
+    def get_pool_metrics():
+        status = pool_status(db.engine)
+        if 'replicas' in app.extensions:
+            status['replicas'] = app.extensions['replicas'].status()
+        return jsonify(status)
+
+    @app.route('/metrics')
+    def get_metrics():
+        if request_metrics is None and admission is None:
+            abort(404)
+        body = ''
+        if request_metrics is not None:
+            body += request_metrics.render(pool_status(db.engine))
+        if admission is not None:
+            body += admission.render()
+        return Response(body, mimetype=PROMETHEUS_MIMETYPE)
+
     @app.errorhandler(400)
     def bad_request(error):
         return jsonify({
@@ -488,7 +1020,20 @@ def create_app(test_config=None):
     return app
 
 
-app = create_app()
+'''
+app
+    the app built from the environment (gunicorn app:app), created on first access
+    so importing this module does no configuration or database work
+'''
+_app = None
+
+def __getattr__(name):
+    global _app
+    if name != 'app':
+        raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+    if _app is None:
+        _app = create_app()
+    return _app
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
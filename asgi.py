@@ -0,0 +1,205 @@
+import asyncio
+import io
+import sys
+from sqlalchemy.util import await_only, greenlet_spawn
+
+from app import create_app
+from models import database_url
+
+'''
+Async deployment mode
+
+    uvicorn asgi:app
+
+serves the same routes as create_app on an ASGI server, over SQLAlchemy's async drivers
+(asyncpg for postgres, aiosqlite for sqlite; pip install uvicorn asyncpg aiosqlite)
+every request runs the flask app inside a greenlet on the event loop, the way SQLAlchemy's own
+asyncio extension runs the ORM, so a request waiting on the database yields the loop to the
+others instead of holding a worker. the sync deployment (gunicorn app:app) is unchanged.
+'''
+
+# async driver for each database the app supports
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+
+'''
+async_database_url(url)
+    swaps the driver of a database url for its async counterpart
+'''
+def async_database_url(url):
+    scheme, separator, rest = url.partition('://')
+    backend = scheme.split('+', 1)[0]
+    if backend == 'postgres':
+        backend = 'postgresql'
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f'no async driver for {scheme} databases')
+    return ASYNC_DRIVERS[backend] + separator + rest
+
+
+'''
+ASGIInput
+    the wsgi.input of a request, read from the ASGI receive channel as the app consumes it
+    must only be read inside the request's greenlet
+'''
+class ASGIInput(io.RawIOBase):
+    def __init__(self, receive):
+        self.receive = receive
+        self.buffer = bytearray()
+        self.more_body = True
+
+    def readable(self):
+        return True
+
+    def _fill(self, size):
+        while self.more_body and (size < 0 or len(self.buffer) < size):
+            message = await_only(self.receive())
+            if message['type'] == 'http.disconnect':
+                self.more_body = False
+                break
+            self.buffer.extend(message.get('body', b''))
+            self.more_body = message.get('more_body', False)
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0 or size >= len(self.buffer):
+            data = bytes(self.buffer)
+            self.buffer.clear()
+        else:
+            data = bytes(self.buffer[:size])
+            del self.buffer[:size]
+        return data
+
+    def readinto(self, target):
+        data = self.read(len(target))
+        target[:len(data)] = data
+        return len(data)
+
+    def readline(self, size=-1):
+        while b'\n' not in self.buffer and self.more_body and (size < 0 or len(self.buffer) < size):
+            self._fill(len(self.buffer) + 1)
+        end = self.buffer.find(b'\n') + 1 or len(self.buffer)
+        if size >= 0:
+            end = min(end, size)
+        return self.read(end)
+
+
+'''
+build_environ(scope, receive)
+    the wsgi environ of an ASGI http request
+'''
+def build_environ(scope, receive):
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': client[0],
+        'REMOTE_PORT': str(client[1]),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': ASGIInput(receive),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': False,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            key = name
+        else:
+            key = f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    if 'CONTENT_LENGTH' not in environ:
+        # a chunked body ends when the client says so
+        environ['wsgi.input_terminated'] = True
+    return environ
+
+
+'''
+AsyncApp
+    an ASGI application running the flask app built by create_app against an async engine
+    the flask app is built on startup (or the first request) because creating the schema
+    already needs the event loop
+'''
+class AsyncApp:
+    def __init__(self, test_config=None):
+        self.config = dict(test_config or {})
+        self.flask_app = None
+        self._startup_lock = asyncio.Lock()
+
+    async def startup(self):
+        async with self._startup_lock:
+            if self.flask_app is None:
+                # the database url is read on startup, not when this module is imported
+                url = self.config.get('SQLALCHEMY_DATABASE_URI', None) or database_url()
+                config = dict(self.config, SQLALCHEMY_DATABASE_URI=async_database_url(url))
+                self.flask_app = await greenlet_spawn(create_app, config)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+        if self.flask_app is None:
+            await self.startup()
+        await greenlet_spawn(self.run_request, build_environ(scope, receive), send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.startup()
+                except Exception as error:
+                    await send({'type': 'lifespan.startup.failed', 'message': str(error)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def run_request(self, environ, send):
+        response_start = {}
+
+        def start_response(status, headers, exc_info=None):
+            response_start['status'] = int(status.split(' ', 1)[0])
+            response_start['headers'] = [
+                (name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]
+
+        def send_start():
+            await_only(send({
+                'type': 'http.response.start',
+                'status': response_start['status'],
+                'headers': response_start['headers']
+            }))
+
+        body = self.flask_app.wsgi_app(environ, start_response)
+        try:
+            started = False
+            for chunk in body:
+                if not chunk:
+                    continue
+                if not started:
+                    send_start()
+                    started = True
+                await_only(send({'type': 'http.response.body', 'body': chunk, 'more_body': True}))
+            if not started:
+                send_start()
+            await_only(send({'type': 'http.response.body', 'body': b'', 'more_body': False}))
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+
+app = AsyncApp()
\ No newline at end of file
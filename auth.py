@@ -1,13 +1,17 @@
+import hashlib
 import json
+import threading
+import time
+from collections import OrderedDict
 from flask import request
 from functools import wraps
-from jose import jwt
 from urllib.request import urlopen
 
 
 AUTH0_DOMAIN = 'dev-s3p6s2sf824za4jf.us.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'storefront'
+JWKS_URL = f'https://{AUTH0_DOMAIN}/.well-known/jwks.json'
 
 ## AuthError Exception
 '''
@@ -20,6 +24,136 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## JWKS and Token Caches
+'''
+JWKSCache
+    keeps the signing keys from a jwks.json document in memory keyed by kid
+    keys are refetched in a background thread once they are older than refresh_after,
+    and fetched inline only when they are older than ttl or on an unknown kid
+    unknown kids trigger at most one forced refetch per min_refetch_interval seconds
+    the url can be a file:// url for local testing
+'''
+class JWKSCache:
+    def __init__(self, url, ttl=3600, refresh_after=3000, min_refetch_interval=30):
+        self.url = url
+        self.ttl = ttl
+        self.refresh_after = refresh_after
+        self.min_refetch_interval = min_refetch_interval
+        self.keys = {}
+        self.fetched_at = None
+        self.last_forced_fetch = None
+        self._lock = threading.Lock()
+        self._refreshing = False
+
+    def fetch(self):
+        with urlopen(self.url) as response:
+            jwks = json.loads(response.read())
+        keys = {}
+        for key in jwks['keys']:
+            keys[key['kid']] = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+        with self._lock:
+            self.keys = keys
+            self.fetched_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def refresh():
+            try:
+                self.fetch()
+            except Exception:
+                # keep serving the keys we have, the next request will try again
+                pass
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def get_key(self, kid):
+        now = time.monotonic()
+        age = None if self.fetched_at is None else now - self.fetched_at
+        if age is None or age >= self.ttl:
+            self.fetch()
+        elif age >= self.refresh_after:
+            self._refresh_in_background()
+
+        key = self.keys.get(kid)
+        if key is not None:
+            return key
+
+        # the key set may have been rotated since the last fetch
+        with self._lock:
+            if self.last_forced_fetch is not None and now - self.last_forced_fetch < self.min_refetch_interval:
+                return None
+            self.last_forced_fetch = now
+        self.fetch()
+        return self.keys.get(kid)
+
+    def clear(self):
+        with self._lock:
+            self.keys = {}
+            self.fetched_at = None
+            self.last_forced_fetch = None
+
+
+'''
+VerifiedTokenCache
+    a bounded lru of tokens that already passed verification
+    each entry is dropped once the exp claim of its token has passed
+'''
+class VerifiedTokenCache:
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    def get(self, token):
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def put(self, token, payload):
+        expires_at = payload.get('exp')
+        if not isinstance(expires_at, (int, float)):
+            return
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+jwks_cache = JWKSCache(JWKS_URL)
+verified_tokens = VerifiedTokenCache()
+
+
 ## Auth Header
 
 '''
@@ -103,27 +237,21 @@ def check_permissions(permission, payload):
     !!NOTE urlopen has a common certificate error described here: https://stackoverflow.com/questions/50236117/scraping-ssl-certificate-verify-failed-error-for-http-en-wikipedia-org
 '''
 def verify_decode_jwt(token):
-    # verify the token using Auth0 /.well-known/jwks.json
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # tokens that were already verified skip the signature check until they expire
+    payload = verified_tokens.get(token)
+    if payload is not None:
+        return payload
+    # jose is only needed once a token has to be verified
+    from jose import jwt
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     # it should be an Auth0 token with key id (kid)
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
-    # it should verify the token using Auth0 /.well-known/jwks.json
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # it should verify the token using the cached Auth0 /.well-known/jwks.json keys
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
     # it should decode the payload from the token
     if rsa_key:
         try:
@@ -134,6 +262,7 @@ def verify_decode_jwt(token):
                 audience=API_AUDIENCE,
                 issuer=f'https://{AUTH0_DOMAIN}/'
             )
+            verified_tokens.put(token, payload)
             return payload
         # it should validate the claims
         except jwt.ExpiredSignatureError:
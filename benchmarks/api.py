@@ -0,0 +1,309 @@
+'''
+Storefront API benchmark
+
+    python benchmarks/api.py --sizes 10000,100000 --concurrency 16 --duration 5
+    python benchmarks/api.py --database postgresql://localhost/bench --sizes 1000000
+
+for every size, seeds a database with that many products and orders (and brands, categories,
+customers, line items and reviews in proportion), builds the app with create_app against it in
+a server process and drives each scenario from --concurrency clients for --duration seconds
+the scenarios cover the list, search, multi-get and export reads, the create, update, delete
+and bulk writes of products, brands, categories and customers, order and review writes and
+/batch; deleting orders and the metrics and html routes are left out
+the throughput and p50/p95/p99 latency of every scenario go to --output, so runs on two commits
+can be compared. without --database each size gets its own temporary sqlite file; a --database
+is dropped and recreated for every size, so point it at a database kept for benchmarking
+'''
+
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import time
+
+from common import ROOT, free_port, run_load, wait_for_server, write_results
+
+sys.path.insert(0, ROOT)
+
+BRANDS = 50
+CATEGORIES = 20
+SEED_BATCH_SIZE = 10000
+PAGE_SIZE = 20
+
+
+'''
+seed_database(database, size, deletable)
+    fills a fresh schema with size products and orders straight through the table inserts
+    the deletable products, brands, categories and customers after them are never referenced,
+    so the delete scenarios can remove them
+    returns the number of rows written per table
+'''
+def seed_database(database, size, deletable):
+    from app import create_app
+    from models import (db, create_schema, Brand, ProductCategory, Product, Customer, Order, OrderItem, ProductReview,
+        recompute_rating_aggregates)
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database, 'DB_SCHEMA': 'skip'})
+    generator = random.Random(size)
+    customers = max(1000, size // 10)
+    now = datetime.datetime.utcnow()
+
+    def insert(model, rows):
+        written = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= SEED_BATCH_SIZE:
+                db.session.execute(model.__table__.insert(), batch)
+                written += len(batch)
+                batch = []
+        if batch:
+            db.session.execute(model.__table__.insert(), batch)
+            written += len(batch)
+        db.session.commit()
+        return written
+
+    def order_items():
+        for order_id in range(1, size + 1):
+            for _ in range(generator.randint(1, 3)):
+                product_id = generator.randint(1, size)
+                yield {'order_id': order_id, 'product_id': product_id,
+                    'quantity': generator.randint(1, 4), 'unit_price': price(product_id)}
+
+    with app.app_context():
+        db.drop_all()
+        create_schema()
+        counts = {
+            'brands': insert(Brand, ({'name': f'brand {i}', 'catchphrase': f'catchphrase {i}'}
+                for i in range(BRANDS + deletable))),
+            'product_categories': insert(ProductCategory, ({'name': f'category {i}', 'description': f'category {i}'}
+                for i in range(CATEGORIES + deletable))),
+            'products': insert(Product, ({
+                'name': f'product {i}',
+                'price': price(i),
+                'brand': 1 + i % BRANDS,
+                'product_category': 1 + i % CATEGORIES,
+                'description': f'description of product {i}'
+            } for i in range(1, size + deletable + 1))),
+            'customers': insert(Customer, ({'name': f'customer {i}', 'email': f'customer{i}@example.com',
+                'address': f'{i} bench street'} for i in range(customers + deletable))),
+            'orders': insert(Order, ({
+                'customer': generator.randint(1, customers),
+                'items_json': '[]',
+                'cost': 0.0,
+                'datetime': now,
+                'status': 'pending'
+            } for _ in range(size))),
+            'order_items': insert(OrderItem, order_items()),
+            'product_reviews': insert(ProductReview, ({
+                'review': f'review {i}',
+                'rating': float(generator.randint(1, 5)),
+                'product': generator.randint(1, size),
+                'customer_id': generator.randint(1, customers)
+            } for i in range(size // 5))),
+        }
+        recompute_rating_aggregates()
+        db.session.remove()
+    return counts, customers
+
+
+def price(product_id):
+    return round(1 + (product_id * 7919) % 500 + 0.99, 2)
+
+
+'''
+serve(database, port)
+    the server process, builds the app with create_app and serves it on a threaded werkzeug server
+'''
+def serve(database, port):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    from app import create_app
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def setup(self):
+            super().setup()
+            # the headers and the body are written separately, do not let nagle hold the body back
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database})
+    make_server('127.0.0.1', port, app, threaded=True, request_handler=KeepAliveHandler).serve_forever()
+
+
+'''
+scenarios(size, customers)
+    the request generator of every scenario, reads first so the writes do not skew them
+    make_request(worker, iteration) returns the (method, path, body) of the next request
+'''
+def scenarios(size, customers):
+    from models import encode_cursor
+
+    def depth(worker, iteration):
+        # a different page of the whole table for every request
+        return (worker * 7919 + iteration * 104729) % size
+
+    def product_id(worker, iteration):
+        return 1 + depth(worker, iteration)
+
+    def get(path):
+        return lambda worker, iteration: ('GET', path(worker, iteration), None)
+
+    def ids(worker, iteration, count, limit):
+        # a comma separated run of count ids spread over 1..limit
+        first = depth(worker, iteration) % limit
+        return ','.join(str(1 + (first + offset * 97) % limit) for offset in range(count))
+
+    deleted = {
+        'products': itertools.count(size + 1),
+        'brands': itertools.count(BRANDS + 1),
+        'product-categories': itertools.count(CATEGORIES + 1),
+        'customers': itertools.count(customers + 1),
+    }
+    created = itertools.count()
+
+    def delete(resource):
+        return lambda worker, iteration: ('DELETE', f'/{resource}/{next(deleted[resource])}', None)
+
+    def new_product(iteration):
+        return {
+            'name': f'new product {next(created)}',
+            'price': 9.99,
+            'brand': 1 + iteration % BRANDS,
+            'product_category_id': 1 + iteration % CATEGORIES
+        }
+
+    def new_customer():
+        number = next(created)
+        return {'name': f'new customer {number}', 'email': f'new{number}@example.com', 'address': 'bench street'}
+
+    return {
+        'products_first_page': get(lambda w, i: f'/products?limit={PAGE_SIZE}'),
+        'products_deep_cursor': get(lambda w, i:
+            f"/products?limit={PAGE_SIZE}&cursor={encode_cursor('id', depth(w, i), depth(w, i))}"),
+        'products_deep_offset': get(lambda w, i: f'/products?limit={PAGE_SIZE}&page={1 + depth(w, i) // PAGE_SIZE}'),
+        'products_by_category_price': get(lambda w, i:
+            f'/products?limit={PAGE_SIZE}&category_id={1 + i % CATEGORIES}&sort=price'),
+        'products_search': get(lambda w, i: f'/products/search?q=product+{product_id(w, i)}'),
+        'product_reviews': get(lambda w, i: f'/products/{product_id(w, i)}/product-reviews?limit={PAGE_SIZE}'),
+        'product_sales': get(lambda w, i: f'/products/{product_id(w, i)}/sales'),
+        'brands': get(lambda w, i: f'/brands?limit={PAGE_SIZE}'),
+        'product_categories': get(lambda w, i: f'/product-categories?limit={PAGE_SIZE}'),
+        'customers_deep_cursor': get(lambda w, i:
+            f"/customers?limit={PAGE_SIZE}&cursor={encode_cursor('id', depth(w, i) % customers, depth(w, i) % customers)}"),
+        'orders_first_page': get(lambda w, i: f'/orders?limit={PAGE_SIZE}'),
+        'orders_deep_cursor': get(lambda w, i:
+            f"/orders?limit={PAGE_SIZE}&cursor={encode_cursor('id', depth(w, i), depth(w, i))}"),
+        'orders_containing_product': get(lambda w, i: f'/orders?limit={PAGE_SIZE}&product_id={product_id(w, i)}'),
+        'products_multi_get': get(lambda w, i: f'/products?ids={ids(w, i, PAGE_SIZE, size)}'),
+        'brands_multi_get': get(lambda w, i: f'/brands?ids={ids(w, i, 5, BRANDS)}'),
+        'customers_multi_get': get(lambda w, i: f'/customers?ids={ids(w, i, PAGE_SIZE, customers)}'),
+        'export_products': get(lambda w, i: f'/export/products?after_id={max(0, size - 1000)}'),
+        'export_orders_csv': get(lambda w, i: f'/export/orders?format=csv&after_id={max(0, size - 1000)}'),
+        'batch': lambda w, i: ('POST', '/batch', {'requests': [
+            {'method': 'GET', 'path': f'/products?limit={PAGE_SIZE}'},
+            {'method': 'GET', 'path': f'/brands?limit={PAGE_SIZE}'},
+            {'method': 'GET', 'path': f'/products/{product_id(w, i)}/product-reviews?limit={PAGE_SIZE}'},
+            {'method': 'PATCH', 'path': f'/products/{product_id(w, i)}', 'body': {'price': price(i)}},
+        ]}),
+        'create_product': lambda w, i: ('POST', '/products', new_product(i)),
+        'update_product': lambda w, i: ('PATCH', f'/products/{product_id(w, i)}', {'price': price(i)}),
+        'delete_product': delete('products'),
+        'bulk_products': lambda w, i: ('POST', '/products/bulk', [new_product(i) for _ in range(PAGE_SIZE)]),
+        'create_brand': lambda w, i: ('POST', '/brands', {'name': f'new brand {next(created)}'}),
+        'update_brand': lambda w, i: ('PATCH', f'/brands/{1 + i % BRANDS}', {'catchphrase': f'catchphrase {i}'}),
+        'delete_brand': delete('brands'),
+        'bulk_brands': lambda w, i: ('POST', '/brands/bulk',
+            [{'name': f'new brand {next(created)}'} for _ in range(PAGE_SIZE)]),
+        'create_product_category': lambda w, i: ('POST', '/product-categories', {
+            'name': f'new category {next(created)}',
+            'description': 'benchmark category'
+        }),
+        'update_product_category': lambda w, i: ('PATCH', f'/product-categories/{1 + i % CATEGORIES}',
+            {'description': f'description {i}'}),
+        'delete_product_category': delete('product-categories'),
+        'create_customer': lambda w, i: ('POST', '/customers', new_customer()),
+        'update_customer': lambda w, i: ('PATCH', f'/customers/{1 + depth(w, i) % customers}',
+            {'address': f'{i} bench street'}),
+        'delete_customer': delete('customers'),
+        'bulk_customers': lambda w, i: ('POST', '/customers/bulk', [new_customer() for _ in range(PAGE_SIZE)]),
+        'create_order': lambda w, i: ('POST', '/orders/', {
+            'customer_id': 1 + i % customers,
+            'items': [{'product_id': product_id(w, i), 'quantity': 1},
+                {'product_id': product_id(w, i + 1), 'quantity': 2}]
+        }),
+        'update_order': lambda w, i: ('PATCH', f'/orders/{product_id(w, i)}',
+            {'items': [{'product_id': product_id(w, i + 2), 'quantity': 1 + i % 3}]}),
+        'create_review': lambda w, i: ('POST', f'/products/{product_id(w, i)}/product-reviews', {
+            'customer_id': 1 + i % customers,
+            'rating': 1 + i % 5,
+            'review': 'benchmark review'
+        }),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help='database url, a temporary sqlite file per size by default')
+    parser.add_argument('--sizes', default='10000', help='comma separated product and order counts')
+    parser.add_argument('--deletable', type=int, default=20000, help='extra products the delete scenario removes')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=5, help='seconds per scenario')
+    parser.add_argument('--scenarios', help='comma separated scenario names, all by default')
+    parser.add_argument('--output', default='bench_api.json')
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    selected = set(args.scenarios.split(',')) if args.scenarios else None
+    runs = []
+    for size in sizes:
+        database = args.database
+        if database is None:
+            database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), f'bench_{size}.db')
+        started = time.perf_counter()
+        counts, customers = seed_database(database, size, args.deletable)
+        seed_seconds = time.perf_counter() - started
+        print(f'seeded {size} in {seed_seconds:.1f}s', json.dumps(counts), file=sys.stderr)
+
+        port = free_port()
+        server = multiprocessing.get_context('spawn').Process(target=serve, args=(database, port), daemon=True)
+        server.start()
+        try:
+            if not wait_for_server(port, lambda: server.exitcode, timeout=120):
+                raise RuntimeError(f'the server did not start listening on {port}')
+            results = {}
+            for name, make_request in scenarios(size, customers).items():
+                if selected is not None and name not in selected:
+                    continue
+                results[name] = run_load(f'http://127.0.0.1:{port}', make_request, args.concurrency, args.duration)
+                print(size, name, json.dumps(results[name]), file=sys.stderr)
+        finally:
+            server.terminate()
+            server.join(10)
+
+        runs.append({
+            'size': size,
+            'rows': counts,
+            'seed_seconds': round(seed_seconds, 1),
+            'scenarios': results
+        })
+
+    write_results(args.output, {
+        'database': (args.database or 'sqlite://').split('://', 1)[0],
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'runs': runs
+    })
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
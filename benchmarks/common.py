@@ -0,0 +1,170 @@
+import http.client
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+'''
+percentile(values, fraction)
+    the value below which the given fraction of the sorted values fall
+'''
+def percentile(values, fraction):
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * (len(values) - 1)))))
+    return values[index]
+
+
+'''
+summarize(latencies, errors, elapsed)
+    throughput and latency percentiles (in milliseconds) of one load run
+'''
+def summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+    }
+
+
+'''
+request(connection, method, path, body, headers)
+    sends one request on a kept alive connection and returns its status and body
+'''
+def request(connection, method, path, body=None, headers=None):
+    headers = dict(headers or {})
+    if body is not None and not isinstance(body, bytes):
+        body = json.dumps(body).encode('utf-8')
+        headers.setdefault('Content-Type', 'application/json')
+    connection.request(method, path, body=body, headers=headers)
+    response = connection.getresponse()
+    return response.status, response.read()
+
+
+'''
+run_load(base_url, make_request, concurrency, duration)
+    drives the server from concurrency client threads for duration seconds
+    make_request(worker, iteration) returns the (method, path, body) of the next request
+'''
+def run_load(base_url, make_request, concurrency=16, duration=10):
+    url = urlsplit(base_url)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker(number):
+        connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+        local = []
+        failed = 0
+        iteration = 0
+        while time.perf_counter() < deadline:
+            method, path, body = make_request(number, iteration)
+            iteration += 1
+            started = time.perf_counter()
+            try:
+                status, _ = request(connection, method, path, body)
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection(url.hostname, url.port, timeout=30)
+                failed += 1
+                continue
+            if status >= 400:
+                failed += 1
+            else:
+                local.append(time.perf_counter() - started)
+        connection.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(number,)) for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return summarize(latencies, errors[0], time.perf_counter() - started)
+
+
+'''
+free_port()
+    a tcp port nothing is listening on
+'''
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+'''
+wait_for_server(port, exited, timeout)
+    polls until a server answers on port, exited() returns an exit code once the server died
+    returns True when the server answered in time
+'''
+def wait_for_server(port, exited, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        code = exited()
+        if code is not None:
+            raise RuntimeError(f'server exited with {code}')
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=2)
+            request(connection, 'GET', '/brands?limit=1')
+            connection.close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+'''
+start_server(command, port, env)
+    starts a server process from the repository root and waits until it answers on port
+'''
+def start_server(command, port, env=None, timeout=30):
+    process = subprocess.Popen(command, cwd=ROOT, env={**os.environ, **(env or {})},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if wait_for_server(port, process.poll, timeout):
+        return process
+    process.terminate()
+    raise RuntimeError(f'{command[0]} did not start listening on {port}')
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+'''
+write_results(path, results)
+    writes the results with the commit they were measured on, so runs can be compared
+'''
+def write_results(path, results):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    document = {
+        'commit': commit,
+        'python': sys.version.split()[0],
+        'measured_at': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'results': results,
+    }
+    with open(path, 'w') as output:
+        json.dump(document, output, indent=2)
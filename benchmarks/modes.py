@@ -0,0 +1,109 @@
+'''
+Sync vs async deployment benchmark
+
+    python benchmarks/modes.py --products 10000 --concurrency 64 --duration 15
+
+seeds one database, then serves it with gunicorn (sync workers, app:app) and with uvicorn
+(asgi:app) in turn, each with --workers processes, drives both with the same request mix and
+writes the throughput and latency percentiles of each mode to --output
+'''
+
+import argparse
+import http.client
+import json
+import os
+import sys
+import tempfile
+
+from common import free_port, request, run_load, start_server, stop_server, write_results
+
+
+def seed(port, products, customers):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+    request(connection, 'POST', '/brands/bulk', [{'name': f'brand {i}'} for i in range(20)])
+    for i in range(10):
+        request(connection, 'POST', '/product-categories', {'name': f'category {i}'})
+    rows = (json.dumps({
+        'name': f'product {i}',
+        'price': round(1 + (i * 7919) % 500 + 0.99, 2),
+        'brand': 1 + i % 20,
+        'product_category_id': 1 + i % 10,
+        'description': f'description of product {i}'
+    }) for i in range(products))
+    request(connection, 'POST', '/products/bulk', '\n'.join(rows).encode('utf-8'),
+        {'Content-Type': 'application/x-ndjson'})
+    request(connection, 'POST', '/customers/bulk',
+        [{'name': f'customer {i}', 'email': f'customer{i}@example.com'} for i in range(customers)])
+    connection.close()
+
+
+def request_mix(products, customers, writes):
+    def make_request(worker, iteration):
+        step = worker * 7919 + iteration
+        if writes and step % 5 == 0:
+            return 'POST', '/orders/', {
+                'customer_id': 1 + step % customers,
+                'items': [{'product_id': 1 + step % products, 'quantity': 1}],
+                'cost': 1
+            }
+        pages = (
+            '/products?limit=20',
+            f'/products?limit=20&category_id={1 + step % 10}&sort=price',
+            '/brands?limit=20',
+            '/orders?limit=20',
+            f'/products/search?q=product+{step % products}',
+        )
+        return 'GET', pages[step % len(pages)], None
+    return make_request
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--database', help='database url, a temporary sqlite file by default')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--customers', type=int, default=1000)
+    parser.add_argument('--workers', type=int, default=4, help='worker processes of each mode')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--writes', action='store_true', help='mix order creation into the load')
+    parser.add_argument('--output', default='bench_output.json')
+    args = parser.parse_args()
+
+    database = args.database
+    if database is None:
+        database = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db')
+    env = {'DATABASE_URL': database, 'DB_SCHEMA': 'create'}
+
+    modes = {
+        'sync': lambda port: ['gunicorn', '-w', str(args.workers), '-b', f'127.0.0.1:{port}', 'app:app'],
+        'async': lambda port: ['uvicorn', 'asgi:app', '--port', str(port), '--workers', str(args.workers),
+            '--log-level', 'warning'],
+    }
+
+    results = {}
+    seeded = False
+    for mode, command in modes.items():
+        port = free_port()
+        server = start_server(command(port), port, env)
+        try:
+            if not seeded:
+                seed(port, args.products, args.customers)
+                seeded = True
+            make_request = request_mix(args.products, args.customers, args.writes)
+            results[mode] = run_load(f'http://127.0.0.1:{port}', make_request, args.concurrency, args.duration)
+        finally:
+            stop_server(server)
+        print(mode, json.dumps(results[mode]), file=sys.stderr)
+
+    write_results(args.output, {
+        'database': database.split('://', 1)[0],
+        'products': args.products,
+        'concurrency': args.concurrency,
+        'workers': args.workers,
+        'writes': args.writes,
+        'modes': results
+    })
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,104 @@
+'''
+Order placement contention benchmark
+
+    python benchmarks/orders.py --concurrency 1,16,64,256 --duration 10
+    python benchmarks/orders.py --database postgresql://localhost/bench --stock 5000
+
+every client orders the same hot product, so each order decrements the same stock row
+runs once per --concurrency level against a server built with create_app and writes the
+throughput and latency of each level to --output, with a check that the stock left matches the
+units sold (409 out of stock answers count as errors once the stock runs out)
+the --database is dropped and recreated, so point it at a database kept for benchmarking
+'''
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+
+from common import free_port, run_load, wait_for_server, write_results
+from api import serve
+
+HOT_PRODUCT = 1
+CUSTOMERS = 100
+
+
+def seed(database, stock):
+    from app import create_app
+    from models import db, create_schema, Brand, Product, Customer
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database, 'DB_SCHEMA': 'skip'})
+    with app.app_context():
+        db.drop_all()
+        create_schema()
+        db.session.execute(Brand.__table__.insert(), [{'name': 'brand'}])
+        db.session.execute(Product.__table__.insert(), [
+            {'name': f'product {i}', 'price': 9.99, 'brand': 1, 'stock': stock if i == HOT_PRODUCT else None}
+            for i in range(1, 11)])
+        db.session.execute(Customer.__table__.insert(),
+            [{'name': f'customer {i}', 'email': f'customer{i}@example.com'} for i in range(CUSTOMERS)])
+        db.session.commit()
+        db.session.remove()
+
+
+def stock_check(database, stock):
+    from app import create_app
+    from models import db, Product, OrderItem
+
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database, 'DB_SCHEMA': 'skip'})
+    with app.app_context():
+        left = db.session.query(Product.stock).filter(Product.id == HOT_PRODUCT).scalar()
+        sold = db.session.query(db.func.coalesce(db.func.sum(OrderItem.quantity), 0)) \
+            .filter(OrderItem.product_id == HOT_PRODUCT).scalar()
+        db.session.remove()
+    return {'stock_left': left, 'units_sold': sold, 'consistent': left == stock - sold and left >= 0}
+
+
+def order_hot_product(worker, iteration):
+    return 'POST', '/orders/', {
+        'customer_id': 1 + (worker + iteration) % CUSTOMERS,
+        'items': [{'product_id': HOT_PRODUCT, 'quantity': 1}, {'product_id': 2 + iteration % 9, 'quantity': 1}]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help='database url, a temporary sqlite file by default')
+    parser.add_argument('--concurrency', default='1,16,64,256', help='comma separated client counts')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per concurrency level')
+    parser.add_argument('--stock', type=int, default=10 ** 9, help='initial stock of the hot product')
+    parser.add_argument('--output', default='bench_orders.json')
+    args = parser.parse_args()
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'orders.db')
+    seed(database, args.stock)
+
+    port = free_port()
+    server = multiprocessing.get_context('spawn').Process(target=serve, args=(database, port), daemon=True)
+    server.start()
+    levels = {}
+    try:
+        if not wait_for_server(port, lambda: server.exitcode, timeout=60):
+            raise RuntimeError(f'the server did not start listening on {port}')
+        for concurrency in (int(level) for level in args.concurrency.split(',')):
+            levels[concurrency] = run_load(f'http://127.0.0.1:{port}', order_hot_product, concurrency, args.duration)
+            print(concurrency, json.dumps(levels[concurrency]), file=sys.stderr)
+    finally:
+        server.terminate()
+        server.join(10)
+
+    check = stock_check(database, args.stock)
+    print(json.dumps(check), file=sys.stderr)
+    write_results(args.output, {
+        'database': database.split('://', 1)[0],
+        'stock': args.stock,
+        'duration': args.duration,
+        'levels': levels,
+        'stock_check': check
+    })
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,76 @@
+'''
+Cold start benchmark
+
+    python benchmarks/startup.py --repeat 10
+
+measures, each in a fresh interpreter, how long importing app takes, how long create_app takes
+with every DB_SCHEMA mode and how long the first request then takes, and writes the median and
+worst of each to --output
+'''
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from common import ROOT, write_results
+
+PROBE = '''
+import json, sys, time
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+flask_app = app.create_app({'DB_SCHEMA': sys.argv[1]})
+created = time.perf_counter()
+flask_app.test_client().get('/brands?limit=1')
+served = time.perf_counter()
+print(json.dumps({
+    'import': imported - started,
+    'create_app': created - imported,
+    'first_request': served - created,
+    'modules': len(sys.modules),
+}))
+'''
+
+
+def probe(database, schema):
+    output = subprocess.check_output([sys.executable, '-c', PROBE, schema], cwd=ROOT, text=True,
+        env={**os.environ, 'DATABASE_URL': database})
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', help='database url, a temporary sqlite file by default')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default='bench_startup.json')
+    args = parser.parse_args()
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'startup.db')
+    # the first run creates the schema the check mode expects
+    probe(database, 'create')
+
+    results = {}
+    for schema in ('check', 'create', 'skip'):
+        runs = [probe(database, schema) for _ in range(args.repeat)]
+        results[schema] = {
+            phase: {
+                'median_ms': round(statistics.median(run[phase] for run in runs) * 1000, 2),
+                'max_ms': round(max(run[phase] for run in runs) * 1000, 2),
+            } for phase in ('import', 'create_app', 'first_request')
+        }
+        results[schema]['modules'] = runs[-1]['modules']
+        print(schema, json.dumps(results[schema]), file=sys.stderr)
+
+    write_results(args.output, {
+        'database': database.split('://', 1)[0],
+        'repeat': args.repeat,
+        'schema_modes': results
+    })
+
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+LocalInvalidationChannel
+    an in-process stand-in for a cross-worker invalidation channel
+    a shared backend (redis pub/sub, postgres LISTEN/NOTIFY, ...) implements the same
+    publish(name, keys) and subscribe(callback) methods and delivers to every worker
+'''
+class LocalInvalidationChannel:
+    def __init__(self):
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def publish(self, name, keys):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            callback(name, keys)
+
+
+invalidation_channel = LocalInvalidationChannel()
+
+
+'''
+ReadThroughCache
+    a bounded lru of values keyed by id, each entry expires ttl seconds after it was loaded
+    misses are loaded in one batch through the loader passed to get_many
+    invalidations are published on the channel so every worker drops the same keys
+    get_many can also be given the version of the table the values come from, an entry loaded
+    at another version is then loaded again, so a worker the channel does not reach never serves
+    values older than the version the response is labelled with
+'''
+class ReadThroughCache:
+    def __init__(self, name, maxsize=1024, ttl=300, channel=invalidation_channel):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.channel = channel
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if channel is not None:
+            channel.subscribe(self._on_invalidate)
+
+    def get_many(self, keys, loader, version=None):
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and entry[1] > now and (version is None or entry[2] == version):
+                    self._entries.move_to_end(key)
+                    found[key] = entry[0]
+                    self.hits += 1
+                else:
+                    missing.append(key)
+                    self.misses += 1
+
+        if missing:
+            loaded = loader(missing)
+            expires_at = time.monotonic() + self.ttl
+            with self._lock:
+                for key, value in loaded.items():
+                    self._entries[key] = (value, expires_at, version)
+                    self._entries.move_to_end(key)
+                while len(self._entries) > self.maxsize:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+            found.update(loaded)
+        return found
+
+    def get(self, key, loader, version=None):
+        return self.get_many([key], loader, version).get(key)
+
+    def invalidate(self, keys=None):
+        if self.channel is None:
+            self._drop(keys)
+        else:
+            self.channel.publish(self.name, None if keys is None else list(keys))
+
+    def _on_invalidate(self, name, keys):
+        if name == self.name:
+            self._drop(keys)
+
+    def _drop(self, keys):
+        with self._lock:
+            if keys is None:
+                self._entries.clear()
+                return
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
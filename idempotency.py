@@ -0,0 +1,264 @@
+import datetime
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import Response, current_app, make_response, request
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError
+
+from models import db, IdempotencyKey
+from pool import setting
+from serializers import jsonify
+
+'''
+Idempotency keys
+
+    POST /orders/
+    Idempotency-Key: 6f1c0c6e-8a55-4d8e-9d0b-3f1f0f3c2a91
+
+a create request sent with an Idempotency-Key runs once, retries with the same key get the
+stored response back (with Idempotent-Replayed: true) without running the write again
+    IDEMPOTENCY_STORE           database (the IdempotencyKeys table, shared by every worker)
+                                or memory (per process, for development and tests)
+    IDEMPOTENCY_TTL             seconds a stored response is kept, one day by default
+    IDEMPOTENCY_LOCK_SECONDS    seconds a request holds its key before another one may take over
+a retry while the first request still runs gets 409, reusing a key for a different request 422
+'''
+
+DEFAULT_TTL = 24 * 60 * 60
+DEFAULT_LOCK_SECONDS = 60
+MAX_KEY_LENGTH = 255
+
+# what begin() answers besides a stored response
+NEW = 'new'
+IN_FLIGHT = 'in_flight'
+MISMATCH = 'mismatch'
+
+
+'''
+StoredResponse
+    the status, content type and body of a completed request
+'''
+class StoredResponse:
+    __slots__ = ('status', 'content_type', 'body')
+
+    def __init__(self, status, content_type, body):
+        self.status = status
+        self.content_type = content_type
+        self.body = body
+
+
+'''
+MemoryIdempotencyStore
+    an in-process stand-in for the database store, with the same begin, complete and release
+    a shared backend (redis, memcached, ...) implements the same three methods
+    keys are kept in the order they were claimed, which is the order they expire in as they all
+    get the same ttl, so purging stops at the first live key instead of scanning them all
+'''
+class MemoryIdempotencyStore:
+    def __init__(self, ttl=DEFAULT_TTL, lock_seconds=DEFAULT_LOCK_SECONDS):
+        self.ttl = ttl
+        self.lock_seconds = lock_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    begin(key, fingerprint)
+        claims key for a request, returns NEW when the caller should run it,
+        IN_FLIGHT or MISMATCH when it must not, or the StoredResponse of the completed request
+    '''
+    def begin(self, key, fingerprint):
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['expires_at'] <= now:
+                entry = None
+            if entry is not None:
+                if entry['fingerprint'] != fingerprint:
+                    return MISMATCH
+                if entry['response'] is not None:
+                    return entry['response']
+                if entry['locked_until'] > now:
+                    return IN_FLIGHT
+            self._entries[key] = {
+                'fingerprint': fingerprint,
+                'response': None,
+                'locked_until': now + datetime.timedelta(seconds=self.lock_seconds),
+                'expires_at': now + datetime.timedelta(seconds=self.ttl),
+            }
+            self._entries.move_to_end(key)
+            self._purge(now)
+            return NEW
+
+    def complete(self, key, response):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry['response'] = response
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry['response'] is None:
+                del self._entries[key]
+
+    def _purge(self, now):
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry['expires_at'] > now:
+                break
+            del self._entries[key]
+
+
+'''
+DatabaseIdempotencyStore
+    keeps keys in the IdempotencyKeys table, each step in its own short transaction so a claim
+    is visible to every worker at once; the primary key makes claiming a key atomic
+'''
+class DatabaseIdempotencyStore:
+    def __init__(self, ttl=DEFAULT_TTL, lock_seconds=DEFAULT_LOCK_SECONDS):
+        self.ttl = ttl
+        self.lock_seconds = lock_seconds
+
+    def begin(self, key, fingerprint):
+        keys = IdempotencyKey.__table__
+        now = datetime.datetime.utcnow()
+        claim = {
+            'fingerprint': fingerprint,
+            'status': None,
+            'content_type': None,
+            'body': None,
+            'locked_until': now + datetime.timedelta(seconds=self.lock_seconds),
+            'expires_at': now + datetime.timedelta(seconds=self.ttl),
+        }
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(keys.insert().values(key=key, **claim))
+            return NEW
+        except IntegrityError:
+            pass
+
+        with db.engine.begin() as connection:
+            row = connection.execute(keys.select().where(keys.c.key == key)).first()
+            if row is None:
+                # expired and purged in between, the retry claims it
+                return self.begin(key, fingerprint)
+            expired = row.expires_at <= now
+            if not expired and row.fingerprint != fingerprint:
+                return MISMATCH
+            if not expired and row.status is not None:
+                return StoredResponse(row.status, row.content_type, row.body)
+            if not expired and row.locked_until > now:
+                return IN_FLIGHT
+            # an expired key, or one whose request died without releasing it, is taken over
+            # only if nobody else took it over first
+            taken = connection.execute(keys.update().where(and_(
+                keys.c.key == key,
+                or_(keys.c.expires_at <= now, and_(keys.c.status.is_(None), keys.c.locked_until <= now)))
+            ).values(claim)).rowcount
+        return NEW if taken else IN_FLIGHT
+
+    def complete(self, key, response):
+        keys = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(keys.update().where(keys.c.key == key).values(
+                status=response.status, content_type=response.content_type, body=response.body))
+
+    def release(self, key):
+        keys = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            connection.execute(keys.delete().where(and_(keys.c.key == key, keys.c.status.is_(None))))
+
+    '''
+    purge_expired()
+        deletes the keys past their ttl, returns how many
+    '''
+    def purge_expired(self):
+        keys = IdempotencyKey.__table__
+        with db.engine.begin() as connection:
+            return connection.execute(keys.delete().where(keys.c.expires_at <= datetime.datetime.utcnow())).rowcount
+
+
+STORES = {
+    'database': DatabaseIdempotencyStore,
+    'memory': MemoryIdempotencyStore,
+}
+
+
+'''
+idempotency_store(config)
+    the store configured by IDEMPOTENCY_STORE, IDEMPOTENCY_TTL and IDEMPOTENCY_LOCK_SECONDS
+'''
+def idempotency_store(config):
+    name = setting(config, 'IDEMPOTENCY_STORE') or 'database'
+    if name not in STORES:
+        raise ValueError(f'IDEMPOTENCY_STORE must be one of {", ".join(STORES)}, not {name}')
+    return STORES[name](
+        ttl=int(setting(config, 'IDEMPOTENCY_TTL') or DEFAULT_TTL),
+        lock_seconds=int(setting(config, 'IDEMPOTENCY_LOCK_SECONDS') or DEFAULT_LOCK_SECONDS))
+
+
+def scoped_key(key):
+    # the same key sent by two clients, or to two routes, names two different requests
+    client = hashlib.sha256(request.headers.get('Authorization', '').encode('utf-8')).hexdigest()[:16]
+    return f'{client}:{request.method}:{request.path}:{key}'
+
+
+'''
+@idempotent
+    runs a create route at most once per Idempotency-Key header, see the top of this module
+    successful and client error responses are stored, server errors and 409/429 answers are not
+    so the request can be retried
+'''
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key', None)
+        if key is None:
+            return f(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            return jsonify({
+                'success': False,
+                'error': 400,
+                'message': 'Invalid Idempotency-Key'
+            }), 400
+
+        store = current_app.extensions['idempotency']
+        key = scoped_key(key)
+        # the query string is part of the request, routes read arguments from it too
+        fingerprint = hashlib.sha256(
+            request.full_path.encode('utf-8') + b'\n' + request.get_data(cache=True)).hexdigest()
+        state = store.begin(key, fingerprint)
+        if state == IN_FLIGHT:
+            response = jsonify({
+                'success': False,
+                'error': 409,
+                'message': 'A request with this Idempotency-Key is in progress'
+            })
+            response.status_code = 409
+            response.headers['Retry-After'] = '1'
+            return response
+        if state == MISMATCH:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'Idempotency-Key was used for a different request'
+            }), 422
+        if isinstance(state, StoredResponse):
+            response = Response(state.body, status=state.status, content_type=state.content_type)
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(*args, **kwargs))
+        except BaseException:
+            store.release(key)
+            raise
+        if response.status_code >= 500 or response.status_code in (409, 429) or response.is_streamed:
+            store.release(key)
+        else:
+            store.complete(key, StoredResponse(response.status_code, response.content_type, response.get_data()))
+        return response
+
+    return wrapper
\ No newline at end of file
@@ -0,0 +1,471 @@
+import contextlib
+import csv
+import datetime
+import io
+import json
+import os
+import random
+import time
+from sqlalchemy import func, select, text
+from sqlalchemy.exc import DBAPIError
+
+from models import (db, bump_table_versions, install_product_search, Brand, ProductCategory, Product, Customer,
+    Order, OrderItem)
+
+'''
+Offline catalog loader
+
+    python manage.py load --directory data/
+    python manage.py load --generate 100000
+
+reads brands, product_categories, products, customers and orders from <table>.csv or
+<table>.ndjson files in a directory, or generates a synthetic catalog of a given size, and
+writes them straight to the database: COPY on postgres, executemany elsewhere
+ids are assigned in memory, so brand, category, customer and product references can be given
+by id or by name (email for customers) and are resolved without a query per row
+rows whose natural key already exists, or that reference something that does not, are skipped
+and reported. the secondary indexes of a table that is empty before the load are dropped
+and rebuilt once at the end, and on postgres foreign key triggers are skipped when the
+role is allowed to, since every reference has already been checked
+'''
+
+LOAD_ORDER = ('brands', 'product_categories', 'products', 'customers', 'orders')
+LOAD_BATCH_SIZE = 10000
+# rejected rows printed per table
+MAX_REPORTED_ERRORS = 10
+
+
+'''
+read_rows(path)
+    yields the rows of a csv file as dicts, or of an ndjson file as the parsed objects
+    lines that are not valid json are yielded as the ValueError raised while parsing them,
+    so one bad line is rejected like any other invalid row instead of ending the load
+'''
+def read_rows(path):
+    if path.endswith('.csv'):
+        with open(path, newline='', encoding='utf-8') as source:
+            yield from csv.DictReader(source)
+        return
+    with open(path, encoding='utf-8') as source:
+        for line in source:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as error:
+                yield error
+
+
+'''
+table_files(directory)
+    the input file of each table found in directory
+'''
+def table_files(directory):
+    files = {}
+    for table in LOAD_ORDER:
+        for extension in ('.csv', '.ndjson', '.jsonl'):
+            path = os.path.join(directory, table + extension)
+            if os.path.exists(path):
+                files[table] = path
+                break
+    return files
+
+
+def blank(value):
+    return value is None or value == ''
+
+
+def as_float(value, name):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be a number')
+
+
+def as_int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{name} must be an integer')
+
+
+'''
+CatalogLoader(connection)
+    loads tables through one connection, keeping the ids of the rows it can reference in memory
+'''
+class CatalogLoader:
+    def __init__(self, connection, batch_size=LOAD_BATCH_SIZE):
+        self.connection = connection
+        self.dialect = connection.dialect.name
+        self.batch_size = batch_size
+        self.brands = self.names(Brand, 'name')
+        self.categories = self.names(ProductCategory, 'name')
+        self.customers = self.names(Customer, 'email')
+        self.brand_ids = set(self.brands.values())
+        self.category_ids = set(self.categories.values())
+        self.customer_ids = set(self.customers.values())
+        products = Product.__table__
+        self.products = {}
+        self.product_prices = {}
+        for id, name, price in connection.execute(select(products.c.id, products.c.name, products.c.price)):
+            self.products[name] = id
+            self.product_prices[id] = price
+        self.next_ids = {}
+
+    def names(self, model, column):
+        table = model.__table__
+        return {name: id for name, id in self.connection.execute(select(table.c[column], table.c.id))}
+
+    def next_id(self, model):
+        if model not in self.next_ids:
+            table = model.__table__
+            self.next_ids[model] = (self.connection.execute(select(func.max(table.c.id))).scalar() or 0) + 1
+        id = self.next_ids[model]
+        self.next_ids[model] = id + 1
+        return id
+
+    '''
+    resolve(value, by_name, ids, name)
+        the id of a referenced row given by id or by name, raises ValueError if there is none
+    '''
+    def resolve(self, value, by_name, ids, name):
+        if isinstance(value, int) or (isinstance(value, str) and value.isdigit()):
+            id = int(value)
+            if id in ids:
+                return id
+        elif value in by_name:
+            return by_name[value]
+        raise ValueError(f'{name} {value} does not exist')
+
+    def brand_row(self, data):
+        name = data.get('name', None)
+        if blank(name):
+            raise ValueError('name is required')
+        if name in self.brands:
+            raise ValueError(f'brand {name} already exists')
+        id = self.brands[name] = self.next_id(Brand)
+        self.brand_ids.add(id)
+        return Brand, {'id': id, 'name': name, 'catchphrase': data.get('catchphrase') or None}
+
+    def category_row(self, data):
+        name = data.get('name', None)
+        if blank(name):
+            raise ValueError('name is required')
+        if name in self.categories:
+            raise ValueError(f'category {name} already exists')
+        id = self.categories[name] = self.next_id(ProductCategory)
+        self.category_ids.add(id)
+        return ProductCategory, {'id': id, 'name': name, 'description': data.get('description') or None}
+
+    def product_row(self, data):
+        name = data.get('name', None)
+        if blank(name):
+            raise ValueError('name is required')
+        if name in self.products:
+            raise ValueError(f'product {name} already exists')
+        price = as_float(data.get('price', None), 'price')
+        brand = self.resolve(data.get('brand', None), self.brands, self.brand_ids, 'brand')
+        category = data.get('product_category', data.get('product_category_id', None))
+        if not blank(category):
+            category = self.resolve(category, self.categories, self.category_ids, 'category')
+        else:
+            category = None
+        id = self.products[name] = self.next_id(Product)
+        self.product_prices[id] = price
+        return Product, {
+            'id': id,
+            'name': name,
+            'price': price,
+            'brand': brand,
+            'description': data.get('description') or None,
+            'product_category': category,
+            'img_url': data.get('img_url') or None,
+            'stock': None if blank(data.get('stock', None)) else as_int(data['stock'], 'stock'),
+            'review_count': 0,
+            'rating_sum': 0.0,
+            'rating_avg': None,
+        }
+
+    def customer_row(self, data):
+        email = data.get('email', None)
+        if blank(email) or blank(data.get('name', None)):
+            raise ValueError('name and email are required')
+        if email in self.customers:
+            raise ValueError(f'customer {email} already exists')
+        id = self.customers[email] = self.next_id(Customer)
+        self.customer_ids.add(id)
+        return Customer, {'id': id, 'name': data['name'], 'email': email, 'address': data.get('address') or None}
+
+    '''
+    order_rows(data)
+        an order and its line items, priced from the products in memory
+    '''
+    def order_rows(self, data):
+        customer = data.get('customer', data.get('customer_id', data.get('email', None)))
+        customer = self.resolve(customer, self.customers, self.customer_ids, 'customer')
+        items = data.get('items', None)
+        if isinstance(items, str):
+            try:
+                items = json.loads(items)
+            except ValueError:
+                raise ValueError('items must be a json list')
+        if not isinstance(items, list) or not items:
+            raise ValueError('items must be a non empty list')
+
+        created = data.get('datetime', None)
+        if blank(created):
+            created = datetime.datetime.utcnow()
+        elif isinstance(created, str):
+            try:
+                created = datetime.datetime.fromisoformat(created)
+            except ValueError:
+                raise ValueError('datetime must be an iso timestamp')
+
+        lines = []
+        for item in items:
+            if not isinstance(item, dict):
+                raise ValueError('each item must be an object')
+            product = item.get('product_id', item.get('product', item.get('name', None)))
+            product_id = self.resolve(product, self.products, self.product_prices, 'product')
+            quantity = as_int(item.get('quantity', 1), 'quantity')
+            if quantity < 1:
+                raise ValueError('quantity must be positive')
+            lines.append((product_id, quantity, self.product_prices[product_id]))
+
+        order_id = self.next_id(Order)
+        cost = data.get('cost', None)
+        cost = sum(quantity * price for _, quantity, price in lines) if blank(cost) else as_float(cost, 'cost')
+        items_json = json.dumps([
+            {'product_id': product_id, 'quantity': quantity, 'unit_price': price}
+            for product_id, quantity, price in lines])
+        rows = [(Order, {
+            'id': order_id,
+            'customer': customer,
+            'items_json': items_json,
+            'cost': cost,
+            'datetime': created,
+            'status': data.get('status') or 'pending',
+        })]
+        rows.extend((OrderItem, {
+            'id': self.next_id(OrderItem),
+            'order_id': order_id,
+            'product_id': product_id,
+            'quantity': quantity,
+            'unit_price': price,
+        }) for product_id, quantity, price in lines)
+        return rows
+
+    def convert(self, table, data):
+        if not isinstance(data, dict):
+            raise ValueError('row must be an object')
+        if table == 'brands':
+            return [self.brand_row(data)]
+        if table == 'product_categories':
+            return [self.category_row(data)]
+        if table == 'products':
+            return [self.product_row(data)]
+        if table == 'customers':
+            return [self.customer_row(data)]
+        return self.order_rows(data)
+
+    '''
+    write(model, rows)
+        writes a batch of rows of one table, with COPY on postgres
+    '''
+    def write(self, model, rows):
+        table = model.__table__
+        if self.dialect != 'postgresql':
+            self.connection.execute(table.insert(), rows)
+            return
+        columns = list(rows[0])
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[column].isoformat() if isinstance(row[column], datetime.datetime) else row[column]
+                for column in columns])
+        buffer.seek(0)
+        column_list = ', '.join(f'"{column}"' for column in columns)
+        cursor = self.connection.connection.cursor()
+        try:
+            cursor.copy_expert(f'COPY "{table.name}" ({column_list}) FROM STDIN WITH (FORMAT csv)', buffer)
+        finally:
+            cursor.close()
+
+    '''
+    load(table, rows)
+        converts and writes the rows of one input table in batches
+        returns the number of rows written per database table and the rejected (row, error) pairs
+    '''
+    def load(self, table, rows):
+        written = {}
+        errors = []
+        batches = {}
+        for index, data in enumerate(rows):
+            try:
+                if isinstance(data, ValueError):
+                    raise ValueError(f'invalid json: {data}')
+                converted = self.convert(table, data)
+            except ValueError as error:
+                errors.append((index, str(error)))
+                continue
+            for model, row in converted:
+                batch = batches.setdefault(model, [])
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    self.flush(batches, written)
+        self.flush(batches, written)
+        return written, errors
+
+    def flush(self, batches, written):
+        # parents before children, the order items of a batch reference its orders
+        for model in sorted(batches, key=lambda model: model is OrderItem):
+            batch = batches[model]
+            if batch:
+                self.write(model, batch)
+                written[model] = written.get(model, 0) + len(batch)
+                batch.clear()
+
+    '''
+    reset_sequences(models)
+        moves the postgres id sequences past the ids assigned in memory
+    '''
+    def reset_sequences(self, models):
+        if self.dialect != 'postgresql':
+            return
+        for model in models:
+            name = model.__tablename__
+            self.connection.execute(text(
+                f'SELECT setval(pg_get_serial_sequence(\'"{name}"\', \'id\'), '
+                f'(SELECT coalesce(max(id), 0) + 1 FROM "{name}"), false)'))
+
+
+'''
+deferred_indexes(connection, models)
+    drops the secondary indexes of the tables that are still empty and recreates them on exit
+    the sqlite search trigger of an empty product table is replaced by one rebuild of the index
+'''
+@contextlib.contextmanager
+def deferred_indexes(connection, models):
+    empty = [model for model in models
+        if connection.execute(select(model.__table__.c.id).limit(1)).first() is None]
+    dropped = [index for model in empty for index in model.__table__.indexes]
+    for index in dropped:
+        index.drop(connection)
+    search_deferred = Product in empty and connection.dialect.name == 'sqlite'
+    if search_deferred:
+        connection.execute(text('DROP TRIGGER IF EXISTS "Products_search_insert"'))
+    try:
+        yield
+    finally:
+        for index in dropped:
+            index.create(connection)
+        if search_deferred:
+            install_product_search(connection, rebuild=True)
+
+
+'''
+deferred_foreign_keys(connection)
+    skips the postgres foreign key triggers for the rest of the session when the role may do so
+    returns True when they are skipped
+'''
+def deferred_foreign_keys(connection):
+    if connection.dialect.name != 'postgresql':
+        return False
+    try:
+        with connection.begin_nested():
+            connection.execute(text('SET session_replication_role = replica'))
+    except DBAPIError:
+        return False
+    return True
+
+
+TABLE_MODELS = {
+    'brands': (Brand,),
+    'product_categories': (ProductCategory,),
+    'products': (Product,),
+    'customers': (Customer,),
+    'orders': (Order, OrderItem),
+}
+
+
+'''
+load_catalog(sources, batch_size, report)
+    loads {table: rows} in dependency order, each table in its own transaction
+    calls report(table, written, errors, seconds) after each table and returns the rows written
+'''
+def load_catalog(sources, batch_size=LOAD_BATCH_SIZE, report=None):
+    totals = {}
+    with db.engine.connect() as connection:
+        loader = CatalogLoader(connection, batch_size)
+        for table in LOAD_ORDER:
+            if table not in sources:
+                continue
+            models = TABLE_MODELS[table]
+            started = time.perf_counter()
+            with connection.begin():
+                skip_foreign_keys = deferred_foreign_keys(connection)
+                with deferred_indexes(connection, models):
+                    written, errors = loader.load(table, sources[table])
+                loader.reset_sequences(models)
+                if skip_foreign_keys:
+                    connection.execute(text('RESET session_replication_role'))
+            for model in models:
+                totals[model.__tablename__] = totals.get(model.__tablename__, 0) + written.get(model, 0)
+            if report is not None:
+                report(table, sum(written.values()), errors, time.perf_counter() - started)
+
+    # executemany and COPY skip the orm events that keep the cached counts and versions current
+    changed = [name for name, count in totals.items() if count]
+    for model in (Brand, ProductCategory, Product, Customer, Order, OrderItem):
+        if model.__tablename__ in changed:
+            model.invalidate_count()
+    bump_table_versions(changed)
+    return totals
+
+
+'''
+synthetic_catalog(products, seed)
+    a generated catalog in the input format of the loader, with products products and as many
+    orders, and brands, categories and customers in proportion, referenced by name
+'''
+def synthetic_catalog(products, seed=0):
+    generator = random.Random(seed)
+    brands = max(10, products // 1000)
+    categories = max(5, products // 5000)
+    customers = max(100, products // 10)
+    adjectives = ('red', 'large', 'classic', 'compact', 'deluxe', 'eco', 'smart', 'vintage')
+    nouns = ('lamp', 'chair', 'kettle', 'backpack', 'speaker', 'jacket', 'desk', 'camera')
+
+    def product_rows():
+        for i in range(products):
+            yield {
+                'name': f'{adjectives[i % len(adjectives)]} {nouns[(i // len(adjectives)) % len(nouns)]} {i}',
+                'price': round(generator.uniform(1, 500), 2),
+                'brand': f'brand {generator.randrange(brands)}',
+                'product_category': f'category {generator.randrange(categories)}',
+                'description': f'synthetic product number {i}',
+            }
+
+    def order_rows():
+        # product names are rebuilt from their index so the catalog is never held in memory
+        for _ in range(products):
+            items = []
+            for _ in range(generator.randint(1, 3)):
+                i = generator.randrange(products)
+                name = f'{adjectives[i % len(adjectives)]} {nouns[(i // len(adjectives)) % len(nouns)]} {i}'
+                items.append({'product': name, 'quantity': generator.randint(1, 4)})
+            yield {
+                'customer': f'customer{generator.randrange(customers)}@example.com',
+                'items': items,
+                'status': generator.choice(('pending', 'paid', 'shipped')),
+            }
+
+    return {
+        'brands': ({'name': f'brand {i}', 'catchphrase': f'catchphrase {i}'} for i in range(brands)),
+        'product_categories': ({'name': f'category {i}', 'description': f'category {i}'} for i in range(categories)),
+        'products': product_rows(),
+        'customers': ({'name': f'customer {i}', 'email': f'customer{i}@example.com', 'address': f'{i} main street'}
+            for i in range(customers)),
+        'orders': order_rows(),
+    }
\ No newline at end of file
@@ -1,14 +1,95 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
-from models import db
+from app import create_app
+import models
+from models import db, backfill_order_items, install_product_search, recompute_rating_aggregates
+from idempotency import DatabaseIdempotencyStore
+from loader import LOAD_BATCH_SIZE, MAX_REPORTED_ERRORS, load_catalog, read_rows, synthetic_catalog, table_files
 
+# commands run before the schema exists, so the app skips the schema check
+app = create_app({'DB_SCHEMA': 'skip'})
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
 
+'''
+create_schema
+    creates the missing tables and records the schema version the app checks on startup
+'''
+@manager.command
+def create_schema():
+    models.create_schema()
+
+
+'''
+search_index
+    creates the product search index on an existing database and indexes the rows already in it
+'''
+@manager.command
+def search_index():
+    with db.engine.begin() as connection:
+        install_product_search(connection, rebuild=True)
+
+
+'''
+backfill_items
+    fills the OrderItems table from the items_json of orders written before it existed
+'''
+@manager.command
+def backfill_items():
+    backfilled, written, skipped = backfill_order_items()
+    print(f'backfilled {backfilled} orders with {written} items, skipped {skipped} unreadable orders')
+
+
+'''
+rating_aggregates
+    recomputes the review count and rating of every product from its reviews
+'''
+@manager.command
+def rating_aggregates():
+    recompute_rating_aggregates()
+
+
+'''
+load
+    bulk loads a catalog into the database, see loader.py
+    --directory reads brands, product_categories, products, customers and orders .csv or .ndjson files
+    --generate N loads a synthetic catalog of N products and N orders instead
+'''
+@manager.command
+def load(directory=None, generate=0, batch_size=LOAD_BATCH_SIZE):
+    if directory is not None:
+        files = table_files(directory)
+        if not files:
+            print(f'no catalog files in {directory}')
+            return
+        sources = {table: read_rows(path) for table, path in files.items()}
+    elif generate:
+        sources = synthetic_catalog(int(generate))
+    else:
+        print('pass --directory or --generate')
+        return
+
+    def report(table, written, errors, seconds):
+        rate = written / seconds if seconds else 0
+        print(f'{table}: {written} rows in {seconds:.1f}s ({rate:.0f} rows/s), {len(errors)} rejected')
+        for index, error in errors[:MAX_REPORTED_ERRORS]:
+            print(f'    row {index}: {error}')
+
+    load_catalog(sources, batch_size=int(batch_size), report=report)
+
+
+'''
+purge_idempotency_keys
+    deletes the stored idempotency keys that are past their ttl
+'''
+@manager.command
+def purge_idempotency_keys():
+    print(f'purged {DatabaseIdempotencyStore().purge_expired()} expired keys')
+
+
 if __name__ == '__main__':
     manager.run()
\ No newline at end of file
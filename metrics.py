@@ -0,0 +1,249 @@
+import bisect
+import logging
+import threading
+import time
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from pool import setting
+
+'''
+Request metrics
+
+    METRICS_ENABLED=true
+    SLOW_QUERY_MS=200
+    SLOW_QUERY_EXPLAIN=true
+
+records for every endpoint the latency, the number of SQL statements, the time spent in them and
+the size of the response, and serves them from /metrics in the Prometheus text format
+statements slower than SLOW_QUERY_MS are logged to the slow_queries logger with their
+parameters, and with the plan of the query when SLOW_QUERY_EXPLAIN is set
+when METRICS_ENABLED is not set no hook is installed at all
+'''
+
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# fields of pool_status that are current values, the others only ever grow
+POOL_GAUGES = ('size', 'checked_out', 'checked_in', 'overflow', 'wait_seconds_max')
+
+slow_query_log = logging.getLogger('slow_queries')
+
+
+def enabled(value):
+    return value is not None and str(value).lower() in ('1', 'true', 'yes')
+
+
+'''
+Histogram(buckets)
+    cumulative bucket counts, sum and count of observed values
+'''
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f'{name}_sum{{{labels}}} {round(self.sum, 6)}')
+        lines.append(f'{name}_count{{{labels}}} {self.count}')
+        return lines
+
+
+'''
+EndpointMetrics
+    the histograms and counters of one endpoint and method
+'''
+class EndpointMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.response_size = Histogram(SIZE_BUCKETS)
+        self.sql_seconds = 0.0
+        self.slow_queries = 0
+
+
+'''
+RequestMetrics
+    the metrics of every endpoint of an app
+'''
+class RequestMetrics:
+    def __init__(self, slow_query_ms=None, explain=False):
+        self.slow_query_seconds = None if slow_query_ms is None else float(slow_query_ms) / 1000
+        self.explain = explain
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, method, latency, state, size):
+        with self._lock:
+            metrics = self.endpoints.get((endpoint, method), None)
+            if metrics is None:
+                metrics = self.endpoints[(endpoint, method)] = EndpointMetrics()
+            metrics.latency.observe(latency)
+            metrics.statements.observe(state.statements)
+            if size is not None:
+                metrics.response_size.observe(size)
+            metrics.sql_seconds += state.sql_seconds
+            metrics.slow_queries += state.slow_queries
+
+    def render(self, pool=None):
+        with self._lock:
+            endpoints = sorted(self.endpoints.items())
+            lines = []
+            families = (
+                ('http_request_duration_seconds', 'histogram', 'request latency', lambda m: m.latency),
+                ('http_request_sql_statements', 'histogram', 'SQL statements per request', lambda m: m.statements),
+                ('http_response_size_bytes', 'histogram', 'response body size', lambda m: m.response_size),
+            )
+            for name, kind, description, histogram in families:
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} {kind}')
+                for (endpoint, method), metrics in endpoints:
+                    lines.extend(histogram(metrics).render(name, f'endpoint="{endpoint}",method="{method}"'))
+
+            counters = (
+                ('http_request_sql_seconds_total', 'time spent executing SQL', lambda m: round(m.sql_seconds, 6)),
+                ('http_request_slow_queries_total', 'statements slower than SLOW_QUERY_MS', lambda m: m.slow_queries),
+            )
+            for name, description, value in counters:
+                lines.append(f'# HELP {name} {description}')
+                lines.append(f'# TYPE {name} counter')
+                for (endpoint, method), metrics in endpoints:
+                    lines.append(f'{name}{{endpoint="{endpoint}",method="{method}"}} {value(metrics)}')
+
+        for key, value in (pool or {}).items():
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                continue
+            if key in POOL_GAUGES:
+                name, kind = f'db_pool_{key}', 'gauge'
+            else:
+                name, kind = f"db_pool_{key.replace('_total', '')}_total", 'counter'
+            lines.append(f'# TYPE {name} {kind}')
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+'''
+RequestState
+    the SQL statements run by one request so far
+'''
+class RequestState:
+    __slots__ = ('metrics', 'started', 'statements', 'sql_seconds', 'slow_queries')
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.slow_queries = 0
+
+
+def current_state():
+    if not has_request_context():
+        return None
+    return g.get('request_metrics', None)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_state() is not None:
+        conn.info.setdefault('metrics_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    state = current_state()
+    if state is None or not conn.info.get('metrics_started'):
+        return
+    elapsed = time.perf_counter() - conn.info['metrics_started'].pop()
+    state.statements += 1
+    state.sql_seconds += elapsed
+
+    threshold = state.metrics.slow_query_seconds
+    if threshold is not None and elapsed >= threshold and not conn.info.get('metrics_explaining'):
+        state.slow_queries += 1
+        plan = None
+        if state.metrics.explain and not executemany and statement.lstrip()[:6].upper() == 'SELECT':
+            plan = explain(conn, statement, parameters)
+        slow_query_log.warning('%.1f ms %s %s params=%r%s', elapsed * 1000, request.endpoint, statement,
+            parameters, '' if plan is None else '\n' + plan)
+
+
+'''
+explain(conn, statement, parameters)
+    the query plan of a statement, run on the connection that executed it
+'''
+def explain(conn, statement, parameters):
+    prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+    conn.info['metrics_explaining'] = True
+    try:
+        rows = conn.exec_driver_sql(prefix + statement, parameters).fetchall()
+    except Exception as error:
+        return f'explain failed: {error}'
+    finally:
+        conn.info['metrics_explaining'] = False
+    return '\n'.join(' '.join(str(value) for value in row) for row in rows)
+
+
+_listening = False
+_listening_lock = threading.Lock()
+
+
+def listen_for_statements():
+    global _listening
+    with _listening_lock:
+        if not _listening:
+            event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+            _listening = True
+
+
+'''
+init_metrics(app)
+    installs the request hooks when METRICS_ENABLED is set
+    returns the app's RequestMetrics, or None when metrics are disabled
+'''
+def init_metrics(app):
+    if not enabled(setting(app.config, 'METRICS_ENABLED')):
+        return None
+
+    metrics = RequestMetrics(
+        slow_query_ms=setting(app.config, 'SLOW_QUERY_MS'),
+        explain=enabled(setting(app.config, 'SLOW_QUERY_EXPLAIN')))
+    listen_for_statements()
+
+    @app.before_request
+    def start_request_metrics():
+        # the sub-requests of a batch run inside it and are counted as part of it
+        if 'request_metrics' in g:
+            request.environ['metrics.nested'] = True
+            return
+        g.request_metrics = RequestState(metrics)
+
+    @app.after_request
+    def record_request_metrics(response):
+        if request.environ.get('metrics.nested', False):
+            return response
+        state = g.pop('request_metrics', None)
+        if state is not None:
+            # streamed responses have no length up front and are recorded without a size
+            size = None if response.is_streamed else response.calculate_content_length()
+            metrics.record(request.endpoint or 'unmatched', request.method,
+                time.perf_counter() - state.started, state, size)
+        return response
+
+    return metrics
\ No newline at end of file
@@ -1,42 +1,390 @@
+import base64
 import datetime
 from math import prod
 import os
-from sqlalchemy import Column, String, create_engine
-from flask_sqlalchemy import SQLAlchemy
+import re
+import threading
+import time
+from sqlalchemy import Column, String, create_engine, and_, or_, bindparam, case, event, func, inspect, select, text
+from sqlalchemy.exc import IntegrityError, OperationalError, ProgrammingError
+from sqlalchemy.orm import Session, load_only, object_session, selectinload
 import json
+from cache import ReadThroughCache
+from serializers import RowEncoder
+from pool import engine_options, setting
+from replicas import RoutingSQLAlchemy, init_replicas, configured_replica_urls, primary_reads, replica_read
 
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith("postgres://"):
-  database_path = database_path.replace("postgres://", "postgresql://", 1)
+db = RoutingSQLAlchemy()
 
-db = SQLAlchemy()
+# bumped whenever the tables change, create_app refuses a database at another version
+SCHEMA_VERSION = 4
+
+# (table, column, definition) of columns added to tables that already existed at an earlier version,
+# create_all only creates missing tables so create_schema adds these itself
+SCHEMA_COLUMNS = (
+  ('Products', 'review_count', 'INTEGER NOT NULL DEFAULT 0'),
+  ('Products', 'rating_sum', 'FLOAT NOT NULL DEFAULT 0'),
+  ('Products', 'rating_avg', 'FLOAT'),
+  ('Products', 'stock', 'INTEGER'),
+)
+
+# upper bound on the number of rows a single page may request
+MAX_PAGE_LIMIT = 100
+
+# rows fetched from the server side cursor at a time by the export stream
+EXPORT_BATCH_SIZE = 1000
+
+# seconds a cached row count is trusted before it is recounted,
+# this bounds the drift caused by writes from other workers
+COUNT_CACHE_TTL = 60
+
+'''
+database_url()
+    the DATABASE_URL of the environment, read when an app is created instead of on import
+'''
+def database_url():
+    url = os.environ.get('DATABASE_URL', None)
+    if url is None:
+        raise RuntimeError('DATABASE_URL is not set')
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
 
 '''
 setup_db(app)
     binds a flask application and a SQLAlchemy service
+    a SQLALCHEMY_DATABASE_URI already in the app config takes precedence over database_path,
+    and both over DATABASE_URL
+    the connection pool is configured from the DB_POOL_* settings, see pool.py
+    replica_urls (or DB_REPLICA_URLS) are read replicas for the reads of GET requests, see replicas.py
+    DB_SCHEMA decides what happens to the schema: check (the default) only compares the schema
+    version, create creates missing tables first, skip does neither
 '''
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None, replica_urls=None):
+    if app.config.get("SQLALCHEMY_DATABASE_URI", None) is None:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_path or database_url()
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS",
+        engine_options(app.config, app.config["SQLALCHEMY_DATABASE_URI"]))
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
-    db.create_all()
+    init_replicas(app, db, replica_urls if replica_urls is not None else configured_replica_urls(app.config))
+
+    schema = setting(app.config, 'DB_SCHEMA') or 'check'
+    if schema == 'create':
+        create_schema()
+    elif schema == 'check':
+        check_schema()
+    elif schema != 'skip':
+        raise ValueError(f'DB_SCHEMA must be check, create or skip, not {schema}')
+
+'''
+encode_cursor(sort_key, value, id)
+    packs the position of the last row of a page into an opaque url-safe token
+'''
+def encode_cursor(sort_key, value, id):
+  if isinstance(value, datetime.datetime):
+    value = value.isoformat()
+  raw = json.dumps([sort_key, value, id], separators=(',', ':'))
+  return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+'''
+decode_cursor(cursor)
+    unpacks a token made by encode_cursor, raises ValueError if it is malformed
+'''
+def decode_cursor(cursor):
+  try:
+    padded = cursor + '=' * (-len(cursor) % 4)
+    sort_key, value, id = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+  except Exception:
+    raise ValueError('malformed cursor')
+  if not isinstance(sort_key, str) or not isinstance(id, int):
+    raise ValueError('malformed cursor')
+  return sort_key, value, id
+
+'''
+RowCountCache
+    exact row counts per table, kept current by the insert and delete events at the bottom of this file
+    a count is kept with the version of its table it was taken at, when given one, and is not used
+    at another version, since the writes of other workers only reach it through that version
+'''
+class RowCountCache:
+  def __init__(self, ttl=COUNT_CACHE_TTL):
+    self.ttl = ttl
+    self._counts = {}
+    self._lock = threading.Lock()
+
+  def get(self, table, version=None):
+    with self._lock:
+      entry = self._counts.get(table)
+    if entry is None or time.monotonic() - entry[1] >= self.ttl:
+      return None
+    if version is not None and entry[2] != version:
+      return None
+    return entry[0]
+
+  def set(self, table, count, version=None):
+    with self._lock:
+      self._counts[table] = (count, time.monotonic(), version)
+
+  def apply(self, deltas):
+    with self._lock:
+      for table, delta in deltas.items():
+        entry = self._counts.get(table)
+        if entry is not None:
+          self._counts[table] = (entry[0] + delta,) + entry[1:]
+
+  def invalidate(self, table=None):
+    with self._lock:
+      if table is None:
+        self._counts.clear()
+      else:
+        self._counts.pop(table, None)
+
+row_counts = RowCountCache()
+
+'''
+Fieldset
+    the fields of a model a response asked for with ?fields=, and the related rows it asked to
+    expand with ?expand=, fields is every field and expand the model's expandable fields by default
+    a related row that is not expanded is left as its id, and the id of the row itself is always in
+    raises ValueError for names the model does not have, or for an empty list of fields
+'''
+class Fieldset:
+  def __init__(self, model, fields=None, expand=None):
+    names = model.field_names()
+    unknown = [name for name in fields or () if name not in names]
+    unknown += [name for name in expand or () if name not in model.expandable]
+    if unknown:
+      raise ValueError(f'unknown fields {", ".join(unknown)}')
+    if fields is not None and not fields:
+      raise ValueError('no fields')
+    self.fields = names if fields is None else tuple(name for name in names if name in fields or name == 'id')
+    self.expand = frozenset(model.expandable if expand is None else expand) & frozenset(self.fields)
+    self.encoded = tuple(name for name in self.fields if name in model.format_columns)
+
+    columns = {'id'}
+    for name in self.fields:
+      columns.update(model.computed_fields.get(name, (name,) if name in model.__table__.columns else ()))
+    self.columns = frozenset(columns)
+    self.everything = self.columns >= frozenset(model.__table__.columns.keys())
+
+  def includes(self, name):
+    return name in self.fields
+
+  def expands(self, name):
+    return name in self.expand
+
+  '''
+  load_options(model, also)
+      load_only the columns the fields are made from (and the columns in also) on a list query
+  '''
+  def load_options(self, model, also=()):
+    if self.everything:
+      return ()
+    return (load_only(*(getattr(model, name) for name in sorted(self.columns.union(also)))),)
 
 '''
 The default interface for a table in the database
 Contains methods for getting all items, getting one item, inserting, updating, and deleting items
 '''
 class DefaultTableInterface:
+  # columns a page can be sorted on, the id is always used as the tie breaker
+  sort_keys = ('id',)
+
+  '''
+  eager_loads(fieldset)
+      loader options applied to list queries so format() does not query per row
+  '''
   @classmethod
-  def get_all(cls, page=1, items_per_page=10):
+  def eager_loads(cls, fieldset=None):
+    return ()
+
+  '''
+  list_query(fieldset, also)
+      a query for rows to format with fieldset, loading only the columns it needs and those in also
+  '''
+  @classmethod
+  def list_query(cls, fieldset=None, also=()):
+    query = db.session.query(cls).options(*cls.eager_loads(fieldset))
+    if fieldset is not None:
+      query = query.options(*fieldset.load_options(cls, also))
+    return query
+
+  '''
+  prepare_format(rows, fieldset)
+      called with every list of rows about to be formatted, to batch what format() needs
+  '''
+  @classmethod
+  def prepare_format(cls, rows, fieldset=None):
+    pass
+
+  # fields format() adds to the format_columns, with the columns each one is made from
+  computed_fields = {}
+  # fields holding a related row, formatted in full unless a fieldset leaves them unexpanded
+  expandable = ()
+
+  @classmethod
+  def field_names(cls):
+    return tuple(cls.format_columns) + tuple(name for name in cls.computed_fields if name not in cls.format_columns)
+
+  '''
+  fieldset(fields, expand)
+      the Fieldset of this model for the names of ?fields= and ?expand=, None for either means all
+  '''
+  @classmethod
+  def fieldset(cls, fields=None, expand=None):
+    if fields is None and expand is None:
+      fieldset = cls.__dict__.get('_default_fieldset')
+      if fieldset is None:
+        fieldset = Fieldset(cls)
+        cls._default_fieldset = fieldset
+      return fieldset
+    return Fieldset(cls, fields, expand)
+
+  @classmethod
+  @replica_read
+  def get_all(cls, page=1, items_per_page=10, criteria=(), fieldset=None):
+    items_per_page = max(1, min(items_per_page, MAX_PAGE_LIMIT))
     start = (page - 1) * items_per_page
     end = start + items_per_page
-    products = db.session.query(cls).where(cls.id >= start).where(cls.id < end).all()
+    products = cls.list_query(fieldset).filter(*criteria).where(cls.id >= start).where(cls.id < end).all()
+    cls.prepare_format(products, fieldset)
     return products
-  
+
+  '''
+  get_page(cursor, limit, sort_key, criteria)
+      keyset pagination over (sort_key, id), restricted to the rows matching criteria
+      a sort_key prefixed with '-' pages in descending order
+      returns the rows after the cursor and the cursor of the next page, or None on the last page
+      every page is a range scan on the (sort_key, id) index no matter how deep it is
+  '''
+  @classmethod
+  @replica_read
+  def get_page(cls, cursor=None, limit=10, sort_key='id', criteria=(), fieldset=None):
+    descending = sort_key.startswith('-')
+    name = sort_key[1:] if descending else sort_key
+    if name not in cls.sort_keys:
+      raise ValueError(f'cannot sort {cls.__tablename__} by {name}')
+    limit = max(1, min(limit, MAX_PAGE_LIMIT))
+
+    column = getattr(cls, name)
+    # the sort column is read from the last row for the next cursor
+    query = cls.list_query(fieldset, also=(name,)).filter(*criteria)
+    if cursor is not None:
+      query = query.filter(cls._after_cursor(column, sort_key, descending, cursor))
+
+    order = (lambda c: c.desc()) if descending else (lambda c: c.asc())
+    if name == 'id':
+      query = query.order_by(order(cls.id))
+    else:
+      query = query.order_by(order(column), order(cls.id))
+
+    rows = query.limit(limit + 1).all()
+    cls.prepare_format(rows[:limit], fieldset)
+    if len(rows) <= limit:
+      return rows, None
+
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor(sort_key, getattr(last, name), last.id)
+
+  @classmethod
+  def _after_cursor(cls, column, sort_key, descending, cursor):
+    cursor_key, value, last_id = decode_cursor(cursor)
+    if cursor_key != sort_key:
+      raise ValueError('cursor does not match the sort key')
+
+    later = (lambda a, b: a < b) if descending else (lambda a, b: a > b)
+    if column is cls.id:
+      return later(cls.id, last_id)
+
+    if value is not None and isinstance(column.type, db.DateTime):
+      try:
+        value = datetime.datetime.fromisoformat(value)
+      except (TypeError, ValueError):
+        raise ValueError('malformed cursor')
+
+    # follow the database's own null placement so the plain (sort_key, id) index stays usable,
+    # postgres sorts nulls above every value and sqlite below
+    nulls_high = db.engine.dialect.name == 'postgresql'
+    nulls_first = nulls_high == descending
+    if value is None:
+      after = and_(column.is_(None), later(cls.id, last_id))
+      return or_(after, column.isnot(None)) if nulls_first else after
+    after = or_(later(column, value), and_(column == value, later(cls.id, last_id)))
+    return after if nulls_first else or_(after, column.is_(None))
+
+  '''
+  count_total(mode, criteria)
+      'exact' returns the cached row count, counting the table only when the cache is cold
+      'estimated' reads the planner statistics on postgres and falls back to 'exact' elsewhere
+      a filtered count is always counted exactly, over the index that serves the filter
+  '''
+  @classmethod
+  @replica_read
+  def count_total(cls, mode='exact', criteria=()):
+    if criteria:
+      return db.session.query(func.count(cls.id)).filter(*criteria).scalar()
+
+    if mode == 'estimated':
+      estimate = cls.estimate_total()
+      if estimate is not None:
+        return estimate
+
+    table = cls.__tablename__
+    version = known_table_version(table)
+    count = row_counts.get(table, version)
+    if count is None:
+      count = db.session.query(func.count(cls.id)).scalar()
+      # a count taken inside an unfinished write would be off by its pending rows,
+      # and one taken on a replica by the writes it has not replayed yet
+      if not db.session.info.get('row_count_deltas') and 'replica_bind' not in db.session.info:
+        row_counts.set(table, count, version)
+    return count
+
+  @classmethod
+  def estimate_total(cls):
+    if db.engine.dialect.name != 'postgresql':
+      return None
+    reltuples = db.session.execute(
+      text('SELECT reltuples FROM pg_class WHERE oid = to_regclass(:table)'),
+      {'table': f'"{cls.__tablename__}"'}).scalar()
+    # reltuples is -1 (or 0 on older servers) until the table has been analyzed
+    if reltuples is None or reltuples <= 0:
+      return None
+    return int(reltuples)
+
+  '''
+  invalidate_count()
+      forgets the cached count, for writes that bypass the ORM events such as bulk statements
+  '''
   @classmethod
-  def count_total(cls):
-    return db.session.query(cls).count()
+  def invalidate_count(cls):
+    row_counts.invalidate(cls.__tablename__)
+
+  # other tables whose served data changes when a row of this table does
+  also_changes = ()
+
+  '''
+  mark_changed()
+      records that the current transaction wrote to this table, so its version is bumped on commit
+      orm writes are recorded by the flush event, bulk statements have to call this themselves
+  '''
+  @classmethod
+  def mark_changed(cls):
+    changed = db.session.info.setdefault('changed_tables', set())
+    changed.add(cls.__tablename__)
+    changed.update(cls.also_changes)
+
+  '''
+  count_inserted(count)
+      tallies rows inserted by statements that bypass the ORM, applied to the cached count on commit
+  '''
+  @classmethod
+  def count_inserted(cls, count):
+    deltas = db.session.info.setdefault('row_count_deltas', {})
+    deltas[cls.__tablename__] = deltas.get(cls.__tablename__, 0) + count
   
   @classmethod
   def insert(cls, product):
@@ -53,15 +401,216 @@ class DefaultTableInterface:
     db.session.commit()
 
   @classmethod
+  @replica_read
   def get_one_or_none(cls, id):
     return db.session.query(cls).get(id)
 
+  '''
+  get_many(ids)
+      the rows with the given ids from one IN query, in the order of ids, ids that do not exist are left out
+  '''
+  @classmethod
+  @replica_read
+  def get_many(cls, ids, fieldset=None):
+    ids = list(ids)
+    found = {row.id: row for row in cls.list_query(fieldset).filter(cls.id.in_(ids))}
+    rows = [found[id] for id in ids if id in found]
+    cls.prepare_format(rows, fieldset)
+    return rows
+
+  # attributes format() copies straight from the row, under the same names
+  format_columns = ('id',)
+
+  '''
+  encode_columns(fieldset)
+      the format_columns of the row (those in fieldset) as a dict, through an encoder built once
+      per model and set of columns
+  '''
+  def encode_columns(self, fieldset=None):
+    model = type(self)
+    names = model.format_columns if fieldset is None else fieldset.encoded
+    encoders = model.__dict__.get('_encoders')
+    if encoders is None:
+      encoders = {}
+      model._encoders = encoders
+    encoder = encoders.get(names)
+    if encoder is None:
+      encoder = RowEncoder(model, names)
+      encoders[names] = encoder
+    return encoder(self)
+
+  def format(self, fieldset=None):
+    return self.encode_columns(fieldset)
+
+  # read through cache of formatted rows, for small tables that are read far more than written
+  cache = None
+
+  @classmethod
+  def load_formatted(cls, ids):
+    return {row.id: row.format() for row in cls.get_many(ids)}
+
+  '''
+  get_formatted(ids)
+      returns {id: formatted row} for the ids that exist, through the cache when the model has one
+  '''
+  @classmethod
+  def get_formatted(cls, ids):
+    ids = {id for id in ids if id is not None}
+    if not ids:
+      return {}
+    if cls.cache is None:
+      return cls.load_formatted(ids)
+    # cached rows outlive the request, so they are not loaded from a replica that may lag
+    with primary_reads(db.session()):
+      return cls.cache.get_many(ids, cls.load_formatted, version=known_table_version(cls.__tablename__))
+
+  @classmethod
+  def get_formatted_one(cls, id):
+    return cls.get_formatted([id]).get(id)
+
+  # columns an export can be filtered on by equality
+  export_filters = ()
+  # timestamp column an export can be bounded on with since=
+  since_column = None
+
+  '''
+  stream_rows(filters, after_id, since)
+      returns an iterator over the raw column values of every matching row in id order,
+      EXPORT_BATCH_SIZE rows at a time
+      rows are read through a server side cursor so memory stays flat however large the table is
+      the query runs when this is called, so a stream sent after its route returned still reads
+      from the replica the route read its table versions from
+  '''
+  @classmethod
+  def stream_rows(cls, filters=None, after_id=None, since=None):
+    table = cls.__table__
+    query = table.select().order_by(table.c.id)
+    for column, value in (filters or {}).items():
+      if column not in cls.export_filters:
+        raise ValueError(f'cannot filter {cls.__tablename__} by {column}')
+      query = query.where(table.c[column] == value)
+    if after_id is not None:
+      query = query.where(table.c.id > after_id)
+    if since is not None:
+      if cls.since_column is None:
+        raise ValueError(f'{cls.__tablename__} has no timestamp to filter on')
+      query = query.where(table.c[cls.since_column] >= since)
+
+    result = db.session.execute(query.execution_options(stream_results=True))
+    return cls._partitions(result)
+
+  @staticmethod
+  def _partitions(result):
+    try:
+      for batch in result.mappings().partitions(EXPORT_BATCH_SIZE):
+        yield batch
+    finally:
+      result.close()
+
+  # (json key, column, type, required) of the rows accepted by the bulk endpoints
+  bulk_fields = ()
+  # column that identifies an existing row when upserting
+  natural_key = None
+
+  '''
+  row_from_json(data)
+      validates one bulk row and returns its column values, raises ValueError if it is invalid
+      optional keys the row leaves out are left out of the values, so an upsert keeps them
+  '''
+  @classmethod
+  def row_from_json(cls, data):
+    if not isinstance(data, dict):
+      raise ValueError('row must be an object')
+    row = {}
+    for key, column, kind, required in cls.bulk_fields:
+      if key not in data and not required:
+        continue
+      value = data.get(key, None)
+      if value is None or value == '':
+        if required:
+          raise ValueError(f'{key} is required')
+        row[column] = None
+        continue
+      if kind is float and isinstance(value, int) and not isinstance(value, bool):
+        value = float(value)
+      if not isinstance(value, kind) or isinstance(value, bool):
+        raise ValueError(f'{key} must be of type {kind.__name__}')
+      row[column] = value
+    return row
+
+  '''
+  bulk_reject(rows)
+      checks a chunk of (index, row) pairs against the database before it is written
+      returns a dict of row index to error message for the rows to drop
+  '''
+  @classmethod
+  def bulk_reject(cls, rows):
+    return {}
+
+  '''
+  bulk_write(rows, upsert)
+      writes a chunk of (index, row) pairs with executemany in a single transaction
+      with upsert, rows whose natural key matches an existing row update that row instead
+      returns the number of rows inserted, the number updated and the per row errors
+  '''
+  @classmethod
+  def bulk_write(cls, rows, upsert=False):
+    rejected = cls.bulk_reject(rows)
+    errors = [{'row': index, 'error': rejected[index]} for index, _ in rows if index in rejected]
+    rows = [row for index, row in rows if index not in rejected]
+
+    inserts, updates = rows, []
+    if upsert and cls.natural_key is not None:
+      key = cls.natural_key
+      # the last row wins when a chunk repeats a key
+      by_key = {}
+      for row in rows:
+        by_key[row[key]] = row
+      existing = dict(db.session.query(getattr(cls, key), cls.id)
+        .filter(getattr(cls, key).in_(list(by_key))).all())
+      inserts = [row for value, row in by_key.items() if value not in existing]
+      updates = [dict(row, _id=existing[value]) for value, row in by_key.items() if value in existing]
+    # a new row gets null for the optional values it leaves out
+    unset = {column: None for _, column, _, _ in cls.bulk_fields}
+    inserts = [dict(unset, **row) for row in inserts]
+
+    try:
+      if inserts:
+        db.session.execute(cls.__table__.insert(), inserts)
+      # an updated row only sets the values it has, one executemany per set of columns
+      by_columns = {}
+      for row in updates:
+        by_columns.setdefault(tuple(sorted(column for column in row if column != '_id')), []).append(row)
+      table = cls.__table__
+      for columns, rows in by_columns.items():
+        if not columns:
+          continue
+        values = {column: bindparam(column) for column in columns}
+        db.session.execute(table.update().where(table.c.id == bindparam('_id')).values(values), rows)
+      cls.mark_changed()
+      db.session.commit()
+    finally:
+      # executemany skips the orm events that keep the cached count and rows current
+      cls.invalidate_count()
+      if cls.cache is not None and updates:
+        cls.cache.invalidate([row['_id'] for row in updates])
+    return len(inserts), len(updates), errors
+
 
 '''
 A brand of a product
 '''
 class Brand(db.Model, DefaultTableInterface):
   __tablename__ = 'Brands'
+  __table_args__ = (db.Index('ix_Brands_name_id', 'name', 'id'),)
+  cache = ReadThroughCache('Brands')
+  sort_keys = ('id', 'name')
+  bulk_fields = (
+    ('name', 'name', str, True),
+    ('catchphrase', 'catchphrase', str, False),
+  )
+  natural_key = 'name'
+  format_columns = ('id', 'name', 'catchphrase')
 
   id = Column(db.Integer, primary_key=True)
   name = Column(String)
@@ -71,11 +620,6 @@ class Brand(db.Model, DefaultTableInterface):
     self.name = name
     self.catchphrase = catchphrase
 
-  def format(self):
-    return {
-      'id': self.id,
-      'name': self.name,
-      'catchphrase': self.catchphrase}
   
 
 '''
@@ -83,6 +627,10 @@ A product category
 '''
 class ProductCategory(db.Model, DefaultTableInterface):
   __tablename__ = 'ProductCategories'
+  __table_args__ = (db.Index('ix_ProductCategories_name_id', 'name', 'id'),)
+  cache = ReadThroughCache('ProductCategories')
+  sort_keys = ('id', 'name')
+  format_columns = ('id', 'name', 'description')
 
   id = Column(db.Integer, primary_key=True)
   name = Column(String)
@@ -92,17 +640,39 @@ class ProductCategory(db.Model, DefaultTableInterface):
     self.name = name
     self.description = description
 
-  def format(self):
-    return {
-      'id': self.id,
-      'name': self.name,
-      'description': self.description}
 
 '''
 A product in the store
 '''
 class Product(db.Model, DefaultTableInterface):  
   __tablename__ = 'Products'
+  __table_args__ = (
+    db.Index('ix_Products_name_id', 'name', 'id'),
+    db.Index('ix_Products_price_id', 'price', 'id'),
+    db.Index('ix_Products_product_category_price_id', 'product_category', 'price', 'id'),
+    db.Index('ix_Products_brand_id', 'brand', 'id'),
+    db.Index('ix_Products_rating_avg_id', 'rating_avg', 'id'),
+  )
+  sort_keys = ('id', 'name', 'price', 'rating_avg')
+  export_filters = ('brand', 'product_category')
+  bulk_fields = (
+    ('name', 'name', str, True),
+    ('price', 'price', float, True),
+    ('brand', 'brand', int, True),
+    ('description', 'description', str, False),
+    ('product_category_id', 'product_category', int, False),
+    ('img_url', 'img_url', str, False),
+    ('stock', 'stock', int, False),
+  )
+  natural_key = 'name'
+  format_columns = ('id', 'name', 'description', 'price', 'stock', 'review_count', 'rating_avg')
+  computed_fields = {
+    'price_usd': ('price',),
+    'product_category': ('product_category',),
+    'brand': ('brand',),
+    'img_url': ('img_url',),
+  }
+  expandable = ('product_category', 'brand')
 
   id = Column(db.Integer, primary_key=True)
   name = Column(String)
@@ -111,33 +681,133 @@ class Product(db.Model, DefaultTableInterface):
   description = Column(String)
   product_category = Column(db.Integer, db.ForeignKey('ProductCategories.id'))
   img_url = Column(String)
-  
+  # units left to sell, null when the stock of the product is not tracked
+  stock = Column(db.Integer)
+  # review aggregates, maintained by the ProductReview events at the bottom of this file
+  review_count = Column(db.Integer, nullable=False, default=0, server_default='0')
+  rating_sum = Column(db.Float, nullable=False, default=0.0, server_default='0')
+  rating_avg = Column(db.Float)
 
-  def __init__(self, name, price, brand, description, product_category, img_url=None):
+  # for joins and single rows, lists format these through prepare_format and the row caches,
+  # so a page that reached for them per product raises instead of querying once per row
+  brand_obj = db.relationship('Brand', lazy='raise')
+  category_obj = db.relationship('ProductCategory', lazy='raise')
+
+  def __init__(self, name, price, brand, description, product_category, img_url=None, stock=None):
     self.name = name
     self.price = price
     self.brand = brand
     self.description = description
     self.product_category = product_category
     self.img_url = img_url
+    self.stock = stock
 
+  @classmethod
+  def prepare_format(cls, rows, fieldset=None):
+    # at most one IN query per dimension table for the whole page, none when the caches are warm
+    if fieldset is None or fieldset.expands('brand'):
+      Brand.get_formatted(row.brand for row in rows)
+    if fieldset is None or fieldset.expands('product_category'):
+      ProductCategory.get_formatted(row.product_category for row in rows)
 
-  def format(self):
-    return {
-      'id': self.id,
-      'name': self.name,
-      'description': self.description,
-      'price': self.price,
-      'price_usd': f"${self.price:.2f}",
-      'product_category': ProductCategory.get_one_or_none(self.product_category).format() if self.product_category is not None else None,
-      'brand': Brand.get_one_or_none(self.brand).format(),
-      'img_url': self.img_url if self.img_url is not None else "https://via.placeholder.com/150"}
+  '''
+  filter_criteria(category_id, brand_id, min_price, max_price)
+      the sql criteria for a filtered product listing, unset arguments do not filter
+  '''
+  @classmethod
+  def filter_criteria(cls, category_id=None, brand_id=None, min_price=None, max_price=None):
+    criteria = []
+    if category_id is not None:
+      criteria.append(cls.product_category == category_id)
+    if brand_id is not None:
+      criteria.append(cls.brand == brand_id)
+    if min_price is not None:
+      criteria.append(cls.price >= min_price)
+    if max_price is not None:
+      criteria.append(cls.price <= max_price)
+    return criteria
+
+  @classmethod
+  def bulk_reject(cls, rows):
+    # one IN query per referenced table for the whole chunk
+    brand_ids = {row['brand'] for _, row in rows}
+    category_ids = {row['product_category'] for _, row in rows if row.get('product_category') is not None}
+    brands = {id for id, in db.session.query(Brand.id).filter(Brand.id.in_(brand_ids))}
+    categories = {id for id, in db.session.query(ProductCategory.id).filter(ProductCategory.id.in_(category_ids))}
+
+    rejected = {}
+    for index, row in rows:
+      if row['brand'] not in brands:
+        rejected[index] = f"brand {row['brand']} does not exist"
+      elif row.get('product_category') is not None and row['product_category'] not in categories:
+        rejected[index] = f"product category {row['product_category']} does not exist"
+    return rejected
+
+  def format(self, fieldset=None):
+    if fieldset is None:
+      fieldset = self.fieldset()
+    data = self.encode_columns(fieldset)
+    if fieldset.includes('price_usd'):
+      data['price_usd'] = f"${self.price:.2f}"
+    if fieldset.includes('product_category'):
+      data['product_category'] = ProductCategory.get_formatted_one(self.product_category) \
+        if fieldset.expands('product_category') else self.product_category
+    if fieldset.includes('brand'):
+      data['brand'] = Brand.get_formatted_one(self.brand) if fieldset.expands('brand') else self.brand
+    if fieldset.includes('img_url'):
+      data['img_url'] = self.img_url if self.img_url is not None else "https://via.placeholder.com/150"
+    return data
+
+  '''
+  search(q, page, limit)
+      full text search over product names and descriptions, best matches first
+      uses the tsvector index on postgres and the fts5 table on sqlite
+      returns one page of products and whether there are more
+  '''
+  @classmethod
+  def search(cls, q, page=1, limit=10, fieldset=None):
+    limit = max(1, min(limit, MAX_PAGE_LIMIT))
+    offset = (max(page, 1) - 1) * limit
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+      statement = text(
+        'SELECT "Products".id FROM "Products", websearch_to_tsquery(\'english\', :q) query '
+        'WHERE search_vector @@ query '
+        'ORDER BY ts_rank(search_vector, query) DESC, "Products".id LIMIT :limit OFFSET :offset')
+    elif dialect == 'sqlite':
+      # quote every word so user input cannot use the fts5 query syntax
+      q = ' '.join('"' + word.replace('"', '') + '"' for word in re.findall(r'\w+', q))
+      statement = text(
+        'SELECT rowid FROM "ProductsSearch" WHERE "ProductsSearch" MATCH :q '
+        'ORDER BY bm25("ProductsSearch", 10.0, 1.0), rowid LIMIT :limit OFFSET :offset')
+    else:
+      statement = text(
+        'SELECT id FROM "Products" WHERE lower(name) LIKE lower(:q) OR lower(description) LIKE lower(:q) '
+        'ORDER BY id LIMIT :limit OFFSET :offset')
+      q = f'%{q}%'
+
+    if not q:
+      return [], False
+
+    ids = [id for id, in db.session.execute(statement, {'q': q, 'limit': limit + 1, 'offset': offset})]
+    has_more = len(ids) > limit
+    ids = ids[:limit]
+    products = {product.id: product for product in cls.list_query(fieldset).filter(cls.id.in_(ids))}
+    products = [products[id] for id in ids if id in products]
+    cls.prepare_format(products, fieldset)
+    return products, has_more
   
 '''
 A review of a product
 '''
 class ProductReview(db.Model, DefaultTableInterface):
   __tablename__ = 'ProductReviews'
+  __table_args__ = (db.Index('ix_ProductReviews_product_id', 'product', 'id'),)
+  export_filters = ('product', 'customer_id')
+  # reviews update the rating aggregates of their product
+  also_changes = ('Products',)
+  format_columns = ('id', 'review', 'rating')
 
   id = Column(db.Integer, primary_key=True)
   review = Column(String)
@@ -151,17 +821,24 @@ class ProductReview(db.Model, DefaultTableInterface):
     self.product = product_id
     self.customer_id = customer_id
 
-  def format(self):
-    return {
-      'id': self.id,
-      'review': self.review,
-      'rating': self.rating}
 
 '''
 A customer of the store
 '''
 class Customer(db.Model, DefaultTableInterface):
   __tablename__ = 'Customers'
+  __table_args__ = (
+    db.Index('ix_Customers_name_id', 'name', 'id'),
+    db.Index('ix_Customers_email', 'email'),
+  )
+  sort_keys = ('id', 'name')
+  bulk_fields = (
+    ('name', 'name', str, True),
+    ('email', 'email', str, True),
+    ('address', 'address', str, False),
+  )
+  natural_key = 'email'
+  format_columns = ('id', 'name', 'email', 'address')
 
   id = Column(db.Integer, primary_key=True)
   name = Column(String)
@@ -173,18 +850,20 @@ class Customer(db.Model, DefaultTableInterface):
     self.email = email
     self.address = address
 
-  def format(self):
-    return {
-      'id': self.id,
-      'name': self.name,
-      'email': self.email,
-      'address': self.address}
 
 '''
 An order in the store
 '''
 class Order(db.Model, DefaultTableInterface):
   __tablename__ = 'Orders'
+  __table_args__ = (db.Index('ix_Orders_datetime_id', 'datetime', 'id'),)
+  sort_keys = ('id', 'datetime')
+  export_filters = ('customer', 'status')
+  since_column = 'datetime'
+  format_columns = ('id', 'customer', 'items_json', 'cost', 'datetime', 'status')
+  # line items come from the OrderItems table, expanding them adds their product names
+  computed_fields = {'items': ()}
+  expandable = ('items',)
 
   id = Column(db.Integer, primary_key=True)
   customer = Column(db.Integer, db.ForeignKey('Customers.id'), nullable=False)
@@ -193,25 +872,662 @@ class Order(db.Model, DefaultTableInterface):
   datetime = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
   status = Column(String, nullable=False, default="pending")
 
+  items = db.relationship('OrderItem', order_by='OrderItem.id', cascade='all, delete-orphan', lazy='select')
+
   def __init__(self, customer, items_json, cost):
     self.customer = customer
     self.items_json = items_json
     self.cost = cost
 
+  @classmethod
+  def eager_loads(cls, fieldset=None):
+    # the items of a whole page of orders, and their products, in one IN query each
+    if fieldset is None or fieldset.expands('items'):
+      return (selectinload(cls.items).selectinload(OrderItem.product),)
+    if fieldset.includes('items'):
+      return (selectinload(cls.items),)
+    return ()
+
+  '''
+  containing_product(product_id)
+      the sql criteria for orders that have a line item for the product
+  '''
+  @classmethod
+  def containing_product(cls, product_id):
+    return [cls.id.in_(db.session.query(OrderItem.order_id).filter(OrderItem.product_id == product_id))]
+
+  '''
+  set_items(items)
+      replaces the line items of the order from a list of {'product_id', 'quantity'} objects
+      unit prices are read from the products in one query and the cost is worked out from them
+      the stock of tracked products moves by the difference from the old items through take_stock()
+      the order must have been loaded with get_for_update(), so two changes cannot both start
+      from the same old items
+      raises OutOfStock, or ValueError if an item is invalid, the caller rolls back
+  '''
+  def set_items(self, items):
+    lines = parse_order_items(items)
+
+    changes = {}
+    for item in self.items:
+      changes[item.product_id] = changes.get(item.product_id, 0) - item.quantity
+    for product_id, quantity in lines:
+      changes[product_id] = changes.get(product_id, 0) + quantity
+
+    products = {product.id: product for product in
+      db.session.query(Product).filter(Product.id.in_(list(changes)))}
+    for product_id, _ in lines:
+      if product_id not in products:
+        raise ValueError(f'product {product_id} does not exist')
+
+    take_stock({product_id: change for product_id, change in changes.items()
+      if product_id in products and products[product_id].stock is not None})
+
+    self.items = [
+      OrderItem(product=products[product_id], quantity=quantity, unit_price=products[product_id].price)
+      for product_id, quantity in lines]
+    self.cost = round(sum(item.quantity * item.unit_price for item in self.items), 2)
+    # kept for clients that still read the json copy
+    self.items_json = json.dumps([item.format() for item in self.items])
+
+  '''
+  place(customer_id, items)
+      creates an order from a list of {'product_id', 'quantity'} objects in one short transaction
+      of plain statements: one query prices the lines and reads the stock, the order and its items
+      are inserted, then the stock of each tracked product is taken with a conditional UPDATE
+      that matches no row when too little is left, so nothing waits on a lock held across the
+      request and the locks it takes are released by the commit right after it
+      raises OutOfStock, or ValueError for invalid items, without writing anything
+      returns the formatted order
+  '''
+  @classmethod
+  def place(cls, customer_id, items):
+    quantities = {}
+    for product_id, quantity in parse_order_items(items):
+      quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+    products = Product.__table__
+    session = db.session
+    try:
+      found = {id: (name, price, stock) for id, name, price, stock in session.execute(
+        select(products.c.id, products.c.name, products.c.price, products.c.stock)
+        .where(products.c.id.in_(list(quantities))))}
+      for product_id in quantities:
+        if product_id not in found:
+          raise ValueError(f'product {product_id} does not exist')
+      tracked = sorted(product_id for product_id in quantities if found[product_id][2] is not None)
+      short = [product_id for product_id in tracked if found[product_id][2] < quantities[product_id]]
+      if short:
+        raise OutOfStock(short)
+
+      lines = [{
+        'product_id': product_id,
+        'name': found[product_id][0],
+        'quantity': quantity,
+        'unit_price': found[product_id][1]
+      } for product_id, quantity in quantities.items()]
+      order = {
+        'customer': customer_id,
+        'items_json': json.dumps(lines),
+        'cost': round(sum(line['quantity'] * line['unit_price'] for line in lines), 2),
+        'datetime': datetime.datetime.utcnow(),
+        'status': 'pending'
+      }
+      order['id'] = session.execute(cls.__table__.insert().values(order)).inserted_primary_key[0]
+      session.execute(OrderItem.__table__.insert(), [{
+        'order_id': order['id'],
+        'product_id': line['product_id'],
+        'quantity': line['quantity'],
+        'unit_price': line['unit_price']
+      } for line in lines])
+
+      take_stock({product_id: quantities[product_id] for product_id in tracked})
+
+      cls.mark_changed()
+      cls.count_inserted(1)
+      OrderItem.mark_changed()
+      OrderItem.count_inserted(len(lines))
+      session.commit()
+    except Exception:
+      session.rollback()
+      raise
+
+    formatted = {column: order[column] for column in cls.format_columns}
+    formatted['items'] = lines
+    return formatted
+
+  '''
+  get_for_update(id)
+      the order with its row locked until the transaction ends, so changes to its items take turns
+  '''
+  @classmethod
+  def get_for_update(cls, id):
+    return db.session.query(cls).with_for_update().populate_existing().get(id)
+
+  '''
+  delete(order)
+      deletes the order and gives the stock of its items back in the same transaction
+  '''
+  @classmethod
+  def delete(cls, order):
+    quantities = {}
+    for item in order.items:
+      quantities[item.product_id] = quantities.get(item.product_id, 0) - item.quantity
+    try:
+      take_stock(quantities)
+      db.session.delete(order)
+      db.session.commit()
+    except Exception:
+      db.session.rollback()
+      raise
+
   def pretty_print_items(self):
-    items = json.loads(self.items_json)
-    pretty_items = ""
-    for item in items:
-      pretty_items += f"{item['name']} x{item['quantity']}, "
-    
-    return pretty_items[:-2]
+    return ", ".join(f"{item.product.name} x{item.quantity}" for item in self.items)
+
+
+  def format(self, fieldset=None):
+    data = self.encode_columns(fieldset)
+    if fieldset is None or fieldset.expands('items'):
+      data['items'] = [item.format() for item in self.items]
+    elif fieldset.includes('items'):
+      data['items'] = [item.format_reference() for item in self.items]
+    return data
+
+'''
+OutOfStock
+    raised when an order asks for more units of some products than are left
+'''
+class OutOfStock(ValueError):
+  def __init__(self, product_ids):
+    super().__init__(f'not enough stock of products {product_ids}')
+    self.product_ids = product_ids
 
+'''
+take_stock(quantities)
+    moves the stock of products by {product_id: quantity}, one conditional UPDATE each in id order
+    so two transactions over the same products cannot deadlock
+    taking stock matches no row when too little is left, a negative quantity gives stock back,
+    products whose stock is not tracked are never changed so only tracked ones may be taken from
+    raises OutOfStock, the caller rolls back
+'''
+def take_stock(quantities):
+  products = Product.__table__
+  take = products.update() \
+    .where(products.c.id == bindparam('take_id')) \
+    .where(products.c.stock >= bindparam('take_quantity')) \
+    .values(stock=products.c.stock - bindparam('take_quantity'))
+  moved = False
+  for product_id in sorted(quantities):
+    quantity = quantities[product_id]
+    if not quantity:
+      continue
+    taken = db.session.execute(take, {'take_id': product_id, 'take_quantity': quantity}).rowcount
+    if not taken and quantity > 0:
+      raise OutOfStock([product_id])
+    moved = moved or bool(taken)
+  if moved:
+    Product.mark_changed()
+
+'''
+parse_order_items(items)
+    the (product_id, quantity) pairs of a list of {'product_id', 'quantity'} objects or its json
+    raises ValueError if an item is invalid
+'''
+def parse_order_items(items):
+  if isinstance(items, str):
+    try:
+      items = json.loads(items)
+    except ValueError:
+      raise ValueError('items must be a list')
+  if not isinstance(items, list) or not items:
+    raise ValueError('items must be a non empty list')
+
+  lines = []
+  for item in items:
+    if not isinstance(item, dict):
+      raise ValueError('each item must be an object')
+    product_id = item.get('product_id', item.get('id', None))
+    quantity = item.get('quantity', 1)
+    if not isinstance(product_id, int) or not isinstance(quantity, int) or quantity < 1:
+      raise ValueError('each item needs an integer product_id and a positive quantity')
+    lines.append((product_id, quantity))
+  return lines
+
+'''
+A line item of an order
+'''
+class OrderItem(db.Model, DefaultTableInterface):
+  __tablename__ = 'OrderItems'
+  __table_args__ = (
+    db.Index('ix_OrderItems_order_id', 'order_id'),
+    db.Index('ix_OrderItems_product_id_order_id', 'product_id', 'order_id'),
+  )
+
+  id = Column(db.Integer, primary_key=True)
+  order_id = Column(db.Integer, db.ForeignKey('Orders.id'), nullable=False)
+  product_id = Column(db.Integer, db.ForeignKey('Products.id'), nullable=False)
+  quantity = Column(db.Integer, nullable=False, default=1)
+  unit_price = Column(db.Float, nullable=False, default=0.0)
+
+  product = db.relationship('Product', lazy='select')
+
+  def __init__(self, product, quantity, unit_price):
+    self.product = product
+    self.quantity = quantity
+    self.unit_price = unit_price
+
+  '''
+  sales(product_id)
+      the units sold and the revenue of a product, summed over the product_id index
+  '''
+  @classmethod
+  def sales(cls, product_id):
+    units, revenue = db.session.query(
+      func.coalesce(func.sum(cls.quantity), 0),
+      func.coalesce(func.sum(cls.quantity * cls.unit_price), 0.0)).filter(cls.product_id == product_id).one()
+    return units, revenue
 
   def format(self):
     return {
-      'id': self.id,
-      'customer': self.customer,
-      'items_json': self.items_json,
-      'cost': self.cost,
-      'datetime': self.datetime,
-      'status': self.status}
\ No newline at end of file
+      'product_id': self.product.id,
+      'name': self.product.name,
+      'quantity': self.quantity,
+      'unit_price': self.unit_price}
+
+  # the line without its product's name, so the product is not loaded
+  def format_reference(self):
+    return {
+      'product_id': self.product_id,
+      'quantity': self.quantity,
+      'unit_price': self.unit_price}
+
+
+'''
+backfill_order_items(batch_size)
+    copies the line items of orders written before the OrderItems table existed out of items_json
+    items are matched to products by product_id (or id), falling back to the product name
+    returns the number of orders backfilled, items written and orders that could not be parsed
+'''
+def backfill_order_items(batch_size=500):
+  backfilled = written = skipped = 0
+  last_id = 0
+  while True:
+    orders = db.session.query(Order.id, Order.items_json) \
+      .filter(Order.id > last_id, ~Order.items.any()) \
+      .order_by(Order.id).limit(batch_size).all()
+    if not orders:
+      return backfilled, written, skipped
+    last_id = orders[-1].id
+
+    parsed = {}
+    for order_id, items_json in orders:
+      try:
+        items = json.loads(items_json)
+      except ValueError:
+        items = None
+      if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        skipped += 1
+        continue
+      parsed[order_id] = items
+
+    # resolve every product of the batch in two IN queries
+    ids = {item.get('product_id', item.get('id')) for items in parsed.values() for item in items}
+    names = {item.get('name') for items in parsed.values() for item in items}
+    by_id = dict(db.session.query(Product.id, Product.price).filter(Product.id.in_(ids - {None})))
+    by_name = {name: (id, price) for id, name, price in
+      db.session.query(Product.id, Product.name, Product.price).filter(Product.name.in_(names - {None}))}
+
+    rows = []
+    for order_id, items in parsed.items():
+      for item in items:
+        product_id = item.get('product_id', item.get('id'))
+        if product_id in by_id:
+          price = by_id[product_id]
+        elif item.get('name') in by_name:
+          product_id, price = by_name[item['name']]
+        else:
+          continue
+        rows.append({
+          'order_id': order_id,
+          'product_id': product_id,
+          'quantity': item.get('quantity', 1),
+          'unit_price': item.get('unit_price', item.get('price', price)) or 0.0})
+      backfilled += 1
+
+    if rows:
+      db.session.execute(OrderItem.__table__.insert(), rows)
+      written += len(rows)
+      OrderItem.mark_changed()
+    db.session.commit()
+    OrderItem.invalidate_count()
+
+
+'''
+The schema version of the database, a single row written by create_schema
+'''
+class SchemaVersion(db.Model):
+  __tablename__ = 'SchemaVersion'
+
+  id = Column(db.Integer, primary_key=True)
+  version = Column(db.Integer, nullable=False)
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+'''
+create_schema()
+    creates the missing tables, columns and indexes and records SCHEMA_VERSION
+'''
+def create_schema():
+  db.create_all()
+  added = set()
+  for table, column, kind in SCHEMA_COLUMNS:
+    if column not in {existing['name'] for existing in inspect(db.engine).get_columns(table)}:
+      with db.engine.begin() as connection:
+        connection.execute(text(f'ALTER TABLE "{table}" ADD COLUMN {column} {kind}'))
+      added.add(column)
+  if added & {'review_count', 'rating_sum', 'rating_avg'}:
+    # products that already had reviews start from their real aggregates
+    recompute_rating_aggregates()
+    db.session.remove()
+  # create_all only indexes the tables it creates, indexes declared later are added here
+  for table in db.Model.metadata.sorted_tables:
+    for index in table.indexes:
+      index.create(db.engine, checkfirst=True)
+  # the search index is made with the Products table, an older Products table gets it here
+  with db.engine.begin() as connection:
+    install_product_search(connection, rebuild=not product_search_installed(connection))
+  versions = SchemaVersion.__table__
+  now = datetime.datetime.utcnow()
+  with db.engine.begin() as connection:
+    updated = connection.execute(versions.update().where(versions.c.id == 1)
+      .values(version=SCHEMA_VERSION, updated_at=now)).rowcount
+    if not updated:
+      connection.execute(versions.insert().values(id=1, version=SCHEMA_VERSION, updated_at=now))
+
+'''
+check_schema()
+    one query comparing the schema version of the database with SCHEMA_VERSION
+    raises RuntimeError when they differ, so a worker never serves a schema it does not know
+'''
+def check_schema():
+  versions = SchemaVersion.__table__
+  try:
+    with db.engine.connect() as connection:
+      version = connection.execute(versions.select().with_only_columns(versions.c.version)
+        .where(versions.c.id == 1)).scalar()
+  except (OperationalError, ProgrammingError) as error:
+    raise RuntimeError(f'cannot read the schema version, run python manage.py create_schema ({error.orig})')
+  if version != SCHEMA_VERSION:
+    raise RuntimeError(f'the database schema is at version {version} but this app needs {SCHEMA_VERSION}, '
+      'run python manage.py create_schema')
+
+'''
+The response of a request sent with an Idempotency-Key, see idempotency.py
+the row is written when the request starts and holds the key until locked_until,
+the response is filled in once the request completes
+'''
+class IdempotencyKey(db.Model):
+  __tablename__ = 'IdempotencyKeys'
+  __table_args__ = (db.Index('ix_IdempotencyKeys_expires_at', 'expires_at'),)
+
+  key = Column(String, primary_key=True)
+  fingerprint = Column(String, nullable=False)
+  status = Column(db.Integer)
+  content_type = Column(String)
+  body = Column(db.LargeBinary)
+  locked_until = Column(db.DateTime, nullable=False)
+  expires_at = Column(db.DateTime, nullable=False)
+
+'''
+A version counter per table, bumped after every commit that writes to the table
+used to answer conditional requests without querying the table itself
+'''
+class TableVersion(db.Model):
+  __tablename__ = 'TableVersions'
+
+  table_name = Column(String, primary_key=True)
+  version = Column(db.Integer, nullable=False, default=0)
+  updated_at = Column(db.DateTime, nullable=False, default=datetime.datetime.utcnow)
+
+'''
+table_versions(tables)
+    returns {table name: (version, updated_at)}, tables that were never written are left out
+    the versions are remembered in the session for known_table_version()
+'''
+def table_versions(tables):
+  rows = db.session.query(TableVersion.table_name, TableVersion.version, TableVersion.updated_at) \
+    .filter(TableVersion.table_name.in_(tables))
+  versions = {table_name: (version, updated_at) for table_name, version, updated_at in rows}
+  known = db.session.info.setdefault('table_versions', {})
+  for table in tables:
+    known[table] = versions.get(table, (0, None))[0]
+  return versions
+
+'''
+known_table_version(table)
+    the version of table the current session read with table_versions(), None if it did not
+    cached values are checked against it, so a response never carries the validators of data
+    newer than what the caches of this worker hold
+'''
+def known_table_version(table):
+  return db.session.info.get('table_versions', {}).get(table)
+
+'''
+bump_table_versions(tables)
+    increments the version of each table in its own short transaction
+'''
+def bump_table_versions(tables):
+  versions = TableVersion.__table__
+  now = datetime.datetime.utcnow()
+  for table_name in sorted(tables):
+    bump = versions.update().where(versions.c.table_name == table_name) \
+      .values(version=versions.c.version + 1, updated_at=now)
+    with db.engine.begin() as connection:
+      if connection.execute(bump).rowcount:
+        continue
+    try:
+      with db.engine.begin() as connection:
+        connection.execute(versions.insert().values(table_name=table_name, version=1, updated_at=now))
+    except IntegrityError:
+      # another worker created the row first
+      with db.engine.begin() as connection:
+        connection.execute(bump)
+
+
+'''
+Product search index
+    postgres keeps a generated tsvector column with a gin index,
+    sqlite keeps an external content fts5 table in sync with triggers
+    both are maintained by the database itself so bulk statements stay in sync too
+'''
+PRODUCT_SEARCH_DDL = {
+  'postgresql': [
+    '''ALTER TABLE "Products" ADD COLUMN IF NOT EXISTS search_vector tsvector
+      GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(name, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B')) STORED''',
+    'CREATE INDEX IF NOT EXISTS "ix_Products_search_vector" ON "Products" USING gin (search_vector)',
+  ],
+  'sqlite': [
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS "ProductsSearch"
+      USING fts5(name, description, content='Products', content_rowid='id')''',
+    '''CREATE TRIGGER IF NOT EXISTS "Products_search_insert" AFTER INSERT ON "Products" BEGIN
+      INSERT INTO "ProductsSearch"(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS "Products_search_delete" AFTER DELETE ON "Products" BEGIN
+      INSERT INTO "ProductsSearch"("ProductsSearch", rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS "Products_search_update" AFTER UPDATE OF name, description ON "Products" BEGIN
+      INSERT INTO "ProductsSearch"("ProductsSearch", rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+      INSERT INTO "ProductsSearch"(rowid, name, description) VALUES (new.id, new.name, new.description);
+    END''',
+  ],
+}
+
+PRODUCT_SEARCH_REBUILD = {
+  'sqlite': ['INSERT INTO "ProductsSearch"("ProductsSearch") VALUES (\'rebuild\')'],
+}
+
+'''
+install_product_search(connection, rebuild)
+    creates the search index for the connection's dialect if it is missing
+    rebuild re-indexes rows written before the index existed
+'''
+def install_product_search(connection, rebuild=False):
+  dialect = connection.dialect.name
+  statements = PRODUCT_SEARCH_DDL.get(dialect, [])
+  if rebuild:
+    statements = statements + PRODUCT_SEARCH_REBUILD.get(dialect, [])
+  for statement in statements:
+    connection.execute(text(statement))
+
+'''
+product_search_installed(connection)
+    whether the search index of the connection's dialect exists, dialects without one always have it
+'''
+def product_search_installed(connection):
+  dialect = connection.dialect.name
+  if dialect == 'postgresql':
+    return 'search_vector' in {column['name'] for column in inspect(connection).get_columns('Products')}
+  if dialect == 'sqlite':
+    return inspect(connection).has_table('ProductsSearch')
+  return True
+
+@event.listens_for(Product.__table__, 'after_create')
+def _create_product_search(target, connection, **kw):
+  install_product_search(connection)
+
+
+'''
+Rating aggregates
+    review inserts, updates and deletes adjust the aggregates of their product
+    with a single relative UPDATE on the flushing connection, so they commit or roll back with the review
+'''
+def adjust_rating_aggregates(connection, product_id, count, rating):
+  products = Product.__table__
+  review_count = products.c.review_count + count
+  rating_sum = products.c.rating_sum + rating
+  connection.execute(products.update().where(products.c.id == product_id).values(
+    review_count=review_count,
+    rating_sum=rating_sum,
+    rating_avg=case((review_count > 0, rating_sum / review_count), else_=None)))
+
+def _committed_value(target, attribute):
+  history = inspect(target).attrs[attribute].history
+  if history.deleted:
+    return history.deleted[0]
+  return getattr(target, attribute)
+
+@event.listens_for(ProductReview, 'after_insert')
+def _rate_insert(mapper, connection, target):
+  if target.rating is not None:
+    adjust_rating_aggregates(connection, target.product, 1, target.rating)
+
+@event.listens_for(ProductReview, 'after_update')
+def _rate_update(mapper, connection, target):
+  old_product, old_rating = _committed_value(target, 'product'), _committed_value(target, 'rating')
+  if old_product == target.product and old_rating == target.rating:
+    return
+  if old_rating is not None:
+    adjust_rating_aggregates(connection, old_product, -1, -old_rating)
+  if target.rating is not None:
+    adjust_rating_aggregates(connection, target.product, 1, target.rating)
+
+@event.listens_for(ProductReview, 'after_delete')
+def _rate_delete(mapper, connection, target):
+  rating = _committed_value(target, 'rating')
+  if rating is not None:
+    adjust_rating_aggregates(connection, _committed_value(target, 'product'), -1, -rating)
+
+'''
+recompute_rating_aggregates()
+    rebuilds every product's aggregates from its reviews, for data written before they were maintained
+'''
+def recompute_rating_aggregates():
+  products = Product.__table__
+  reviews = ProductReview.__table__
+  rated = reviews.c.product == products.c.id
+  rated = and_(rated, reviews.c.rating.isnot(None))
+  review_count = db.select(func.count(reviews.c.id)).where(rated).scalar_subquery()
+  rating_sum = db.select(func.coalesce(func.sum(reviews.c.rating), 0.0)).where(rated).scalar_subquery()
+  rating_avg = db.select(func.avg(reviews.c.rating)).where(rated).scalar_subquery()
+  db.session.execute(products.update().values(
+    review_count=review_count, rating_sum=rating_sum, rating_avg=rating_avg))
+  Product.mark_changed()
+  db.session.commit()
+
+
+'''
+Row count maintenance
+    inserts and deletes are tallied on the session as they flush,
+    and only applied to the cached counts once the transaction commits
+'''
+def _add_row_count_delta(target, delta):
+  session = object_session(target)
+  if session is None or not isinstance(target, DefaultTableInterface):
+    return
+  deltas = session.info.setdefault('row_count_deltas', {})
+  table = target.__tablename__
+  deltas[table] = deltas.get(table, 0) + delta
+
+@event.listens_for(db.Model, 'after_insert', propagate=True)
+def _count_insert(mapper, connection, target):
+  _add_row_count_delta(target, 1)
+
+@event.listens_for(db.Model, 'after_delete', propagate=True)
+def _count_delete(mapper, connection, target):
+  _add_row_count_delta(target, -1)
+
+@event.listens_for(Session, 'after_commit')
+def _apply_row_count_deltas(session):
+  deltas = session.info.pop('row_count_deltas', None)
+  if deltas:
+    row_counts.apply(deltas)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_row_count_deltas(session):
+  session.info.pop('row_count_deltas', None)
+
+
+'''
+Table version maintenance
+    the tables written by a transaction are collected as it flushes
+    and their versions are bumped after it commits, outside of its locks
+'''
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_tables(session, flush_context):
+  changed = session.info.setdefault('changed_tables', set())
+  for target in list(session.new) + list(session.dirty) + list(session.deleted):
+    if isinstance(target, DefaultTableInterface):
+      changed.add(target.__tablename__)
+      changed.update(target.also_changes)
+
+@event.listens_for(Session, 'after_commit')
+def _bump_changed_tables(session):
+  changed = session.info.pop('changed_tables', None)
+  if changed:
+    bump_table_versions(changed)
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_tables(session):
+  session.info.pop('changed_tables', None)
+  session.info.pop('stale_cache_rows', None)
+
+
+'''
+Row cache invalidation
+    updated and deleted rows of cached models are dropped from their cache once the write commits
+'''
+@event.listens_for(Session, 'after_flush')
+def _collect_stale_cache_rows(session, flush_context):
+  stale = session.info.setdefault('stale_cache_rows', {})
+  for target in list(session.dirty) + list(session.deleted):
+    if isinstance(target, DefaultTableInterface) and type(target).cache is not None:
+      stale.setdefault(type(target), set()).add(target.id)
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_stale_cache_rows(session):
+  stale = session.info.pop('stale_cache_rows', None)
+  for model, ids in (stale or {}).items():
+    model.cache.invalidate(ids)
\ No newline at end of file
@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from functools import wraps
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeout
+from sqlalchemy.orm import Session
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+'''
+Connection pool configuration
+
+every setting is read from the app config (e.g. the test_config passed to create_app) first,
+then from the environment variable of the same name, and otherwise left to SQLAlchemy's default
+    DB_POOL_SIZE, DB_MAX_OVERFLOW    connections kept open, and allowed on top of them under load
+    DB_POOL_TIMEOUT                  seconds a request waits for a connection before failing
+    DB_POOL_RECYCLE                  seconds after which a connection is replaced
+    DB_POOL_PRE_PING                 test connections on checkout so stale ones are replaced
+    DB_STATEMENT_TIMEOUT_MS          postgres statement timeout for every transaction
+'''
+POOL_SETTINGS = (
+    ('DB_POOL_SIZE', 'pool_size', int),
+    ('DB_MAX_OVERFLOW', 'max_overflow', int),
+    ('DB_POOL_TIMEOUT', 'pool_timeout', float),
+    ('DB_POOL_RECYCLE', 'pool_recycle', int),
+    ('DB_POOL_PRE_PING', 'pool_pre_ping', lambda value: str(value).lower() in ('1', 'true', 'yes')),
+)
+
+
+def setting(config, name):
+    value = config.get(name, None)
+    if value is None:
+        value = os.environ.get(name, None)
+    return value
+
+
+'''
+PoolMetrics
+    counters shared by every metered pool of the process
+'''
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.connects = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def record_checkout(self, waited, failed):
+        with self._lock:
+            if failed:
+                self.checkout_failures += 1
+            else:
+                self.checkouts += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def record(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'checkout_failures': self.checkout_failures,
+                'wait_seconds_total': round(self.wait_seconds, 6),
+                'wait_seconds_max': round(self.max_wait_seconds, 6),
+                'connects': self.connects,
+                'invalidations': self.invalidations,
+            }
+
+
+pool_metrics = PoolMetrics()
+
+
+'''
+MeteredQueuePool
+    a QueuePool that times how long each checkout waited for a connection
+    and counts the connections it opens and invalidates
+'''
+class MeteredQueuePool(QueuePool):
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeout:
+            pool_metrics.record_checkout(time.perf_counter() - started, failed=True)
+            raise
+        pool_metrics.record_checkout(time.perf_counter() - started, failed=False)
+        return connection
+
+    def _create_connection(self):
+        pool_metrics.record('connects')
+        return super()._create_connection()
+
+    def _invalidate(self, connection, exception=None, _checkin=True):
+        pool_metrics.record('invalidations')
+        return super()._invalidate(connection, exception, _checkin)
+
+
+class MeteredAsyncAdaptedQueuePool(AsyncAdaptedQueuePool, MeteredQueuePool):
+    pass
+
+
+def is_async_url(database_uri):
+    # the drivers asgi.py swaps in, their requests all run on the event loop thread
+    return '+asyncpg' in database_uri or '+aiosqlite' in database_uri
+
+
+'''
+engine_options(config, database_uri)
+    the create_engine options for the configured pool
+    sqlite keeps Flask-SQLAlchemy's default pool unless a pool size is configured
+'''
+def engine_options(config, database_uri):
+    options = {}
+    for name, option, convert in POOL_SETTINGS:
+        value = setting(config, name)
+        if value is not None:
+            options[option] = convert(value)
+
+    if database_uri.startswith('sqlite') and 'pool_size' not in options:
+        for option in ('max_overflow', 'pool_timeout'):
+            options.pop(option, None)
+        return options
+
+    if is_async_url(database_uri):
+        options['poolclass'] = MeteredAsyncAdaptedQueuePool
+    else:
+        options['poolclass'] = MeteredQueuePool
+    return options
+
+
+'''
+pool_status(engine)
+    the live state of an engine's pool together with the process wide counters
+'''
+def pool_status(engine):
+    pool = engine.pool
+    status = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+        })
+    status.update(pool_metrics.snapshot())
+    return status
+
+
+'''
+@statement_timeout(milliseconds)
+    overrides DB_STATEMENT_TIMEOUT_MS for the requests of one route, None disables it
+'''
+def statement_timeout(milliseconds):
+    def statement_timeout_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            g.statement_timeout = milliseconds
+            return f(*args, **kwargs)
+
+        return wrapper
+    return statement_timeout_decorator
+
+
+def current_statement_timeout():
+    if not has_app_context():
+        return None
+    if 'statement_timeout' in g:
+        return g.statement_timeout
+    return setting(current_app.config, 'DB_STATEMENT_TIMEOUT_MS')
+
+
+@event.listens_for(Session, 'after_begin')
+def _apply_statement_timeout(session, transaction, connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    timeout = current_statement_timeout()
+    if timeout is not None:
+        # SET LOCAL ends with the transaction, so the pooled connection is not affected
+        connection.exec_driver_sql(f'SET LOCAL statement_timeout = {int(timeout)}')
\ No newline at end of file
@@ -0,0 +1,209 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from flask import current_app, has_app_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from pool import engine_options, setting
+
+'''
+Read replicas
+
+    DB_REPLICA_URLS=postgresql://replica-1/shop,postgresql://replica-2/shop
+
+the get_all, get_page, get_many, count_total and get_one_or_none reads of GET requests go to the
+replicas in turn, everything else goes to the primary
+    DB_REPLICA_STICKY_SECONDS   after a client's request wrote, its reads go to the primary for
+                                this long (a cookie carries the deadline), 5 by default
+    DB_REPLICA_RETRY_SECONDS    a replica that failed a read is left out this long, 30 by default
+a session that has flushed writes reads from the primary until it ends, and a read that fails
+on a replica is retried on the primary
+a view wrapped in @replica_read, as @conditional does, reads everything from the one replica it
+picked, so the table versions its validators come from match its body
+'''
+
+DEFAULT_STICKY_SECONDS = 5
+DEFAULT_RETRY_SECONDS = 30
+STICKY_COOKIE = 'read_primary_until'
+READ_METHODS = ('GET', 'HEAD')
+
+
+'''
+RoutingSession
+    a session that sends its queries to the replica engine in session.info['replica_bind'] while
+    one is set, flushes always go to the primary
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica_bind', None)
+        if replica is not None and not self._flushing:
+            return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+'''
+ReplicaRouter
+    the replica engines of an app's db, handed out round robin, skipping those marked down
+'''
+class ReplicaRouter:
+    def __init__(self, db, engines, retry_seconds=DEFAULT_RETRY_SECONDS, sticky_seconds=DEFAULT_STICKY_SECONDS):
+        self.db = db
+        self.engines = list(engines)
+        self.retry_seconds = retry_seconds
+        self.sticky_seconds = sticky_seconds
+        self.down_until = {}
+        self.fallbacks = 0
+        self._turn = itertools.count()
+        self._lock = threading.Lock()
+
+    '''
+    choose()
+        the next healthy replica engine, None when every replica is down
+    '''
+    def choose(self):
+        now = time.monotonic()
+        start = next(self._turn)
+        for offset in range(len(self.engines)):
+            engine = self.engines[(start + offset) % len(self.engines)]
+            if self.down_until.get(engine, 0) <= now:
+                return engine
+        return None
+
+    def mark_down(self, engine):
+        with self._lock:
+            self.down_until[engine] = time.monotonic() + self.retry_seconds
+            self.fallbacks += 1
+
+    def status(self):
+        now = time.monotonic()
+        return {
+            'replicas': len(self.engines),
+            'healthy': sum(1 for engine in self.engines if self.down_until.get(engine, 0) <= now),
+            'fallbacks': self.fallbacks,
+        }
+
+
+def current_router():
+    if not has_app_context():
+        return None
+    return current_app.extensions.get('replicas', None)
+
+
+'''
+@replica_read
+    runs a read (a classmethod, or a whole view) on a replica when the current session may read
+    from one, on the primary otherwise or when the replica fails
+    the reads it makes, @replica_read ones included, stay on the replica it picked
+'''
+def replica_read(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        router = current_router()
+        if router is None:
+            return f(*args, **kwargs)
+        session = router.db.session()
+        if not session.info.get('replica_reads', False) or 'replica_bind' in session.info:
+            return f(*args, **kwargs)
+        engine = router.choose()
+        if engine is None:
+            return f(*args, **kwargs)
+
+        session.info['replica_bind'] = engine
+        try:
+            return f(*args, **kwargs)
+        except OperationalError:
+            router.mark_down(engine)
+        finally:
+            session.info.pop('replica_bind', None)
+        session.rollback()
+        with primary_reads(session):
+            return f(*args, **kwargs)
+
+    return wrapper
+
+
+'''
+primary_reads(session)
+    reads inside the block go to the primary, for results that outlive the request (caches)
+    the @replica_read methods called inside it do not pick a replica again
+'''
+@contextmanager
+def primary_reads(session):
+    replica = session.info.pop('replica_bind', None)
+    replica_reads = session.info.get('replica_reads', None)
+    session.info['replica_reads'] = False
+    try:
+        yield session
+    finally:
+        if replica is not None:
+            session.info['replica_bind'] = replica
+        # a session that flushed writes in the block stays on the primary
+        if not session.info.get('wrote', False):
+            if replica_reads is None:
+                session.info.pop('replica_reads', None)
+            else:
+                session.info['replica_reads'] = replica_reads
+
+
+def configured_replica_urls(config):
+    urls = setting(config, 'DB_REPLICA_URLS') or ''
+    if not isinstance(urls, str):
+        return list(urls)
+    return [url.strip() for url in urls.split(',') if url.strip()]
+
+
+'''
+init_replicas(app, db, urls)
+    creates the replica engines and installs the request hooks that decide where reads go
+    returns the app's ReplicaRouter, or None without replicas
+'''
+def init_replicas(app, db, urls):
+    urls = [url.replace('postgres://', 'postgresql://', 1) if url.startswith('postgres://') else url for url in urls]
+    if not urls:
+        return None
+
+    router = ReplicaRouter(db,
+        (create_engine(url, **engine_options(app.config, url)) for url in urls),
+        retry_seconds=float(setting(app.config, 'DB_REPLICA_RETRY_SECONDS') or DEFAULT_RETRY_SECONDS),
+        sticky_seconds=float(setting(app.config, 'DB_REPLICA_STICKY_SECONDS') or DEFAULT_STICKY_SECONDS))
+    app.extensions['replicas'] = router
+
+    @app.before_request
+    def route_reads():
+        session = db.session()
+        if 'replica_reads' in session.info:
+            # a sub-request of a batch reads where its batch does
+            return
+        try:
+            sticky = float(request.cookies.get(STICKY_COOKIE, 0)) > time.time()
+        except ValueError:
+            sticky = False
+        session.info['replica_reads'] = request.method in READ_METHODS and not sticky
+
+    @app.after_request
+    def stick_to_primary(response):
+        session = db.session()
+        if session.info.get('wrote', False) or \
+                (request.method not in READ_METHODS and response.status_code < 400):
+            until = time.time() + router.sticky_seconds
+            response.set_cookie(STICKY_COOKIE, f'{until:.3f}', max_age=int(router.sticky_seconds) + 1, httponly=True)
+        return response
+
+    return router
+
+
+@event.listens_for(Session, 'after_flush')
+def _read_own_writes(session, flush_context):
+    # a lagging replica would not have them yet
+    session.info['wrote'] = True
+    session.info['replica_reads'] = False
\ No newline at end of file
@@ -0,0 +1,92 @@
+import datetime
+import decimal
+import json
+import math
+from operator import attrgetter
+from flask import Response
+from sqlalchemy import Float
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+'''
+RowEncoder
+    copies a fixed list of attributes of a model row into a dict
+    the attribute getter and the float columns are worked out once per model, not once per row
+    floats that are not finite become null so every backend writes valid json
+    no attributes give an empty dict, for fields that are all computed or expanded
+'''
+class RowEncoder:
+    def __init__(self, model, names):
+        self.keys = tuple(names)
+        if not names:
+            self.getter = lambda row: ()
+        else:
+            getter = attrgetter(*names)
+            self.getter = getter if len(names) != 1 else (lambda row: (getter(row),))
+        columns = model.__table__.columns
+        self.float_positions = tuple(
+            index for index, name in enumerate(names)
+            if name in columns and isinstance(columns[name].type, Float))
+
+    def __call__(self, row):
+        values = self.getter(row)
+        if self.float_positions:
+            values = list(values)
+            for index in self.float_positions:
+                value = values[index]
+                if value is not None and not math.isfinite(value):
+                    values[index] = None
+        return dict(zip(self.keys, values))
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (set, frozenset)):
+        return list(value)
+    raise TypeError(f'{type(value).__name__} is not json serializable')
+
+
+def _finite(value):
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {key: _finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(item) for item in value]
+    return value
+
+
+'''
+dumps(value)
+    encodes a value as json bytes with orjson when it is installed and the standard library otherwise
+    both write datetimes as iso 8601 and non finite floats as null
+'''
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value, default=_default)
+    try:
+        text = json.dumps(value, default=_default, separators=(',', ':'), allow_nan=False)
+    except ValueError:
+        text = json.dumps(_finite(value), default=_default, separators=(',', ':'))
+    return text.encode('utf-8')
+
+
+'''
+jsonify(*args, **kwargs)
+    a drop in for flask.jsonify that encodes through dumps
+'''
+def jsonify(*args, **kwargs):
+    if args and kwargs:
+        raise TypeError('jsonify() takes either positional or keyword arguments, not both')
+    if len(args) == 1:
+        data = args[0]
+    else:
+        data = args or kwargs
+    return Response(dumps(data), mimetype='application/json')
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import create_app
+from models import db, row_counts, Brand, ProductCategory
+
+
+@pytest.fixture
+def app():
+    # the row count and dimension caches are per process, so each test starts them empty
+    row_counts.invalidate()
+    Brand.cache.invalidate()
+    ProductCategory.cache.invalidate()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'DB_SCHEMA': 'create'})
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
\ No newline at end of file
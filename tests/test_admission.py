@@ -0,0 +1,103 @@
+import json
+import time
+
+import pytest
+from flask import Flask
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+from admission import init_admission
+from app import create_app
+from auth import verified_tokens
+
+'''
+Admission control
+'''
+
+
+def make_app(**config):
+    return create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'DB_SCHEMA': 'create',
+        'ADMISSION_RATE': 0.001, 'ADMISSION_BURST': 1, **config})
+
+
+@pytest.fixture(autouse=True)
+def clear_tokens():
+    verified_tokens.clear()
+    yield
+    verified_tokens.clear()
+
+
+def get(app, address, **headers):
+    # the flask test client of this flask and werkzeug pair drops REMOTE_ADDR
+    environ = EnvironBuilder('/brands', headers=headers, environ_base={'REMOTE_ADDR': address}).get_environ()
+    _, status, _ = run_wsgi_app(app, environ)
+    return int(status.split()[0])
+
+
+def test_client_supplied_headers_do_not_pick_the_bucket():
+    app = make_app()
+
+    assert get(app, '10.0.0.1') == 200
+    assert get(app, '10.0.0.1', **{'X-Forwarded-For': '1.2.3.4'}) == 429
+    assert get(app, '10.0.0.1', **{'X-API-Key': 'made up'}) == 429
+    assert get(app, '10.0.0.1', Authorization='Bearer made-up') == 429
+    assert get(app, '10.0.0.2') == 200
+
+
+def test_trusted_proxy_hops_take_the_forwarded_address():
+    app = make_app(TRUSTED_PROXY_HOPS=1)
+
+    assert get(app, '10.0.0.1', **{'X-Forwarded-For': '1.2.3.4'}) == 200
+    assert get(app, '10.0.0.1', **{'X-Forwarded-For': '1.2.3.4'}) == 429
+    # only the last hop is trusted, an entry the client prepended is not
+    assert get(app, '10.0.0.1', **{'X-Forwarded-For': '9.9.9.9, 1.2.3.4'}) == 429
+    assert get(app, '10.0.0.1', **{'X-Forwarded-For': '5.6.7.8'}) == 200
+
+
+def test_verified_tokens_get_their_own_bucket():
+    app = make_app()
+    verified_tokens.put('verified', {'sub': 'user-1', 'exp': time.time() + 60})
+
+    assert get(app, '10.0.0.1') == 200
+    assert get(app, '10.0.0.1', Authorization='Bearer verified') == 200
+    assert get(app, '10.0.0.3', Authorization='Bearer verified') == 429
+
+
+def batch_of_brands(app, count):
+    body = json.dumps({'requests': [
+        {'method': 'POST', 'path': '/brands', 'body': {'name': f'brand {i}'}} for i in range(count)]})
+    environ = EnvironBuilder('/batch', method='POST', data=body, content_type='application/json',
+        environ_base={'REMOTE_ADDR': '10.0.0.1'}).get_environ()
+    app_iter, status, _ = run_wsgi_app(app, environ)
+    assert status.startswith('200')
+    return [response['status'] for response in json.loads(b''.join(app_iter))['responses']]
+
+
+def test_batch_sub_requests_each_take_a_token():
+    app = make_app(ADMISSION_BURST=3)
+
+    # the batch itself takes the first token
+    assert batch_of_brands(app, 20) == [200, 200] + [429] * 18
+
+
+def test_batch_sub_requests_are_capped_by_their_own_group():
+    app = make_app(ADMISSION_RATE=None, ADMISSION_CONCURRENCY='default=1')
+    admission = app.extensions['admission']
+
+    assert batch_of_brands(app, 3) == [200] * 3
+    admission.semaphores['default'].acquire()
+    try:
+        assert batch_of_brands(app, 3) == [503] * 3
+    finally:
+        admission.semaphores['default'].release()
+    assert admission.in_flight == {'default': 0}
+
+
+def test_the_asgi_mode_refuses_an_admission_queue():
+    app = Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite+aiosqlite://', ADMISSION_CONCURRENCY='orders=4',
+        ADMISSION_QUEUE_SECONDS=2)
+    with pytest.raises(ValueError):
+        init_admission(app)
+
+    app.config['ADMISSION_QUEUE_SECONDS'] = 0
+    assert init_admission(app) is not None
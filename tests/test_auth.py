@@ -0,0 +1,111 @@
+import json
+import time
+
+import pytest
+
+from auth import JWKSCache, VerifiedTokenCache
+
+'''
+JWKS and verified token caches, against a jwks.json file
+'''
+
+
+def jwk(kid):
+    return {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': f'n-{kid}', 'e': 'AQAB'}
+
+
+@pytest.fixture
+def jwks(tmp_path):
+    path = tmp_path / 'jwks.json'
+
+    def publish(*kids):
+        path.write_text(json.dumps({'keys': [jwk(kid) for kid in kids]}), encoding='utf-8')
+
+    publish('first')
+    cache = JWKSCache(path.as_uri(), ttl=100, refresh_after=50, min_refetch_interval=30)
+    fetches = []
+    fetch = cache.fetch
+    def counted_fetch():
+        fetches.append(time.monotonic())
+        fetch()
+    cache.fetch = counted_fetch
+    return cache, publish, fetches
+
+
+def age(cache, seconds):
+    cache.fetched_at = time.monotonic() - seconds
+
+
+def test_keys_are_fetched_once_within_the_ttl(jwks):
+    cache, publish, fetches = jwks
+
+    assert cache.get_key('first')['n'] == 'n-first'
+    assert cache.get_key('first')['n'] == 'n-first'
+    assert len(fetches) == 1
+
+
+def test_keys_past_the_ttl_are_fetched_inline(jwks):
+    cache, publish, fetches = jwks
+    cache.get_key('first')
+    publish('second')
+    age(cache, 100)
+
+    assert cache.get_key('second')['kid'] == 'second'
+    assert len(fetches) == 2
+
+
+def test_keys_past_refresh_after_are_refreshed_in_the_background(jwks):
+    cache, publish, fetches = jwks
+    cache.get_key('first')
+    publish('first', 'second')
+    age(cache, 60)
+
+    # the old keys answer at once, the new ones arrive with the background fetch
+    assert cache.get_key('first')['kid'] == 'first'
+    deadline = time.monotonic() + 5
+    while 'second' not in cache.keys and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert 'second' in cache.keys
+    assert len(fetches) == 2
+    assert cache.get_key('second')['kid'] == 'second'
+    assert len(fetches) == 2
+
+
+def test_an_unknown_kid_forces_one_refetch_per_interval(jwks):
+    cache, publish, fetches = jwks
+    cache.get_key('first')
+
+    assert cache.get_key('rotated') is None
+    assert len(fetches) == 2
+    assert cache.get_key('rotated') is None
+    assert cache.get_key('other') is None
+    assert len(fetches) == 2
+
+    publish('first', 'rotated')
+    cache.last_forced_fetch -= 30
+    assert cache.get_key('rotated')['kid'] == 'rotated'
+    assert len(fetches) == 3
+
+
+def test_verified_tokens_expire_at_exp():
+    tokens = VerifiedTokenCache()
+    tokens.put('live', {'sub': 'a', 'exp': time.time() + 60})
+    tokens.put('expired', {'sub': 'b', 'exp': time.time() - 1})
+    tokens.put('no exp', {'sub': 'c'})
+
+    assert tokens.get('live') == {'sub': 'a', 'exp': pytest.approx(time.time() + 60, abs=5)}
+    assert tokens.get('expired') is None
+    assert tokens.get('no exp') is None
+
+
+def test_verified_tokens_drop_the_least_recently_used():
+    tokens = VerifiedTokenCache(maxsize=2)
+    exp = time.time() + 60
+    tokens.put('a', {'exp': exp})
+    tokens.put('b', {'exp': exp})
+    tokens.get('a')
+    tokens.put('c', {'exp': exp})
+
+    assert tokens.get('a') is not None
+    assert tokens.get('b') is None
+    assert tokens.get('c') is not None
@@ -0,0 +1,46 @@
+from models import db, Brand, Product
+
+'''
+Bulk endpoints
+'''
+
+
+def seed(app):
+    with app.app_context():
+        db.session.add(Brand('brand'))
+        db.session.commit()
+        db.session.remove()
+
+
+def test_upsert_keeps_values_the_row_leaves_out(app, client):
+    seed(app)
+    response = client.post('/products/bulk', json=[
+        {'name': 'lamp', 'price': 10.0, 'brand': 1, 'description': 'a lamp', 'stock': 5, 'img_url': 'lamp.png'}])
+    assert response.get_json()['inserted'] == 1
+
+    response = client.post('/products/bulk?upsert=true', json=[{'name': 'lamp', 'price': 12.5, 'brand': 1}])
+    assert response.get_json()['updated'] == 1
+
+    with app.app_context():
+        product = Product.query.filter_by(name='lamp').one()
+        assert (product.price, product.stock, product.description, product.img_url) == (12.5, 5, 'a lamp', 'lamp.png')
+
+
+def test_upsert_clears_values_set_to_null(app, client):
+    seed(app)
+    client.post('/products/bulk', json=[{'name': 'lamp', 'price': 10.0, 'brand': 1, 'stock': 5}])
+    client.post('/products/bulk?upsert=true', json=[{'name': 'lamp', 'price': 10.0, 'brand': 1, 'stock': None}])
+
+    with app.app_context():
+        assert Product.query.filter_by(name='lamp').one().stock is None
+
+
+def test_insert_without_optional_values(app, client):
+    seed(app)
+    response = client.post('/products/bulk', json=[
+        {'name': 'lamp', 'price': 10.0, 'brand': 1},
+        {'name': 'desk', 'price': 80.0, 'brand': 1, 'stock': 2}])
+    assert response.get_json()['inserted'] == 2
+
+    with app.app_context():
+        assert {product.name: product.stock for product in Product.query} == {'lamp': None, 'desk': 2}
\ No newline at end of file
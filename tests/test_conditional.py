@@ -0,0 +1,59 @@
+import datetime
+
+from werkzeug.http import http_date
+
+from models import db, bump_table_versions, Brand, ProductCategory, Product, TableVersion
+
+'''
+Conditional list responses
+'''
+
+
+def set_brands_updated_at(app, updated_at):
+    with app.app_context():
+        db.session.merge(TableVersion(table_name='Brands', version=1, updated_at=updated_at))
+        db.session.commit()
+        db.session.remove()
+
+
+def test_if_modified_since_after_the_last_write(app, client):
+    set_brands_updated_at(app, datetime.datetime(2024, 1, 1, 12, 0, 0, 500000))
+    since = http_date(datetime.datetime(2024, 1, 1, 12, 0, 1))
+    assert client.get('/brands', headers={'If-Modified-Since': since}).status_code == 304
+
+
+def test_if_modified_since_in_the_second_of_the_last_write(app, client):
+    # the client may have fetched before the write in that same second
+    set_brands_updated_at(app, datetime.datetime(2024, 1, 1, 12, 0, 0, 500000))
+    since = http_date(datetime.datetime(2024, 1, 1, 12, 0, 0))
+    assert client.get('/brands', headers={'If-Modified-Since': since}).status_code == 200
+
+
+def write_from_another_worker(app, statement, table):
+    # a write whose cache invalidation never reaches this worker, only its version bump does
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql(statement)
+        bump_table_versions([table])
+
+
+def test_cached_rows_are_reloaded_at_a_new_table_version(app, client):
+    with app.app_context():
+        db.session.add(Brand('old name'))
+        db.session.add(ProductCategory('category'))
+        db.session.commit()
+        db.session.add(Product('lamp', 1.0, 1, 'description', 1))
+        db.session.commit()
+        db.session.remove()
+    first = client.get('/products')
+    assert first.get_json()['products'][0]['brand']['name'] == 'old name'
+    assert first.get_json()['total_products'] == 1
+
+    write_from_another_worker(app, 'UPDATE "Brands" SET name = \'new name\'', 'Brands')
+    write_from_another_worker(app,
+        'INSERT INTO "Products" (name, price, brand, product_category) VALUES (\'desk\', 2.0, 1, 1)', 'Products')
+
+    second = client.get('/products')
+    assert second.headers['ETag'] != first.headers['ETag']
+    assert [product['brand']['name'] for product in second.get_json()['products']] == ['new name', 'new name']
+    assert second.get_json()['total_products'] == 2
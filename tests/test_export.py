@@ -0,0 +1,33 @@
+import json
+
+from models import db, Brand, Product
+
+'''
+Export endpoints
+'''
+
+
+def seed(app):
+    with app.app_context():
+        db.session.add_all([Brand('first'), Brand('second')])
+        db.session.commit()
+        db.session.add_all([Product(f'product {i}', 1.0, 1 + i % 2, '', None) for i in range(4)])
+        db.session.commit()
+        db.session.remove()
+
+
+def rows(response):
+    return [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+
+def test_export_filters_and_resumes(app, client):
+    seed(app)
+    assert [row['id'] for row in rows(client.get('/export/products?brand=2'))] == [2, 4]
+    assert [row['id'] for row in rows(client.get('/export/products?after_id=2'))] == [3, 4]
+
+
+def test_export_rejects_values_the_column_cannot_hold(app, client):
+    seed(app)
+    assert client.get('/export/products?after_id=x').status_code == 400
+    assert client.get('/export/products?brand=abc').status_code == 400
+    assert client.get('/export/products?since=2020-01-01').status_code == 400
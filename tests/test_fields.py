@@ -0,0 +1,48 @@
+import pytest
+
+from models import db, Brand, ProductCategory, Product, Customer
+from serializers import RowEncoder
+
+'''
+Sparse fieldsets
+'''
+
+
+@pytest.fixture
+def app(app):
+    with app.app_context():
+        db.session.add(Brand('brand'))
+        db.session.add(ProductCategory('category'))
+        db.session.add(Customer('customer', 'customer@example.com', 'address'))
+        db.session.commit()
+        db.session.add(Product('product', 2.5, 1, 'description', 1, img_url='product.png'))
+        db.session.commit()
+        db.session.remove()
+    return app
+
+
+@pytest.mark.parametrize('path, fields', [
+    ('/products?fields=price_usd', {'id', 'price_usd'}),
+    ('/products?fields=brand&expand=brand', {'id', 'brand'}),
+    ('/products?fields=img_url', {'id', 'img_url'}),
+    ('/orders?fields=items', {'id', 'items'}),
+])
+def test_fields_without_plain_columns(client, path, fields):
+    assert client.post('/orders/', json={'customer_id': 1, 'items': [{'product_id': 1, 'quantity': 1}]}).status_code == 200
+
+    response = client.get(path)
+    assert response.status_code == 200
+    body = response.get_json()
+    [row] = body['products'] if 'products' in body else body['orders']
+    assert set(row) == fields
+    assert row['id'] == 1
+
+
+@pytest.mark.parametrize('path', ['/products?fields=', '/orders?fields=', '/products?fields=,'])
+def test_empty_fields_are_refused(client, path):
+    assert client.get(path).status_code == 400
+
+
+
+def test_row_encoder_without_names():
+    assert RowEncoder(Product, ())(Product('product', 2.5, 1, 'description', 1)) == {}
\ No newline at end of file
@@ -0,0 +1,50 @@
+import datetime
+
+import pytest
+
+from app import create_app
+from idempotency import MemoryIdempotencyStore, NEW, MISMATCH
+from models import db, Brand, ProductCategory, Product, Customer
+
+'''
+Idempotency keys
+'''
+
+
+@pytest.fixture
+def app():
+    app = create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite://', 'DB_SCHEMA': 'create', 'IDEMPOTENCY_STORE': 'memory'})
+    with app.app_context():
+        db.session.add(Brand('brand'))
+        db.session.add(ProductCategory('category'))
+        db.session.add_all([Customer(f'customer {i}', f'customer{i}@example.com', 'address') for i in range(2)])
+        db.session.commit()
+        db.session.add(Product('product', 1.0, 1, 'description', 1))
+        db.session.commit()
+        db.session.remove()
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+def test_the_query_string_is_part_of_the_fingerprint(client):
+    body = {'rating': 5, 'review': 'good'}
+    headers = {'Idempotency-Key': 'review-1'}
+
+    first = client.post('/products/1/product-reviews?customer_id=1', json=body, headers=headers)
+    assert first.status_code == 200
+    replayed = client.post('/products/1/product-reviews?customer_id=1', json=body, headers=headers)
+    assert replayed.headers['Idempotent-Replayed'] == 'true'
+    other = client.post('/products/1/product-reviews?customer_id=2', json=body, headers=headers)
+    assert other.status_code == 422
+
+
+def test_memory_store_purges_only_expired_keys():
+    store = MemoryIdempotencyStore(ttl=10)
+    assert store.begin('old', 'a') == NEW
+    store._entries['old']['expires_at'] -= datetime.timedelta(seconds=20)
+    assert store.begin('new', 'b') == NEW
+
+    assert list(store._entries) == ['new']
+    assert store.begin('new', 'c') == MISMATCH
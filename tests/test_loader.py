@@ -0,0 +1,22 @@
+from loader import load_catalog, read_rows
+from models import Brand
+
+'''
+Catalog loader
+'''
+
+
+def test_malformed_ndjson_lines_are_rejected_rows(app, tmp_path):
+    path = tmp_path / 'brands.ndjson'
+    path.write_text('{"name": "first"}\n{"name": "second"\n{"name": "third"}\n', encoding='utf-8')
+
+    reports = []
+    with app.app_context():
+        totals = load_catalog({'brands': read_rows(str(path))},
+            report=lambda table, written, errors, seconds: reports.append(errors))
+        assert totals == {'Brands': 2}
+        assert sorted(brand.name for brand in Brand.query) == ['first', 'third']
+
+    [errors] = reports
+    assert [index for index, _ in errors] == [1]
+    assert errors[0][1].startswith('invalid json')
@@ -0,0 +1,98 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import db, Brand, ProductCategory, Product, Customer, Order
+
+'''
+Order updates
+'''
+
+
+@pytest.fixture
+def app(app):
+    with app.app_context():
+        db.session.add(Brand('brand'))
+        db.session.add(ProductCategory('category'))
+        db.session.add(Customer('customer', 'customer@example.com', 'address'))
+        db.session.commit()
+        db.session.add_all([
+            Product('tracked', 2.5, 1, 'description', 1, stock=10),
+            Product('untracked', 4.0, 1, 'description', 1)])
+        db.session.commit()
+        db.session.remove()
+    return app
+
+
+def stock(app, product_id):
+    with app.app_context():
+        return db.session.query(Product.stock).filter(Product.id == product_id).scalar()
+
+
+def place(client, items):
+    response = client.post('/orders/', json={'customer_id': 1, 'items': items})
+    assert response.status_code == 200
+    return response.get_json()['order']['id']
+
+
+def test_patch_items_prices_the_lines_and_ignores_the_client_cost(app, client):
+    order_id = place(client, [{'product_id': 1, 'quantity': 2}])
+
+    response = client.patch(f'/orders/{order_id}', json={
+        'items': [{'product_id': 1, 'quantity': 1}, {'product_id': 2, 'quantity': 3}],
+        'cost': 0.01})
+    assert response.status_code == 200
+    assert response.get_json()['order']['cost'] == 14.5
+
+    response = client.patch(f'/orders/{order_id}', json={'cost': 0.01})
+    assert response.status_code == 200
+    assert response.get_json()['order']['cost'] == 14.5
+
+
+def test_patch_items_moves_the_stock_by_the_difference(app, client):
+    order_id = place(client, [{'product_id': 1, 'quantity': 4}])
+    assert stock(app, 1) == 6
+
+    assert client.patch(f'/orders/{order_id}', json={'items': [{'product_id': 1, 'quantity': 9}]}).status_code == 200
+    assert stock(app, 1) == 1
+
+    assert client.patch(f'/orders/{order_id}', json={'items': [{'product_id': 2, 'quantity': 1}]}).status_code == 200
+    assert stock(app, 1) == 10
+
+
+def test_patch_items_beyond_the_stock_is_refused(app, client):
+    order_id = place(client, [{'product_id': 1, 'quantity': 4}])
+
+    response = client.patch(f'/orders/{order_id}', json={'items': [{'product_id': 1, 'quantity': 11}]})
+    assert response.status_code == 409
+    assert response.get_json()['product_ids'] == [1]
+    assert stock(app, 1) == 6
+    with app.app_context():
+        assert [(item.product_id, item.quantity) for item in Order.query.get(order_id).items] == [(1, 4)]
+
+
+def test_deleting_an_order_gives_its_stock_back(app, client):
+    order_id = place(client, [{'product_id': 1, 'quantity': 4}, {'product_id': 2, 'quantity': 1}])
+    assert stock(app, 1) == 6
+
+    assert client.delete(f'/orders/{order_id}').status_code == 200
+    assert stock(app, 1) == 10
+    assert stock(app, 2) is None
+    assert client.delete(f'/orders/{order_id}').status_code == 404
+
+
+def test_order_changes_lock_the_order_row(app, client):
+    order_id = place(client, [{'product_id': 1, 'quantity': 1}])
+    locked = []
+    def record(state):
+        if state.is_select:
+            locked.append(state.statement._for_update_arg is not None)
+
+    event.listen(Session, 'do_orm_execute', record)
+    try:
+        assert client.patch(f'/orders/{order_id}', json={'items': [{'product_id': 1, 'quantity': 2}]}).status_code == 200
+        assert client.delete(f'/orders/{order_id}').status_code == 200
+    finally:
+        event.remove(Session, 'do_orm_execute', record)
+    # the PATCH and the DELETE each load the order locked
+    assert locked.count(True) == 2
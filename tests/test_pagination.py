@@ -0,0 +1,76 @@
+import pytest
+
+from models import db, Brand, ProductCategory, Product
+
+'''
+Keyset pagination of the list routes
+'''
+
+PRODUCTS = 30
+
+
+@pytest.fixture
+def app(app):
+    with app.app_context():
+        db.session.add(Brand('brand'))
+        db.session.add(ProductCategory('category'))
+        db.session.commit()
+        for i in range(PRODUCTS):
+            # repeated prices and ratings, a third of the products without a rating
+            product = Product(f'product {i}', float(i % 4), 1, 'description', 1)
+            product.rating_avg = None if i % 3 == 0 else float(i % 5)
+            db.session.add(product)
+        db.session.commit()
+        db.session.remove()
+    return app
+
+
+def walk(client, sort, limit=7):
+    rows, cursor, pages = [], None, 0
+    while True:
+        path = f'/products?sort={sort}&limit={limit}' + (f'&cursor={cursor}' if cursor else '')
+        response = client.get(path)
+        assert response.status_code == 200
+        body = response.get_json()
+        rows += body['products']
+        pages += 1
+        cursor = body['next_cursor']
+        if cursor is None:
+            return rows, pages
+
+
+def expected_ids(key, descending):
+    products = [{'id': i + 1, 'price': float(i % 4), 'rating_avg': None if i % 3 == 0 else float(i % 5)}
+        for i in range(PRODUCTS)]
+    # sqlite sorts nulls below every value
+    rank = lambda product: (product[key] is not None, product[key] or 0, product['id'])
+    return [product['id'] for product in sorted(products, key=rank, reverse=descending)]
+
+
+@pytest.mark.parametrize('sort, key, descending', [
+    ('price', 'price', False),
+    ('-price', 'price', True),
+    ('-rating_avg', 'rating_avg', True),
+    ('rating_avg', 'rating_avg', False),
+])
+def test_cursor_walk_visits_every_row_once_in_order(client, sort, key, descending):
+    rows, pages = walk(client, sort)
+
+    assert [row['id'] for row in rows] == expected_ids(key, descending)
+    assert pages == -(-PRODUCTS // 7)
+
+
+def test_a_cursor_only_continues_its_own_sort(client):
+    cursor = client.get('/products?sort=price&limit=5').get_json()['next_cursor']
+    assert client.get(f'/products?sort=-price&limit=5&cursor={cursor}').status_code == 400
+
+
+@pytest.mark.parametrize('path', ['/products?page=1&limit=100000', '/products?limit=100000'])
+def test_page_size_is_capped(app, client, path):
+    with app.app_context():
+        db.session.add_all([Product(f'more {i}', 1.0, 1, 'description', 1) for i in range(120)])
+        db.session.commit()
+
+    response = client.get(path)
+    assert response.status_code == 200
+    assert 0 < len(response.get_json()['products']) <= 100
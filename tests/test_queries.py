@@ -0,0 +1,86 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.orm import joinedload
+
+from models import db, row_counts, Brand, ProductCategory, Product
+
+'''
+Query counts of the list routes
+
+a page of products is formatted from one query for the products and at most one IN query per
+dimension table, however many products it holds
+'''
+
+PRODUCTS = 120
+BRANDS = 7
+CATEGORIES = 5
+
+
+@pytest.fixture
+def app(app):
+    with app.app_context():
+        db.session.add_all([Brand(f'brand {i}') for i in range(BRANDS)])
+        db.session.add_all([ProductCategory(f'category {i}') for i in range(CATEGORIES)])
+        db.session.commit()
+        db.session.add_all([
+            Product(f'product {i}', 1.0 + i, 1 + i % BRANDS, 'description', 1 + i % CATEGORIES)
+            for i in range(PRODUCTS)])
+        db.session.commit()
+        db.session.remove()
+    return app
+
+
+def count_queries(app, path, cold=True):
+    if cold:
+        Brand.cache.invalidate()
+        ProductCategory.cache.invalidate()
+        row_counts.invalidate()
+
+    statements = []
+    def record(connection, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = app.test_client().get(path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    return response.get_json(), statements
+
+
+@pytest.mark.parametrize('limit', [10, 50])
+def test_get_products_query_count(app, limit):
+    body, statements = count_queries(app, f'/products?limit={limit}')
+
+    assert len(body['products']) == limit
+    assert all(isinstance(product['brand'], dict) for product in body['products'])
+    assert all(isinstance(product['product_category'], dict) for product in body['products'])
+    # table versions, the page, brands, categories and the total
+    assert len(statements) == 5
+
+
+def test_get_products_query_count_does_not_grow_with_the_page(app):
+    _, small = count_queries(app, '/products?limit=10')
+    _, large = count_queries(app, '/products?limit=50')
+    assert len(small) == len(large)
+
+
+def test_get_products_warm_caches(app):
+    count_queries(app, '/products?limit=50')
+    # brands, categories and the total come from the caches the first page filled
+    _, statements = count_queries(app, '/products?limit=50', cold=False)
+    assert len(statements) == 2
+
+def test_product_relationships_load_only_when_asked_for(app):
+    with app.app_context():
+        product = Product.query.options(joinedload(Product.brand_obj), joinedload(Product.category_obj)).first()
+        assert (product.brand_obj.id, product.category_obj.id) == (product.brand, product.product_category)
+
+        lazy = Product.query.filter(Product.id == 2).one()
+        with pytest.raises(InvalidRequestError):
+            lazy.brand_obj
+        db.session.remove()
@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from app import create_app
+from models import db, row_counts, Brand, ProductCategory, Product
+
+'''
+Read replicas
+
+the primary and the replica are two sqlite files holding different names, so a response shows
+which of them each part of it was read from
+'''
+
+
+def seed(url, name):
+    app = create_app({'SQLALCHEMY_DATABASE_URI': url, 'DB_SCHEMA': 'create'})
+    with app.app_context():
+        db.session.add(Brand(f'{name} brand'))
+        db.session.add(ProductCategory(f'{name} category'))
+        db.session.commit()
+        db.session.add(Product(f'{name} product', 1.0, 1, 'description', 1))
+        db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+
+
+@pytest.fixture
+def app(tmp_path):
+    primary = f'sqlite:///{tmp_path / "primary.db"}'
+    replica = f'sqlite:///{tmp_path / "replica.db"}'
+    seed(primary, 'primary')
+    seed(replica, 'replica')
+    row_counts.invalidate()
+    Brand.cache.invalidate()
+    ProductCategory.cache.invalidate()
+    app = create_app({'SQLALCHEMY_DATABASE_URI': primary, 'DB_REPLICA_URLS': replica})
+    yield app
+    with app.app_context():
+        db.session.remove()
+        db.engine.dispose()
+
+
+def test_cached_dimensions_are_read_from_the_primary(client):
+    [product] = client.get('/products').get_json()['products']
+
+    assert product['name'] == 'replica product'
+    assert product['brand']['name'] == 'primary brand'
+    assert product['product_category']['name'] == 'primary category'
+
+
+def test_validators_are_read_with_the_body(app, client, tmp_path):
+    with app.app_context():
+        brand = Brand.query.get(1)
+        brand.name = 'renamed brand'
+        db.session.commit()
+    response = client.get('/brands')
+
+    replica = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "replica.db"}'})
+    expected = replica.test_client().get('/brands')
+    with replica.app_context():
+        db.engine.dispose()
+
+    assert response.get_json()['brands'][0]['name'] == 'replica brand'
+    assert response.headers['ETag'] == expected.headers['ETag']
+    assert response.headers['Last-Modified'] == expected.headers['Last-Modified']
+
+
+def test_a_failing_replica_is_retried_on_the_primary(tmp_path):
+    primary = f'sqlite:///{tmp_path / "primary.db"}'
+    seed(primary, 'primary')
+    Brand.cache.invalidate()
+    ProductCategory.cache.invalidate()
+    # a replica without the schema fails every read
+    app = create_app({'SQLALCHEMY_DATABASE_URI': primary, 'DB_REPLICA_URLS': f'sqlite:///{tmp_path / "empty.db"}'})
+
+    response = app.test_client().get('/products')
+    assert response.status_code == 200
+    [product] = response.get_json()['products']
+    assert product['name'] == 'primary product'
+    assert app.extensions['replicas'].status()['fallbacks'] == 1
+    with app.app_context():
+        db.engine.dispose()
+
+
+def test_exports_stream_from_the_replica_their_validators_came_from(app, client, tmp_path):
+    with app.app_context():
+        Brand.query.get(1).name = 'renamed brand'
+        db.session.commit()
+    response = client.get('/export/brands')
+    names = [json.loads(line)['name'] for line in response.get_data().splitlines()]
+
+    replica = create_app({'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "replica.db"}'})
+    expected = replica.test_client().get('/export/brands')
+    with replica.app_context():
+        db.engine.dispose()
+
+    assert names == ['replica brand']
+    assert response.headers['ETag'] == expected.headers['ETag']
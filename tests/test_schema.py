@@ -0,0 +1,57 @@
+from sqlalchemy import inspect
+
+from models import db, create_schema, check_schema
+
+'''
+Schema upgrades
+'''
+
+
+def test_create_schema_adds_indexes_to_existing_tables(app):
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('DROP INDEX "ix_Products_brand_id"')
+            connection.exec_driver_sql('DROP INDEX "ix_Products_product_category_price_id"')
+
+        create_schema()
+
+        indexes = {index['name'] for index in inspect(db.engine).get_indexes('Products')}
+        assert {'ix_Products_brand_id', 'ix_Products_product_category_price_id'} <= indexes
+        check_schema()
+
+
+def test_create_schema_upgrades_a_products_table_without_rating_aggregates(app, client):
+    with app.app_context():
+        with db.engine.begin() as connection:
+            connection.exec_driver_sql('DROP INDEX "ix_Products_rating_avg_id"')
+            for column in ('review_count', 'rating_sum', 'rating_avg'):
+                connection.exec_driver_sql(f'ALTER TABLE "Products" DROP COLUMN {column}')
+            connection.exec_driver_sql('INSERT INTO "Brands" (id, name) VALUES (1, \'brand\')')
+            connection.exec_driver_sql('INSERT INTO "Customers" (id, name, email) VALUES (1, \'c\', \'c@example.com\')')
+            connection.exec_driver_sql('INSERT INTO "Products" (id, name, price, brand) VALUES (1, \'lamp\', 10.0, 1)')
+            connection.exec_driver_sql('INSERT INTO "ProductReviews" (review, rating, product, customer_id) '
+                'VALUES (\'good\', 4.0, 1, 1), (\'fine\', 3.0, 1, 1)')
+
+        create_schema()
+        check_schema()
+
+    product = client.get('/products').get_json()['products'][0]
+    assert (product['review_count'], product['rating_avg']) == (2, 3.5)
+
+
+def test_create_schema_adds_the_search_index_to_an_existing_products_table(app, client):
+    with app.app_context():
+        with db.engine.begin() as connection:
+            for trigger in ('insert', 'delete', 'update'):
+                connection.exec_driver_sql(f'DROP TRIGGER "Products_search_{trigger}"')
+            connection.exec_driver_sql('DROP TABLE "ProductsSearch"')
+            connection.exec_driver_sql('INSERT INTO "Brands" (id, name) VALUES (1, \'brand\')')
+            connection.exec_driver_sql('INSERT INTO "Products" (id, name, price, brand, description) '
+                'VALUES (1, \'desk lamp\', 10.0, 1, \'a lamp\'), (2, \'chair\', 20.0, 1, \'a chair\')')
+
+        create_schema()
+        check_schema()
+
+    response = client.get('/products/search?q=lamp')
+    assert response.status_code == 200
+    assert [product['id'] for product in response.get_json()['products']] == [1]